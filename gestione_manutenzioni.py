@@ -1,14 +1,18 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import sqlite3
 import os
 import datetime
 from dateutil.relativedelta import relativedelta
 from geopy.distance import geodesic
 from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
 import time
 import uuid
 import folium
+from folium.plugins import FastMarkerCluster
+from jinja2 import Template
 from streamlit_folium import st_folium
 from streamlit_pdf_viewer import pdf_viewer
 from reportlab.lib import colors
@@ -20,12 +24,23 @@ from reportlab.lib import colors
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 import re
+import logging
 import io 
 from io import BytesIO
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-from github import Github, GithubException
 import tempfile
+import threading
+import bisect
+import unicodedata
+from collections import Counter
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import json
 
 # --- CONFIGURAZIONE E COSTANTI ---
 st.set_page_config(
@@ -34,65 +49,534 @@ st.set_page_config(
     layout="wide"
 )
 
+logger = logging.getLogger(__name__)
+
 DB_FILE = "manutenzioni.db"
+LOGIN_DB_FILE = "login_log.db"
 
 # FUNZIONE PER STREAMLIT CLOUD : RIPRISTINA I FILE .DB DA GITHUB 
 
 # --- Funzioni di backup/restore ---
-def get_github_repo():
-    token = st.secrets["github"]["token"]
-    repo_name = st.secrets["github"]["repo"]
-    branch = st.secrets["github"]["branch"]
-    g = Github(token)
-    repo = g.get_repo(repo_name)
-    return repo, branch
+
+BACKUP_DB_FILES = [DB_FILE, LOGIN_DB_FILE]
+BACKUP_STATE_FILE = "backup_state.json"   # hash dell'ultimo snapshot caricato per ogni database
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_TIMEOUT = 60
+# errori temporanei e limiti di frequenza: nuovi tentativi con attesa crescente (anche per POST/PATCH,
+# qui idempotenti: blob e alberi sono indirizzati per contenuto, il ref punta sempre allo stesso commit)
+GITHUB_RETRY = Retry(
+    total=4, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None, respect_retry_after_header=True, raise_on_status=False,
+)
+SQLITE_HEADER = b"SQLite format 3\x00"
+# formato a blocchi: backup/<db>/manifest.json + backup/<db>/chunks/<sha256 del blocco>.gz
+BACKUP_DIR = "backup"
+BACKUP_CHUNK_SIZE = 1024 * 1024   # multiplo della pagina SQLite: una pagina modificata cambia un solo blocco
+BACKUP_MANIFEST_FORMAT = 1
+BACKUP_DOWNLOAD_WORKERS = 4
+# backup incrementali: fra due snapshot completi si accodano al manifest segmenti del journal
+BACKUP_FULL_INTERVAL = datetime.timedelta(hours=24)
+BACKUP_MAX_JOURNAL_SEGMENTS = 50
+# oltre queste righe (backup che non riescono) il journal viene svuotato e si torna allo snapshot completo
+JOURNAL_MAX_ROWS = 100_000
+# backup automatico: dopo BACKUP_AUTO_QUIET_SECONDS senza scritture, o al più tardi dopo BACKUP_AUTO_MAX_MINUTES
+BACKUP_AUTO_QUIET_SECONDS = 60
+BACKUP_AUTO_MAX_MINUTES = 10
+BACKUP_AUTO_POLL_SECONDS = 5
+BACKUP_AUTO_RETRY_SECONDS = 300
+
+
+def github_settings():
+    """
+    Parametri GitHub da st.secrets["github"]: token, repo, branch, api_url e le opzioni del
+    backup automatico (auto_backup, auto_backup_quiet_seconds, auto_backup_max_minutes).
+    KeyError se mancano le credenziali, FileNotFoundError (StreamlitSecretNotFoundError) se
+    manca del tutto il file dei secrets.
+    """
+    conf = st.secrets["github"]
+    return {
+        "token": conf["token"],
+        "repo": conf["repo"],
+        "branch": conf.get("branch", "main"),
+        "api_url": conf.get("api_url", GITHUB_API_URL).rstrip("/"),
+        "auto_backup": bool(conf.get("auto_backup", True)),
+        "quiet_seconds": float(conf.get("auto_backup_quiet_seconds", BACKUP_AUTO_QUIET_SECONDS)),
+        "max_delay_seconds": 60 * float(conf.get("auto_backup_max_minutes", BACKUP_AUTO_MAX_MINUTES)),
+    }
 
 
-def backup_to_github_simple():
-    github_token = st.secrets["github"]["token"]
-    repo = st.secrets["github"]["repo"]
-    branch = st.secrets["github"]["branch"]
-
-    db_files = ["login_log.db", "manutenzioni.db"]
-    headers = {
-        "Authorization": f"token {github_token}",
-        "Accept": "application/vnd.github+json"
+def github_session(settings):
+    """Sessione HTTP riusata per tutte le chiamate di un backup/ripristino, con retry e backoff."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"token {settings['token']}",
+        "Accept": "application/vnd.github+json",
+    })
+    adapter = HTTPAdapter(max_retries=GITHUB_RETRY)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def github_contents_url(settings, path):
+    return f"{settings['api_url']}/repos/{settings['repo']}/contents/{path}"
+
+
+def github_api(session, method, settings, path, expected=(200,), **kwargs):
+    """Chiamata all'API del repo (path relativo a /repos/{repo}/): JSON della risposta, RuntimeError se inattesa."""
+    response = session.request(
+        method, f"{settings['api_url']}/repos/{settings['repo']}/{path}", timeout=GITHUB_TIMEOUT, **kwargs
+    )
+    if response.status_code not in expected:
+        raise RuntimeError(f"Errore GitHub ({response.status_code}) su {method} {path}: {response.text[:200]}")
+    return response.json()
+
+
+def github_head_commit(settings, session):
+    """SHA del commit in testa al branch configurato."""
+    return github_api(session, "GET", settings, f"git/ref/heads/{settings['branch']}")["object"]["sha"]
+
+
+def commit_to_github(settings, session, plan, message, sent=None):
+    """
+    Un unico commit con la Git Data API: blob dei file nuovi, un albero sopra quello del commit
+    in testa, il commit e un solo spostamento del ref del branch. Il branch cambia solo alla fine,
+    quindi un errore a metà non lascia file di versioni diverse.
+    Il prezzo è nel numero di richieste: 3 GET (ref, commit, albero) + un POST per blob + albero,
+    commit e PATCH del ref, più delle 2 GET + 2 PUT dell'API contents per due file; in cambio
+    l'albero in testa dice quali blocchi sono già presenti e si caricano solo quelli mancanti.
+
+    `plan(existing)` riceve {percorso: sha del blob} dell'albero in testa e ritorna le modifiche
+    {percorso: funzione che produce i bytes, oppure None per eliminarlo}. Se nel frattempo il branch
+    è avanzato, ricalcola le modifiche sulla nuova testa (una volta): i blob già creati sono
+    riconosciuti dal contenuto, quindi un piano diverso al secondo tentativo non riusa blob vecchi.
+    In `sent`, se dato, annota {percorso: byte} dei blob effettivamente inviati.
+    Ritorna lo SHA del commit (quello in testa se non c'è nulla da cambiare).
+    """
+    blobs = set()
+    for attempt in range(2):
+        head = github_head_commit(settings, session)
+        base_tree = github_api(session, "GET", settings, f"git/commits/{head}")["tree"]["sha"]
+        listing = github_api(session, "GET", settings, f"git/trees/{base_tree}", params={"recursive": "1"})
+        existing = {entry["path"]: entry["sha"] for entry in listing["tree"] if entry["type"] == "blob"}
+
+        entries = []
+        for path, load in plan(existing).items():
+            if load is None:
+                if path in existing:
+                    entries.append({"path": path, "mode": "100644", "type": "blob", "sha": None})
+                continue
+            content = load()
+            sha = git_blob_sha(content)
+            if sha not in blobs:
+                github_api(session, "POST", settings, "git/blobs", expected=(201,), json={
+                    "content": base64.b64encode(content).decode("ascii"), "encoding": "base64",
+                })
+                blobs.add(sha)
+                if sent is not None:
+                    sent[path] = sent.get(path, 0) + len(content)
+            entries.append({"path": path, "mode": "100644", "type": "blob", "sha": sha})
+        if not entries:
+            return head
+
+        tree = github_api(session, "POST", settings, "git/trees", expected=(201,), json={
+            "base_tree": base_tree, "tree": entries,
+        })["sha"]
+        commit = github_api(session, "POST", settings, "git/commits", expected=(201,), json={
+            "message": message, "tree": tree, "parents": [head],
+        })["sha"]
+        try:
+            github_api(session, "PATCH", settings, f"git/refs/heads/{settings['branch']}", json={"sha": commit, "force": False})
+            return commit
+        except RuntimeError:
+            if attempt == 1:
+                raise
+
+
+def load_backup_state():
+    try:
+        with open(BACKUP_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_backup_state(state):
+    tmp_path = BACKUP_STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, BACKUP_STATE_FILE)
+
+
+@contextlib.contextmanager
+def database_snapshot(db_file):
+    """
+    Copia coerente del database in un file temporaneo con l'API di backup di SQLite (comprende
+    i commit ancora nel WAL e non risente di scritture in corso); il file viene rimosso all'uscita.
+    A database invariato i byte sono identici, quindi gli hash dicono se c'è qualcosa da salvare.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        source = sqlite3.connect(db_file, timeout=30)
+        target = sqlite3.connect(tmp_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def snapshot_manifest(path, db_file):
+    """
+    Manifest di uno snapshot letto a blocchi: sha256 e dimensione del file e di ogni blocco,
+    posizione del journal compresa nello snapshot e segmenti del journal accodati (nessuno).
+    """
+    total, chunks = hashlib.sha256(), []
+    with open(path, "rb") as f:
+        while chunk := f.read(BACKUP_CHUNK_SIZE):
+            total.update(chunk)
+            chunks.append({"sha256": hashlib.sha256(chunk).hexdigest(), "bytes": len(chunk)})
+    journal_seq, snapshot_requests = journal_position(path) or (None, None)
+    return {
+        "formato": BACKUP_MANIFEST_FORMAT,
+        "file": db_file,
+        "sha256": total.hexdigest(),
+        "bytes": sum(chunk["bytes"] for chunk in chunks),
+        "chunk_size": BACKUP_CHUNK_SIZE,
+        "chunks": chunks,
+        "creato_il": datetime.datetime.now().isoformat(timespec="seconds"),
+        "journal_seq": journal_seq,
+        "snapshot_richiesti": snapshot_requests,
+        "journal": [],
     }
 
-    for db_file in db_files:
-        if os.path.exists(db_file):
-            try:
-                with open(db_file, "rb") as f:
-                    content = base64.b64encode(f.read()).decode("utf-8")
-
-                # Controlla SHA esistente per evitare errori 409
-                get_url = f"https://api.github.com/repos/{repo}/contents/{db_file}?ref={branch}"
-                get_res = requests.get(get_url, headers=headers)
-                sha = get_res.json().get("sha") if get_res.status_code == 200 else None
-
-                # Effettua il PUT
-                put_url = f"https://api.github.com/repos/{repo}/contents/{db_file}"
-                data = {
-                    "message": f"💾 Backup {db_file} da Streamlit",
-                    "content": content,
-                    "branch": branch,
-                }
-                if sha:
-                    data["sha"] = sha
 
-                put_res = requests.put(put_url, headers=headers, json=data)
-                if put_res.status_code in [200, 201]:
-                    st.success(f"✅ {db_file} salvato su GitHub")
+def backup_paths(db_file):
+    """Percorsi remoti del backup a blocchi: (manifest, cartella dei blocchi, cartella del journal)."""
+    base = f"{BACKUP_DIR}/{db_file}"
+    return f"{base}/manifest.json", f"{base}/chunks/", f"{base}/journal/"
+
+
+def manifest_bytes(manifest):
+    return json.dumps(manifest, indent=1).encode("utf-8")
+
+
+def git_blob_sha(content):
+    """SHA con cui Git identifica un blob: dice se un file del repo ha esattamente questo contenuto."""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def _chunk_loader(path, index):
+    def load():
+        with open(path, "rb") as f:
+            f.seek(index * BACKUP_CHUNK_SIZE)
+            return gzip.compress(f.read(BACKUP_CHUNK_SIZE), mtime=0)
+    return load
+
+
+def full_backup_changes(db_file, snapshot_path, manifest, existing):
+    """
+    Modifiche all'albero del repo per lo snapshot completo di un database (vedi commit_to_github):
+    i soli blocchi non ancora presenti, il manifest, e l'eliminazione dei blocchi non più
+    referenziati, dei segmenti del journal (compresi nello snapshot) e del vecchio `<db_file>.gz`.
+    """
+    manifest_path, chunks_dir, journal_dir = backup_paths(db_file)
+    changes, wanted = {}, set()
+    for index, chunk in enumerate(manifest["chunks"]):
+        chunk_path = f"{chunks_dir}{chunk['sha256']}.gz"
+        wanted.add(chunk_path)
+        if chunk_path not in existing and chunk_path not in changes:
+            changes[chunk_path] = _chunk_loader(snapshot_path, index)
+    changes[manifest_path] = lambda: manifest_bytes(manifest)
+    for path in existing:
+        if (path.startswith(chunks_dir) and path not in wanted) or path.startswith(journal_dir):
+            changes[path] = None
+    changes[f"{db_file}.gz"] = None
+    return changes
+
+
+def journal_backup_changes(db_file, manifest, rows):
+    """
+    Modifiche all'albero del repo per un backup incrementale: un segmento con le righe del journal
+    (JSON Lines compresso) e il manifest che lo elenca. Ritorna (modifiche, nuovo manifest).
+    """
+    manifest_path, _, journal_dir = backup_paths(db_file)
+    content = gzip.compress("\n".join(json.dumps(row) for row in rows).encode("utf-8"), mtime=0)
+    segment = {
+        "path": f"{journal_dir}{rows[0][0]:012d}-{rows[-1][0]:012d}.jsonl.gz",
+        "da": rows[0][0],
+        "a": rows[-1][0],
+        "righe": len(rows),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    new_manifest = {**manifest, "journal": manifest["journal"] + [segment]}
+    return {segment["path"]: lambda: content, manifest_path: lambda: manifest_bytes(new_manifest)}, new_manifest
+
+
+def incremental_backup_base(previous, position, now):
+    """
+    Manifest dell'ultimo backup a cui accodare il journal, oppure None se serve uno snapshot
+    completo: database senza journal, nessun manifest noto, operazioni massive non registrate
+    dopo lo snapshot, snapshot più vecchio di BACKUP_FULL_INTERVAL o troppi segmenti accodati.
+    """
+    manifest = previous.get("manifest")
+    if not manifest or position is None or manifest.get("journal_seq") is None:
+        return None
+    if position[1] != manifest["snapshot_richiesti"] or len(manifest["journal"]) >= BACKUP_MAX_JOURNAL_SEGMENTS:
+        return None
+    if now - datetime.datetime.fromisoformat(previous["completo_il"]) >= BACKUP_FULL_INTERVAL:
+        return None
+    return manifest
+
+
+def backup_databases(settings, db_files=None, force=False, full=False):
+    """
+    Backup (senza interfaccia) dei database cambiati dall'ultimo caricamento, in un unico commit:
+    o tutti o nessuno. Se possibile è incrementale (solo le righe del journal successive
+    all'ultimo backup), altrimenti uno snapshot completo a blocchi; con full lo snapshot è
+    sempre completo, con force viene caricato anche se invariato. Le tabelle fuori dal journal
+    (cache, code di lavoro) viaggiano solo con gli snapshot completi.
+    Per ogni database ritorna un report con file, esito ("caricato", "invariato", "assente",
+    "errore"), tipo ("completo", "incrementale"), byte, blocchi caricati/totali, righe,
+    byte effettivamente inviati (compressi), messaggio.
+    """
+    state = load_backup_state()
+    now = datetime.datetime.now()
+    reports, pending = [], {}
+    with contextlib.ExitStack() as stack:
+
+        def take_snapshot(item):
+            # lo snapshot si prende una volta sola; report e manifest si riallineano a ogni tentativo
+            if "snapshot" not in item:
+                item["snapshot"] = stack.enter_context(database_snapshot(item["report"]["file"]))
+                item["snapshot_manifest"] = snapshot_manifest(item["snapshot"], item["report"]["file"])
+            item.update(incrementale=False, manifest=item["snapshot_manifest"])
+            item["report"].update(tipo="completo", righe=0, bytes=item["manifest"]["bytes"], blocchi=len(item["manifest"]["chunks"]))
+
+        for db_file in db_files or BACKUP_DB_FILES:
+            report = {"file": db_file, "esito": None, "tipo": None, "bytes": 0, "blocchi": 0,
+                      "blocchi_caricati": 0, "righe": 0, "bytes_inviati": 0, "messaggio": ""}
+            reports.append(report)
+            if not os.path.exists(db_file):
+                report.update(esito="assente", messaggio=f"File {db_file} non trovato in locale — nessun backup eseguito.")
+                continue
+            previous, item = state.get(db_file, {}), {"report": report}
+            try:
+                base = None if (full or force) else incremental_backup_base(previous, journal_position(db_file), now)
+                if base is not None:
+                    item.update(base=base, rows=read_journal(db_file, previous["journal_seq"]))
+                    report.update(tipo="incrementale", righe=len(item["rows"]))
+                    if not item["rows"]:
+                        report.update(esito="invariato", messaggio=f"{db_file}: nessuna modifica registrata dall'ultimo backup.")
+                        continue
                 else:
-                    st.error(f"❌ Errore salvando {db_file}: {put_res.status_code}")
-                    st.text(put_res.text)
+                    take_snapshot(item)
+                    if not force and previous.get("sha256") == item["manifest"]["sha256"]:
+                        report.update(esito="invariato", messaggio=f"{db_file} invariato dall'ultimo backup: nessun caricamento.")
+                        continue
             except Exception as e:
-                st.error(f"❌ Errore durante backup di {db_file}: {e}")
+                report.update(esito="errore", messaggio=f"Errore durante la preparazione del backup di {db_file}: {e}")
+                continue
+            pending[db_file] = item
+        if not pending:
+            return reports
+
+        def plan(existing):
+            # ricalcolato da zero a ogni tentativo: la testa del branch può essere cambiata
+            changes = {}
+            for db_file, item in pending.items():
+                manifest_path = backup_paths(db_file)[0]
+                if "rows" in item and existing.get(manifest_path) == git_blob_sha(manifest_bytes(item["base"])):
+                    db_changes, manifest = journal_backup_changes(db_file, item["base"], item["rows"])
+                    item.update(incrementale=True, manifest=manifest)
+                    item["report"].update(tipo="incrementale", righe=len(item["rows"]), bytes=0, blocchi=0, blocchi_caricati=0)
+                else:
+                    # nessun journal, o il manifest remoto non è quello a cui si riferisce: snapshot completo
+                    take_snapshot(item)
+                    db_changes = full_backup_changes(db_file, item["snapshot"], item["manifest"], existing)
+                    item["report"]["blocchi_caricati"] = sum(1 for path, load in db_changes.items() if load and "/chunks/" in path)
+                changes.update(db_changes)
+            return changes
+
+        sent = {}
+        try:
+            with github_session(settings) as session:
+                commit = commit_to_github(settings, session, plan, f"💾 Backup {', '.join(pending)} da Streamlit", sent)
+        except Exception as e:
+            for item in pending.values():
+                item["report"].update(esito="errore", messaggio=f"Backup di {item['report']['file']} non eseguito: {e}")
+            return reports
+
+    stamp = now.isoformat(timespec="seconds")
+    for db_file, item in pending.items():
+        report, manifest = item["report"], item["manifest"]
+        remote_dir = f"{BACKUP_DIR}/{db_file}/"
+        report["bytes_inviati"] = sum(size for path, size in sent.items() if path.startswith(remote_dir))
+        if item["incrementale"]:
+            state[db_file].update(manifest=manifest, journal_seq=item["rows"][-1][0], commit=commit, caricato_il=stamp)
+            report.update(esito="caricato", messaggio=(
+                f"{db_file}: backup incrementale di {report['righe']} modifiche (commit {commit[:7]})."
+            ))
+            continue
+        state[db_file] = {
+            "sha256": manifest["sha256"], "remoto": backup_paths(db_file)[0], "commit": commit,
+            "caricato_il": stamp, "completo_il": stamp, "manifest": manifest, "journal_seq": manifest["journal_seq"],
+        }
+        if manifest["journal_seq"]:
+            # le righe comprese nello snapshot caricato non servono più
+            prune_journal(db_file, manifest["journal_seq"])
+        report.update(esito="caricato", messaggio=(
+            f"{db_file} salvato su GitHub ({report['bytes'] / 1e6:.2f} MB, caricati "
+            f"{report['blocchi_caricati']} blocchi su {report['blocchi']}, commit {commit[:7]})."
+        ))
+    save_backup_state(state)
+    return reports
+
+
+def backup_to_github_simple():
+    try:
+        settings = github_settings()
+    except (KeyError, FileNotFoundError):
+        st.error("❌ Errore: credenziali GitHub non trovate in st.secrets['github'].")
+        return
+    reports = run_backup(_backup_scheduler(), _data_versions(), settings, "manuale")
+    if reports is None:
+        st.info("⏳ Un backup è già in corso: riprova tra qualche istante.")
+        return
+    for report in reports:
+        if report["esito"] == "caricato":
+            st.success(f"✅ {report['messaggio']}")
+        elif report["esito"] == "invariato":
+            st.info(f"ℹ️ {report['messaggio']}")
+        elif report["esito"] == "assente":
+            st.warning(f"⚠️ {report['messaggio']}")
         else:
-            st.warning(f"⚠️ File {db_file} non trovato in locale — nessun backup eseguito.")
+            st.error(f"❌ {report['messaggio']}")
 
 # === RESTORE FROM GITHUB===
 
+def download_github_file(settings, session, path, ref=None):
+    """Contenuto grezzo di un file del repo (fino a 100 MB, a differenza del JSON base64), None se assente."""
+    response = session.get(
+        github_contents_url(settings, path),
+        params={"ref": ref or settings["branch"]},
+        headers={"Accept": "application/vnd.github.raw+json"},
+        timeout=GITHUB_TIMEOUT,
+    )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore GitHub ({response.status_code}) per {path}.")
+    return response.content
+
+
+def _download_chunk(settings, session, chunks_dir, chunk, ref):
+    """Scarica, decomprime e verifica (sha256 e dimensione) un blocco del backup."""
+    content = download_github_file(settings, session, f"{chunks_dir}{chunk['sha256']}.gz", ref)
+    if content is None:
+        raise ValueError(f"blocco {chunk['sha256'][:12]} mancante nel repo.")
+    data = gzip.decompress(content)
+    if len(data) != chunk["bytes"] or hashlib.sha256(data).hexdigest() != chunk["sha256"]:
+        raise ValueError(f"blocco {chunk['sha256'][:12]} corrotto.")
+    return data
+
+
+def restore_chunked(manifest, out_path, settings, session, ref=None):
+    """
+    Ricostruisce uno snapshot dal manifest in out_path: blocchi scaricati in parallelo, verificati
+    e scritti su disco in ordine man mano che arrivano; alla fine verifica l'hash dell'intero file.
+    """
+    _, chunks_dir, _ = backup_paths(manifest["file"])
+    total = hashlib.sha256()
+    with ThreadPoolExecutor(max_workers=BACKUP_DOWNLOAD_WORKERS) as pool, open(out_path, "wb") as out:
+        for data in pool.map(lambda chunk: _download_chunk(settings, session, chunks_dir, chunk, ref), manifest["chunks"]):
+            total.update(data)
+            out.write(data)
+    if total.hexdigest() != manifest["sha256"]:
+        raise ValueError(f"lo snapshot ricostruito di {manifest['file']} non corrisponde al manifest.")
+
+
+def _download_segment(settings, session, segment, ref):
+    """Scarica e verifica un segmento del journal: lista delle righe (vedi read_journal)."""
+    content = download_github_file(settings, session, segment["path"], ref)
+    if content is None or hashlib.sha256(content).hexdigest() != segment["sha256"]:
+        raise ValueError(f"segmento del journal {segment['path']} mancante o corrotto.")
+    return [json.loads(line) for line in gzip.decompress(content).decode("utf-8").splitlines()]
+
+
+def restore_journal(manifest, db_path, settings, session, ref=None):
+    """Riapplica allo snapshot ricostruito in db_path i segmenti del journal elencati nel manifest, in ordine."""
+    with ThreadPoolExecutor(max_workers=BACKUP_DOWNLOAD_WORKERS) as pool:
+        segments = list(pool.map(lambda segment: _download_segment(settings, session, segment, ref), manifest["journal"]))
+    replayed = {row[1] for rows in segments for row in rows}
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            for rows in segments:
+                replay_journal(conn, rows)
+            # INSERT OR REPLACE non attiva i trigger di UPDATE/DELETE: R*Tree e cache delle distanze
+            # dello snapshot vanno ricostruiti dai dati riapplicati
+            if "manutenzioni" in replayed:
+                install_spatial_index(conn, "manutenzioni")
+                install_distance_cache(conn, clear=True)
+            if "comuni" in replayed:
+                install_spatial_index(conn, "comuni")
+    finally:
+        conn.close()
+
+
+def restore_database(db_file, settings, session, state, ref=None):
+    """
+    Ripristina db_file da GitHub (al commit `ref`, di default la testa del branch) se non è
+    presente in locale. Usa il backup a blocchi se c'è il manifest (snapshot più i segmenti
+    del journal), altrimenti i formati precedenti `<db_file>.gz` e `<db_file>` non compresso. Scrive su un file temporaneo e lo
+    rinomina solo se è un database SQLite valido e integro. Ritorna un report: file, esito
+    ("presente", "ripristinato", "non trovato"), origine.
+    """
+    if os.path.exists(db_file):
+        return {"file": db_file, "esito": "presente", "origine": None}
+    tmp_path = f"{db_file}.restore"
+    manifest_path, _, _ = backup_paths(db_file)
+    try:
+        origin, manifest = None, download_github_file(settings, session, manifest_path, ref)
+        if manifest is not None:
+            manifest = json.loads(manifest)
+            restore_chunked(manifest, tmp_path, settings, session, ref)
+            if manifest.get("journal"):
+                restore_journal(manifest, tmp_path, settings, session, ref)
+            origin, digest = manifest_path, manifest["sha256"]
+        else:
+            for remote_path, compressed in ((f"{db_file}.gz", True), (db_file, False)):
+                content = download_github_file(settings, session, remote_path, ref)
+                if content is None:
+                    continue
+                data = gzip.decompress(content) if compressed else content
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                origin, digest = remote_path, hashlib.sha256(data).hexdigest()
+                break
+        if origin is None:
+            return {"file": db_file, "esito": "non trovato", "origine": None}
+        with open(tmp_path, "rb") as f:
+            if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+                raise ValueError(f"{origin} non contiene un database SQLite valido.")
+        os.replace(tmp_path, db_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    # il database appena scaricato coincide con il backup: il prossimo backup non lo ricarica
+    state[db_file] = {"sha256": digest, "remoto": origin,
+                      "caricato_il": datetime.datetime.now().isoformat(timespec="seconds")}
+    if manifest is not None and not manifest.get("journal"):
+        # snapshot senza journal accodato: i prossimi backup possono essere incrementali su questo manifest
+        state[db_file].update(manifest=manifest, journal_seq=manifest["journal_seq"], completo_il=manifest["creato_il"])
+    return {"file": db_file, "esito": "ripristinato", "origine": origin}
+
+
 def restore_from_github_simple():
     """
     🔄 Ripristina i database da GitHub *solo se non presenti in locale*.
@@ -106,44 +590,33 @@ def restore_from_github_simple():
         "warnings": []          # Lista degli avvertimenti
     }
     try:
-        github_conf = st.secrets["github"]
-        token = github_conf["token"]
-        repo = github_conf["repo"]
-        branch = github_conf.get("branch", "main")
-
-        db_files = ["manutenzioni.db", "login_log.db"]
-        headers = {"Authorization": f"token {token}"}
+        settings = github_settings()
+    except (KeyError, FileNotFoundError):
+        report["errors"].append("❌ Errore: credenziali GitHub non trovate in st.secrets['github'].")
+        return report
 
-        for db_file in db_files:
-            if os.path.exists(db_file):
-                report["already_present"].append(db_file)
+    state = load_backup_state()
+    with github_session(settings) as session:
+        missing = [db_file for db_file in BACKUP_DB_FILES if not os.path.exists(db_file)]
+        try:
+            # tutti i file dallo stesso commit: un punto di ripristino coerente
+            ref = github_head_commit(settings, session) if missing else None
+        except Exception as e:
+            report["errors"].append(f"❌ Errore durante il ripristino: {e}")
+            return report
+        for db_file in BACKUP_DB_FILES:
+            try:
+                result = restore_database(db_file, settings, session, state, ref)
+            except Exception as e:
+                report["errors"].append(f"❌ Errore durante il ripristino di {db_file}: {e}")
                 continue
-
-            url = f"https://api.github.com/repos/{repo}/contents/{db_file}?ref={branch}"
-            response = requests.get(url, headers=headers)
-
-            if response.status_code == 200:
-                content_json = response.json()
-                encoded_content = content_json.get("content", "")
-                encoding = content_json.get("encoding", "")
-
-                if encoding == "base64" and encoded_content:
-                    binary_data = base64.b64decode(encoded_content)
-                    with open(db_file, "wb") as f:
-                        f.write(binary_data)
-                    report["restored"].append(db_file)
-                else:
-                    report["warnings"].append(f"⚠️ {db_file} trovato ma encoding non valido ({encoding}).")
-            elif response.status_code == 404:
-                report["warnings"].append(f"⚠️ {db_file} non trovato nel repo GitHub.")
+            if result["esito"] == "presente":
+                report["already_present"].append(db_file)
+            elif result["esito"] == "ripristinato":
+                report["restored"].append(f"{db_file} (da {result['origine']})")
             else:
-                report["errors"].append(f"❌ Errore GitHub ({response.status_code}) per {db_file}.")
-
-    except KeyError:
-        report["errors"].append("❌ Errore: credenziali GitHub non trovate in st.secrets['github'].")
-    except Exception as e:
-        report["errors"].append(f"❌ Errore imprevisto durante il ripristino: {e}")
-
+                report["warnings"].append(f"⚠️ {db_file} non trovato nel repo GitHub.")
+    save_backup_state(state)
     return report
 
 
@@ -170,6 +643,139 @@ def get_backup_timestamp():
             except Exception:
                 return None
     return None
+
+
+# --- BACKUP AUTOMATICO IN BACKGROUND ---
+
+@st.cache_resource
+def _backup_scheduler():
+    """
+    Stato del backup automatico, unico per processo: lock che impedisce due backup contemporanei
+    (automatico e manuale), lock (breve) per l'avvio del thread dello scheduler, thread e stato
+    dell'ultimo backup per la sidebar.
+    """
+    return {
+        "run_lock": threading.Lock(),
+        "start_lock": threading.Lock(),
+        "thread": None,
+        "status": {"ultimo_successo": None, "origine": None, "durata": None, "bytes_inviati": 0,
+                   "errore": None, "riprova_dopo": None},
+    }
+
+
+def run_backup(scheduler, versions, settings, origin):
+    """
+    Esegue backup_databases se nessun altro backup è in corso (altrimenti ritorna None subito),
+    aggiorna lo stato per la sidebar e, se non ci sono errori, l'orario dell'ultimo backup e il
+    conteggio delle scritture salvate. Usabile dai thread: riceve i registri, non usa Streamlit.
+    """
+    if not scheduler["run_lock"].acquire(blocking=False):
+        return None
+    try:
+        with versions["lock"]:
+            writes_at_start = versions["writes"]
+        started = time.monotonic()
+        reports = backup_databases(settings)
+        duration = time.monotonic() - started
+        errors = [report["messaggio"] for report in reports if report["esito"] == "errore"]
+        status = scheduler["status"]
+        if errors:
+            status.update(errore="; ".join(errors), riprova_dopo=time.monotonic() + BACKUP_AUTO_RETRY_SECONDS)
+            # backup che continuano a fallire non devono far crescere il journal senza limite
+            try:
+                # mode=rw: non crea un database vuoto se il file non c'è
+                conn = sqlite3.connect(f"file:{DB_FILE}?mode=rw", uri=True, timeout=30)
+                try:
+                    with conn:
+                        cap_journal(conn)
+                finally:
+                    conn.close()
+            except sqlite3.OperationalError:
+                pass
+            return reports
+        save_backup_timestamp()
+        status.update(
+            ultimo_successo=datetime.datetime.now(), origine=origin, durata=duration,
+            bytes_inviati=sum(report["bytes_inviati"] for report in reports), errore=None, riprova_dopo=None,
+        )
+        with versions["lock"]:
+            versions["saved_writes"] = max(versions["saved_writes"], writes_at_start)
+            if versions["writes"] == versions["saved_writes"]:
+                versions["first_unsaved"] = None
+            elif versions["first_unsaved"] is not None:
+                versions["first_unsaved"] = max(versions["first_unsaved"], started)
+        return reports
+    finally:
+        scheduler["run_lock"].release()
+
+
+def backup_due(versions, settings, now):
+    """True se ci sono scritture non salvate e sono passati il periodo di quiete o il ritardo massimo."""
+    with versions["lock"]:
+        if versions["writes"] == versions["saved_writes"] or versions["first_unsaved"] is None:
+            return False
+        return (now - versions["last_write"] >= settings["quiet_seconds"]
+                or now - versions["first_unsaved"] >= settings["max_delay_seconds"])
+
+
+def _backup_scheduler_loop(scheduler, versions, settings):
+    while True:
+        time.sleep(BACKUP_AUTO_POLL_SECONDS)
+        now = time.monotonic()
+        retry_after = scheduler["status"]["riprova_dopo"]
+        if (retry_after is None or now >= retry_after) and backup_due(versions, settings, now):
+            try:
+                run_backup(scheduler, versions, settings, "automatico")
+            except Exception as e:
+                scheduler["status"].update(errore=str(e), riprova_dopo=time.monotonic() + BACKUP_AUTO_RETRY_SECONDS)
+
+
+def ensure_backup_scheduler():
+    """
+    Avvia (una volta per processo) il thread del backup automatico: le scritture segnalate da
+    bump_data_version vengono salvate su GitHub dopo un periodo senza modifiche o al più tardi
+    dopo il ritardo massimo. Non fa nulla senza credenziali o con auto_backup = false.
+    """
+    try:
+        settings = github_settings()
+    except (KeyError, FileNotFoundError):
+        return None
+    if not settings["auto_backup"]:
+        return None
+    scheduler = _backup_scheduler()
+    # non run_lock: è tenuto per tutto il caricamento e bloccherebbe ogni rerun durante un backup
+    with scheduler["start_lock"]:
+        if scheduler["thread"] is None or not scheduler["thread"].is_alive():
+            scheduler["thread"] = threading.Thread(
+                target=_backup_scheduler_loop, args=(scheduler, _data_versions(), settings),
+                name="backup-scheduler", daemon=True,
+            )
+            scheduler["thread"].start()
+    return scheduler
+
+
+def show_backup_status():
+    """Stato del backup automatico nella sidebar."""
+    scheduler = _backup_scheduler()
+    status, versions = scheduler["status"], _data_versions()
+    if scheduler["thread"] is None:
+        st.sidebar.caption("Backup automatico non attivo (credenziali assenti o disattivato).")
+        return
+    if status["ultimo_successo"]:
+        st.sidebar.caption(
+            f"✅ Ultimo backup ({status['origine']}) alle {status['ultimo_successo']:%H:%M:%S}: "
+            f"{status['durata']:.1f} s, {status['bytes_inviati'] / 1024:.1f} KB inviati."
+        )
+    if status["errore"]:
+        st.sidebar.caption(f"❌ Ultimo backup non riuscito: {status['errore'][:200]}")
+    with versions["lock"]:
+        unsaved = versions["writes"] - versions["saved_writes"]
+    if unsaved > 0:
+        st.sidebar.caption(f"⏳ {unsaved} modifiche in attesa del backup automatico.")
+    else:
+        st.sidebar.caption("Backup automatico attivo: nessuna modifica in attesa.")
+
+
 # VERIFICA SE CI SONO LE CREDENZIALI E SE IL REPO è VISTO CORRETTAMENTE SU GITHUB
 def test_github_connection():
     try:
@@ -197,47 +803,37 @@ def test_github_connection():
 
 
 def test_github_db_files():
-    github_token = st.secrets["github"]["token"]
-    repo_name = st.secrets["github"]["repo"]
-    branch_name = st.secrets["github"]["branch"]
-
+    """Verifica che il backup di ogni database sia presente su GitHub (manifest, blocchi e segmenti del journal)."""
     try:
-        g = Github(github_token)
-        repo = g.get_repo(repo_name)
-        st.info(f"✅ Connessione a GitHub OK. Repo '{repo_name}' trovata.")
-
-        # Verifica branch
-        branch = repo.get_branch(branch_name)
-        st.info(f"✅ Branch '{branch_name}' trovato nel repo.")
-
-        # Controlla file login_log.db
-        try:
-            login_log_file = repo.get_contents("login_log.db", ref=branch_name)
-            st.success(f"✅ File 'login_log.db' trovato su GitHub (sha: {login_log_file.sha})")
-        except Exception as e:
-            st.warning(f"⚠️ File 'login_log.db' non trovato su GitHub: {e}")
-
-        # Controlla file manutenzioni.db
-        try:
-            manut_file = repo.get_contents("manutenzioni.db", ref=branch_name)
-            st.success(f"✅ File 'manutenzioni.db' trovato su GitHub (sha: {manut_file.sha})")
-        except Exception as e:
-            st.warning(f"⚠️ File 'manutenzioni.db' non trovato su GitHub: {e}")
+        settings = github_settings()
+    except (KeyError, FileNotFoundError):
+        st.error("❌ Errore: credenziali GitHub non trovate in st.secrets['github'].")
+        return
 
+    try:
+        with github_session(settings) as session:
+            head = github_head_commit(settings, session)
+            st.info(f"✅ Connessione a GitHub OK. Branch '{settings['branch']}' del repo '{settings['repo']}' al commit {head[:7]}.")
+            for db_file in BACKUP_DB_FILES:
+                manifest_path = backup_paths(db_file)[0]
+                content = download_github_file(settings, session, manifest_path, head)
+                if content is None:
+                    st.warning(f"⚠️ Backup di '{db_file}' non trovato su GitHub ({manifest_path}).")
+                    continue
+                manifest = json.loads(content)
+                st.success(
+                    f"✅ Backup di '{db_file}' trovato su GitHub: snapshot del {manifest['creato_il']} "
+                    f"({manifest['bytes'] / 1e6:.2f} MB in {len(manifest['chunks'])} blocchi), "
+                    f"{len(manifest['journal'])} segmenti del journal."
+                )
     except Exception as e:
         st.error(f"❌ Errore connessione GitHub: {e}")
 
 
 # FUNZIONE INIZIALIZZAZIONE LOGIN
 
-def init_login_log():
-    """
-    Crea il database login_log.db e la tabella login_log
-    se non esistono ancora.
-    """
-    conn = sqlite3.connect("login_log.db")  # file nella cartella principale
-    cursor = conn.cursor()
-    cursor.execute("""
+def _login_migration_001_tabella(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS login_log (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT NOT NULL,
@@ -248,8 +844,35 @@ def init_login_log():
             success INTEGER NOT NULL
         )
     """)
-    conn.commit()
-    conn.close()
+
+
+def _login_migration_002_colonna_ip(conn):
+    # usata da log_login_attempt()
+    add_column_if_missing(conn, "login_log", "ip", "TEXT")
+
+
+def _login_migration_003_indici(conn):
+    create_managed_indexes(conn, LOGIN_DB_FILE)
+
+
+# Migrazioni numerate di login_log.db (la versione applicata è in PRAGMA user_version)
+LOGIN_LOG_MIGRATIONS = [
+    (1, "Tabella login_log", _login_migration_001_tabella),
+    (2, "Colonna ip in login_log", _login_migration_002_colonna_ip),
+    (3, "Indice su login_time", _login_migration_003_indici),
+]
+
+
+def init_login_log():
+    """
+    Crea/aggiorna lo schema di login_log.db applicando le migrazioni mancanti.
+    Ritorna la lista delle versioni applicate.
+    """
+    conn = get_connection(LOGIN_DB_FILE)  # file nella cartella principale
+    try:
+        return apply_migrations(conn, LOGIN_LOG_MIGRATIONS)
+    finally:
+        conn.close()
 
 
 #FUNZIONE DIALOG PER POPUP LOGOUT
@@ -288,7 +911,7 @@ def perform_logout():
         duration_min = (logout_time - session_start).total_seconds() / 60.0
         
         # 🔹 Aggiorna l'ultimo log di login
-        conn = sqlite3.connect("login_log.db")
+        conn = get_connection(LOGIN_DB_FILE)
         cursor = conn.cursor()
         cursor.execute("""
             SELECT id FROM login_log 
@@ -304,7 +927,8 @@ def perform_logout():
                 WHERE id = ?
             """, (logout_time.isoformat(), duration_min, last_id))
             conn.commit()
-            conn.close()
+            bump_data_version("login_log")
+        conn.close()
     
     # Resetta lo stato della sessione, inclusa la nostra nuova variabile
       # Resetta lo stato della sessione, inclusa la nostra nuova variabile
@@ -326,7 +950,7 @@ def perform_logout():
 # 2️⃣ Log dei tentativi di login
 # --------------------------
 def log_login_attempt(username, success, ip=None):
-    conn = sqlite3.connect("login_log.db")
+    conn = get_connection(LOGIN_DB_FILE)
     cursor = conn.cursor()
     cursor.execute(
         "INSERT INTO login_log (username, login_time, success, ip) VALUES (?, ?, ?, ?)",
@@ -334,6 +958,7 @@ def log_login_attempt(username, success, ip=None):
     )
     conn.commit()
     conn.close()
+    bump_data_version("login_log")
 
 # --------------------------
 # 3️⃣ Funzione di login principale
@@ -361,7 +986,7 @@ def check_login(username, password):
         st.session_state["login_start_time"] = datetime.datetime.now()
 
         # 🔹 Log login riuscito
-        conn = sqlite3.connect("login_log.db")
+        conn = get_connection(LOGIN_DB_FILE)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO login_log (username, role, login_time, success)
@@ -369,11 +994,12 @@ def check_login(username, password):
         """, (username, role, st.session_state["login_start_time"].isoformat(), 1))
         conn.commit()
         conn.close()
+        bump_data_version("login_log")
         
         return True
     else:
         # 🔹 Log tentativo fallito
-        conn = sqlite3.connect("login_log.db")
+        conn = get_connection(LOGIN_DB_FILE)
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO login_log (username, role, login_time, success)
@@ -381,6 +1007,7 @@ def check_login(username, password):
         """, (username, None, datetime.datetime.now().isoformat(), 0))
         conn.commit()
         conn.close()
+        bump_data_version("login_log")
         
         return False
 
@@ -391,7 +1018,7 @@ def check_login(username, password):
 def show_login_history():
     st.header("📜 Storico Accessi Utenti")
 
-    conn = sqlite3.connect("login_log.db")
+    conn = get_connection(LOGIN_DB_FILE, readonly=True)
     df = pd.read_sql_query("SELECT * FROM login_log ORDER BY login_time DESC", conn)
     conn.close()
 
@@ -431,10 +1058,11 @@ def show_login_history():
         st.markdown("---")
         if st.button("🧹 Svuota completamente il log accessi", type="secondary"):
             with st.spinner("Pulizia in corso..."):
-                conn = sqlite3.connect("login_log.db")
+                conn = get_connection(LOGIN_DB_FILE)
                 conn.execute("DELETE FROM login_log")
                 conn.commit()
                 conn.close()
+                bump_data_version("login_log")
                 st.success("✅ Log accessi completamente svuotato!")
                 st.rerun()
 
@@ -454,17 +1082,207 @@ COMUNI_COLUMNS = [
 
 # --- FUNZIONI HELPER (MODEL) ---
 
-def get_connection():
-    """Ottiene una connessione al database."""
-    return sqlite3.connect(DB_FILE)
+# --- GESTIONE CONNESSIONI SQLITE (POOL) ---
 
-def init_db():
-    """Inizializza il database e crea le tabelle se non esistono."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # --- TABELLA MANUTENZIONI (rimane uguale) ---
-    cursor.execute('''
+# PRAGMA applicati ad ogni nuova connessione (journal_mode=WAL è persistente nel file)
+SQLITE_PRAGMAS = {
+    "busy_timeout": 5000,        # ms di attesa sui lock prima di "database is locked"
+    "synchronous": "NORMAL",     # sicuro in modalità WAL, molto meno fsync
+    "cache_size": -32000,        # ~32 MB di page cache per connessione
+    "mmap_size": 268435456,      # 256 MB di I/O mappato in memoria
+    "temp_store": "MEMORY",
+}
+POOL_MAX_IDLE_CONNECTIONS = 8
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connessione sqlite3 che, al close(), torna nel pool invece di chiudersi davvero."""
+
+    pool = None
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def close_for_real(self):
+        super().close()
+
+
+class SQLiteConnectionPool:
+    """
+    Pool di connessioni a lunga durata verso un file SQLite, condiviso da tutte le sessioni.
+    Le connessioni in sola lettura hanno PRAGMA query_only attivo.
+    """
+
+    def __init__(self, db_file, readonly=False, max_idle=POOL_MAX_IDLE_CONNECTIONS):
+        self.db_file = db_file
+        self.readonly = readonly
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_file, timeout=SQLITE_PRAGMAS["busy_timeout"] / 1000,
+                               check_same_thread=False, factory=PooledConnection)
+        if not self.readonly:
+            conn.execute("PRAGMA journal_mode=WAL")
+        for pragma, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        if self.readonly:
+            conn.execute("PRAGMA query_only=ON")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._open()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.Error:
+            conn.close_for_real()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close_for_real()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close_for_real()
+
+
+@st.cache_resource
+def _connection_pools():
+    """Registro dei pool per (file, sola lettura), unico per processo."""
+    return {"lock": threading.Lock(), "pools": {}}
+
+
+def get_connection(db_file=DB_FILE, readonly=False):
+    """
+    Ottiene una connessione al database dal pool condiviso.
+    Usare readonly=True per i percorsi di sola lettura; conn.close() restituisce la connessione al pool.
+    """
+    return _connection_from(_connection_pools(), db_file, readonly)
+
+
+def _connection_from(registry, db_file, readonly):
+    """Come get_connection ma con il registro dei pool esplicito (per i thread in background)."""
+    key = (os.path.abspath(db_file), readonly)
+    with registry["lock"]:
+        pool = registry["pools"].get(key)
+        if pool is None:
+            pool = registry["pools"][key] = SQLiteConnectionPool(db_file, readonly=readonly)
+    return pool.acquire()
+
+
+def close_all_connections():
+    """Chiude tutte le connessioni inattive dei pool (es. prima di sostituire un file .db)."""
+    registry = _connection_pools()
+    with registry["lock"]:
+        pools = list(registry["pools"].values())
+    for pool in pools:
+        pool.close_all()
+
+
+@contextlib.contextmanager
+def write_transaction(conn):
+    """Transazione esplicita BEGIN IMMEDIATE: commit all'uscita, rollback in caso di errore."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+# --- INDICI SECONDARI GESTITI ---
+
+# (database, nome indice, tabella, colonne, univoco) per le colonne usate in WHERE/filtri
+MANAGED_INDEXES = [
+    (DB_FILE, "idx_programmazione_work_order_id", "programmazione", "work_order_id", False),
+    (DB_FILE, "uq_storico_prog_wo_pv", "storico_prog", "work_order_id, punto_vendita", True),
+    (DB_FILE, "idx_storico_prog_wo_number", "storico_prog", "work_order_number", False),
+    (DB_FILE, "idx_manutenzioni_punto_vendita", "manutenzioni", "punto_vendita", False),
+    (DB_FILE, "idx_manutenzioni_brand", "manutenzioni", "brand", False),
+    (DB_FILE, "idx_manutenzioni_citta", "manutenzioni", "citta", False),
+    (DB_FILE, "idx_manutenzioni_prossimo_intervento", "manutenzioni", "prossimo_intervento", False),
+    (LOGIN_DB_FILE, "idx_login_log_login_time", "login_log", "login_time", False),
+]
+
+
+def create_managed_indexes(conn, db_file, include_unique=True):
+    """Crea (se mancanti) gli indici gestiti che appartengono al database indicato."""
+    for index_db, index_name, table, columns, unique in MANAGED_INDEXES:
+        if index_db == db_file and (include_unique or not unique):
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            conn.execute(f"CREATE {kind} IF NOT EXISTS {index_name} ON {table} ({columns})")
+
+
+def find_missing_indexes():
+    """Ritorna la lista (database, nome, tabella, colonne) degli indici gestiti non presenti."""
+    missing = []
+    for db_file in (DB_FILE, LOGIN_DB_FILE):
+        conn = get_connection(db_file, readonly=True)
+        try:
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        finally:
+            conn.close()
+        missing.extend(entry for entry in MANAGED_INDEXES if entry[0] == db_file and entry[1] not in existing)
+    return missing
+
+
+# --- MIGRAZIONI DELLO SCHEMA (PRAGMA user_version) ---
+
+def add_column_if_missing(conn, table, column, column_type):
+    """Aggiunge una colonna solo se la tabella non la possiede già."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in existing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def apply_migrations(conn, migrations):
+    """
+    Applica, in ordine, le migrazioni (versione, descrizione, funzione) con versione
+    maggiore di PRAGMA user_version. Ogni migrazione gira in una transazione IMMEDIATE
+    insieme all'aggiornamento di user_version. Ritorna le versioni applicate.
+    """
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    applied = []
+    for version, description, migrate in migrations:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Un altro processo potrebbe averla già applicata nel frattempo
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            migrate(conn)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise RuntimeError(f"Migrazione {version} ({description}) fallita: {e}") from e
+        applied.append(version)
+    return applied
+
+
+def _migration_001_tabelle_base(conn):
+    # --- TABELLA MANUTENZIONI ---
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS manutenzioni (
             ID INTEGER PRIMARY KEY AUTOINCREMENT,
             punto_vendita TEXT NOT NULL,
@@ -480,14 +1298,12 @@ def init_db():
             lat REAL,
             lon REAL,
             codice TEXT,
-            brand TEXT,
-            referente_pv TEXT,  
-            telefono TEXT        
+            brand TEXT
         )
     ''')
 
-    # --- TABELLA COMUNI (rimane uguale) ---
-    cursor.execute('''
+    # --- TABELLA COMUNI ---
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS comuni (
             comune TEXT PRIMARY KEY,
             codice TEXT,
@@ -501,17 +1317,16 @@ def init_db():
         )
     ''')
 
-    # --- TABELLA FORMAT (rimane uguale) ---
-    cursor.execute('''
+    # --- TABELLA FORMAT ---
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS format (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             brand TEXT UNIQUE NOT NULL
         )
     ''')
-    
-    
-    # --- TABELLA PROGRAMMAZIONE (VERSIONE CON AGGIORNAMENTO) ---
-    cursor.execute('''
+
+    # --- TABELLA PROGRAMMAZIONE ---
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS programmazione (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             work_order_id TEXT NOT NULL,
@@ -523,15 +1338,12 @@ def init_db():
             provincia TEXT,
             tecnico_assegnato TEXT,
             data_programmata DATE,
-            distanza_totale REAL,
-            referente_pv TEXT,   
-            telefono TEXT, 
-            note TEXT,       
-            orario_previsto TIME   
+            distanza_totale REAL
         )
     ''')
-    # --- TABELLA STORICO PROGRAMMAZIONE (VERSIONE CON AGGIORNAMENTO) ---
-    cursor.execute('''
+
+    # --- TABELLA STORICO PROGRAMMAZIONE ---
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS storico_prog (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             work_order_id TEXT NOT NULL,
@@ -551,42 +1363,420 @@ def init_db():
             orario_previsto TIME
         )
     ''')
-    
-    try:
-        cursor.execute("ALTER TABLE manutenzioni ADD COLUMN referente_pv TEXT")
-    except sqlite3.OperationalError: pass
-    try:
-        cursor.execute("ALTER TABLE manutenzioni ADD COLUMN telefono TEXT")
-    except sqlite3.OperationalError: pass
+
+
+def _migration_002_colonne_aggiuntive(conn):
+    add_column_if_missing(conn, "manutenzioni", "referente_pv", "TEXT")
+    add_column_if_missing(conn, "manutenzioni", "telefono", "TEXT")
+    add_column_if_missing(conn, "programmazione", "work_order_number", "INTEGER")
+    add_column_if_missing(conn, "programmazione", "referente_pv", "TEXT")
+    add_column_if_missing(conn, "programmazione", "telefono", "TEXT")
+    add_column_if_missing(conn, "programmazione", "orario_previsto", "TIME")
+    add_column_if_missing(conn, "programmazione", "attrezzature", "TEXT")
+    add_column_if_missing(conn, "programmazione", "note", "TEXT")
+    # complete_work_order copia in storico_prog tutte le colonne di programmazione
+    add_column_if_missing(conn, "storico_prog", "work_order_number", "INTEGER")
+    add_column_if_missing(conn, "storico_prog", "referente_pv", "TEXT")
+    add_column_if_missing(conn, "storico_prog", "telefono", "TEXT")
+    add_column_if_missing(conn, "storico_prog", "orario_previsto", "TIME")
+    add_column_if_missing(conn, "storico_prog", "attrezzature", "TEXT")
+    add_column_if_missing(conn, "storico_prog", "note", "TEXT")
+
+
+def _migration_003_viste(conn):
+    conn.execute("CREATE VIEW IF NOT EXISTS storico_manutenzioni AS SELECT * FROM manutenzioni")
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS report_attivita AS
+        SELECT
+            work_order_id, work_order_number, created_at AS data_creazione_ordine,
+            punto_vendita, indirizzo, cap, citta, provincia, tecnico_assegnato,
+            data_programmata, referente_pv, telefono, orario_previsto, attrezzature, note,
+            distanza_totale, 'programmazione' AS provenienza
+        FROM programmazione
+        UNION ALL
+        SELECT
+            work_order_id, work_order_number, created_at AS data_creazione_ordine,
+            punto_vendita, indirizzo, cap, citta, provincia, tecnico_assegnato,
+            data_programmata, referente_pv, telefono, orario_previsto, attrezzature, note,
+            NULL AS distanza_totale, 'storico' AS provenienza
+        FROM storico_prog
+    """)
+
+
+def _migration_004_indici(conn):
+    # Gli indici UNIQUE richiedono la pulizia dei duplicati (migrazione 5)
+    create_managed_indexes(conn, DB_FILE, include_unique=False)
+
+
+def _migration_005_storico_univoco(conn):
+    # Tiene un solo record per coppia (work_order_id, punto_vendita), il primo inserito
+    conn.execute("""
+        DELETE FROM storico_prog
+        WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM storico_prog GROUP BY work_order_id, punto_vendita
+        )
+    """)
+    conn.execute("DROP INDEX IF EXISTS idx_storico_prog_wo_pv")
+    create_managed_indexes(conn, DB_FILE)
+
+
+def _migration_006_sequenze(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sequenze (
+            nome TEXT PRIMARY KEY,
+            valore INTEGER NOT NULL
+        )
+    """)
+    # Parte dal numero più alto già usato, sia negli ordini attivi sia nello storico
+    conn.execute("""
+        INSERT OR IGNORE INTO sequenze (nome, valore)
+        SELECT 'work_order_number', COALESCE(MAX(n), 0) FROM (
+            SELECT MAX(work_order_number) AS n FROM programmazione
+            UNION ALL
+            SELECT MAX(work_order_number) FROM storico_prog
+        )
+    """)
+
+
+def next_sequence_value(conn, name):
+    """
+    Incrementa e restituisce il contatore `name` della tabella sequenze.
+    Va chiamata dentro una transazione IMMEDIATE, che serializza gli scrittori.
+    """
+    conn.execute("INSERT OR IGNORE INTO sequenze (nome, valore) VALUES (?, 0)", (name,))
+    conn.execute("UPDATE sequenze SET valore = valore + 1 WHERE nome = ?", (name,))
+    return conn.execute("SELECT valore FROM sequenze WHERE nome = ?", (name,)).fetchone()[0]
+
+
+def _migration_007_indice_spaziale(conn):
+    for table in SPATIAL_INDEXES:
+        install_spatial_index(conn, table)
+
+
+def _migration_008_ordine_percorso(conn):
+    # posizione del PV nella sequenza di visita dell'ordine (1 = prima tappa)
+    add_column_if_missing(conn, "programmazione", "ordine_percorso", "INTEGER")
+    add_column_if_missing(conn, "storico_prog", "ordine_percorso", "INTEGER")
+
+
+def _migration_009_distanze(conn):
+    install_distance_cache(conn)
+
+
+def _migration_010_geocode_cache(conn):
+    # una riga per testo di ricerca normalizzato; lat/lon NULL = nessun risultato (scade dopo un TTL)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            chiave TEXT PRIMARY KEY,
+            query TEXT NOT NULL,
+            lat REAL,
+            lon REAL,
+            livello TEXT,
+            provider TEXT NOT NULL,
+            aggiornato_il TEXT NOT NULL
+        )
+    """)
+
+
+def _migration_011_geocode_jobs(conn):
+    # stato job: in_coda | in_corso | annullato | completato
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stato TEXT NOT NULL,
+            totale INTEGER NOT NULL DEFAULT 0,
+            creato_da TEXT,
+            creato_il TEXT NOT NULL,
+            aggiornato_il TEXT
+        )
+    """)
+    # stato elemento: in_coda | ok | fallito; l'indirizzo è quello al momento della richiesta
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_job_items (
+            job_id INTEGER NOT NULL REFERENCES geocode_jobs(id) ON DELETE CASCADE,
+            pv_id INTEGER NOT NULL,
+            indirizzo TEXT,
+            cap TEXT,
+            citta TEXT,
+            provincia TEXT,
+            stato TEXT NOT NULL DEFAULT 'in_coda',
+            livello TEXT,
+            query TEXT,
+            errore TEXT,
+            aggiornato_il TEXT,
+            PRIMARY KEY (job_id, pv_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_job_items_stato ON geocode_job_items (job_id, stato)")
+
+
+def _migration_012_precisione_geo(conn):
+    # origine delle coordinate: livello della geocodifica online o centroide del comune (NULL = manuale/importata)
+    add_column_if_missing(conn, "manutenzioni", "precisione_geo", "TEXT")
+
+
+def _migration_013_journal(conn):
+    install_change_journal(conn)
+
+
+# Migrazioni numerate di manutenzioni.db: non modificare quelle esistenti, aggiungerne di nuove in coda
+MIGRATIONS = [
+    (1, "Tabelle di base", _migration_001_tabelle_base),
+    (2, "Colonne referente/telefono/orario/attrezzature/note", _migration_002_colonne_aggiuntive),
+    (3, "Viste storico_manutenzioni e report_attivita", _migration_003_viste),
+    (4, "Indici secondari sulle colonne di ricerca", _migration_004_indici),
+    (5, "Vincolo UNIQUE (work_order_id, punto_vendita) su storico_prog", _migration_005_storico_univoco),
+    (6, "Tabella sequenze per la numerazione degli ordini", _migration_006_sequenze),
+    (7, "Indice spaziale R*Tree su manutenzioni e comuni", _migration_007_indice_spaziale),
+    (8, "Colonna ordine_percorso negli ordini di lavoro", _migration_008_ordine_percorso),
+    (9, "Cache persistente delle distanze tra PV", _migration_009_distanze),
+    (10, "Cache persistente della geocodifica", _migration_010_geocode_cache),
+    (11, "Coda dei job di geocodifica", _migration_011_geocode_jobs),
+    (12, "Precisione delle coordinate dei PV", _migration_012_precisione_geo),
+    (13, "Journal delle modifiche per i backup incrementali", _migration_013_journal),
+]
+
+
+def init_db():
+    """
+    Inizializza il database applicando le migrazioni mancanti.
+    Ritorna la lista delle versioni applicate.
+    """
+    conn = get_connection()
     try:
-        cursor.execute("ALTER TABLE programmazione ADD COLUMN work_order_number INTEGER")
-    except sqlite3.OperationalError:pass
+        applied = apply_migrations(conn, MIGRATIONS)
+        # trigger del journal rigenerati a ogni avvio: seguono le colonne aggiunte dalle migrazioni;
+        # una pausa rimasta attiva da un'interruzione non ha più senso (lo snapshot completo è già richiesto).
+        # Senza backup automatico nessuno svuoterebbe il journal: resta in pausa finché non viene configurato
+        with write_transaction(conn):
+            install_change_journal(conn)
+            if change_journal_enabled():
+                conn.execute("UPDATE journal_control SET pausa = 0 WHERE id = 1")
+                cap_journal(conn)
+            else:
+                conn.execute("UPDATE journal_control SET pausa = 1, snapshot_richiesti = snapshot_richiesti + 1 WHERE id = 1")
+                conn.execute("DELETE FROM journal")
+        return applied
+    finally:
+        conn.close()
+
+
+@st.cache_resource
+def ensure_database_schema():
+    """Applica le migrazioni di entrambi i database una sola volta per processo."""
+    return {
+        DB_FILE: init_db(),
+        LOGIN_DB_FILE: init_login_log(),
+    }
+
+# --- JOURNAL DELLE MODIFICHE (BACKUP INCREMENTALI) ---
+
+JOURNAL_TABLES = ["manutenzioni", "programmazione", "storico_prog", "format", "comuni"]
+
+
+def install_change_journal(conn):
+    """
+    Crea la tabella journal (una riga per ogni riga inserita, modificata o eliminata nelle
+    JOURNAL_TABLES, con il contenuto come oggetto JSON) e ne rigenera i trigger dalle colonne
+    attuali delle tabelle. journal_control contiene il flag di pausa e il contatore delle
+    operazioni non registrate, che rendono necessario un nuovo snapshot completo.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tabella TEXT NOT NULL,
+            riga INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            dati TEXT,
+            ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal_control (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pausa INTEGER NOT NULL DEFAULT 0,
+            snapshot_richiesti INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO journal_control (id) VALUES (1)")
+    active = "(SELECT pausa FROM journal_control WHERE id = 1) = 0"
+    for table in JOURNAL_TABLES:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        for op in ("insert", "update", "delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_journal_{table}_{op}")
+        if not columns:
+            continue
+        # JSON non ammette BLOB: vengono registrati come {"$hex": ...} (vedi replay_journal)
+        payload = "json_object(" + ", ".join(
+            f"'{col}', CASE typeof(NEW.\"{col}\") WHEN 'blob' THEN json_object('$hex', hex(NEW.\"{col}\")) ELSE NEW.\"{col}\" END"
+            for col in columns
+        ) + ")"
+        log = lambda op: f"INSERT INTO journal (tabella, riga, op, dati) VALUES ('{table}', NEW.rowid, '{op}', {payload});"
+        conn.execute(f"""
+            CREATE TRIGGER trg_journal_{table}_insert AFTER INSERT ON {table} WHEN {active} BEGIN
+                {log('I')}
+            END
+        """)
+        # un UPDATE che cambia il rowid equivale a eliminare la riga vecchia
+        conn.execute(f"""
+            CREATE TRIGGER trg_journal_{table}_update AFTER UPDATE ON {table} WHEN {active} BEGIN
+                INSERT INTO journal (tabella, riga, op) SELECT '{table}', OLD.rowid, 'D' WHERE OLD.rowid <> NEW.rowid;
+                {log('U')}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER trg_journal_{table}_delete AFTER DELETE ON {table} WHEN {active} BEGIN
+                INSERT INTO journal (tabella, riga, op) VALUES ('{table}', OLD.rowid, 'D');
+            END
+        """)
+
+
+def change_journal_enabled():
+    """Il journal serve solo ai backup incrementali: attivo se il backup automatico su GitHub è configurato."""
     try:
-        cursor.execute("ALTER TABLE programmazione ADD COLUMN referente_pv TEXT")
-    except sqlite3.OperationalError: pass
+        return github_settings()["auto_backup"]
+    except (KeyError, FileNotFoundError):
+        return False
+
+
+def cap_journal(conn, max_rows=JOURNAL_MAX_ROWS):
+    """
+    Svuota il journal se supera max_rows righe (backup che non riescono da tempo) e richiede uno
+    snapshot completo al prossimo backup. Ritorna True se lo ha svuotato.
+    """
+    if conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0] <= max_rows:
+        return False
+    conn.execute("DELETE FROM journal")
+    conn.execute("UPDATE journal_control SET snapshot_richiesti = snapshot_richiesti + 1 WHERE id = 1")
+    return True
+
+
+@contextlib.contextmanager
+def journal_paused(conn):
+    """
+    Sospende il journal per operazioni massive (import, ricostruzioni che rinumerano le righe),
+    da usare nella stessa transazione: le modifiche non vengono registrate e il prossimo backup
+    sarà uno snapshot completo. All'uscita rigenera i trigger (le tabelle potrebbero essere state
+    ricreate) e ripristina la pausa precedente (il journal è sempre in pausa senza backup automatico).
+    """
+    paused = conn.execute("SELECT pausa FROM journal_control WHERE id = 1").fetchone()[0]
+    conn.execute("UPDATE journal_control SET pausa = 1, snapshot_richiesti = snapshot_richiesti + 1 WHERE id = 1")
     try:
-        cursor.execute("ALTER TABLE programmazione ADD COLUMN telefono TEXT")
-    except sqlite3.OperationalError: pass
+        yield conn
+    finally:
+        conn.execute("UPDATE journal_control SET pausa = ? WHERE id = 1", (paused,))
+        install_change_journal(conn)
+
+
+def journal_position(db_path):
+    """
+    (ultimo seq del journal, snapshot richiesti) di un file di database, None se non ha il journal
+    o se è in pausa (backup automatico non configurato): in quel caso i backup sono solo completi.
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
     try:
-        cursor.execute("ALTER TABLE programmazione ADD COLUMN orario_previsto TIME")
-    except sqlite3.OperationalError: pass
-    
+        requested, paused = conn.execute("SELECT snapshot_richiesti, pausa FROM journal_control WHERE id = 1").fetchone()
+        if paused:
+            return None
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM journal").fetchone()[0], requested
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def read_journal(db_path, after_seq):
+    """Righe del journal successive a after_seq, come liste [seq, tabella, riga, op, dati, ts]."""
+    conn = sqlite3.connect(db_path, timeout=30)
     try:
-        cursor.execute("CREATE VIEW IF NOT EXISTS storico_manutenzioni AS SELECT * FROM manutenzioni")
-    except sqlite3.OperationalError: pass
-    
-    conn.commit()
-    conn.close()
+        return [list(row) for row in conn.execute(
+            "SELECT seq, tabella, riga, op, dati, ts FROM journal WHERE seq > ? ORDER BY seq", (after_seq,)
+        )]
+    finally:
+        conn.close()
+
+
+def prune_journal(db_path, upto_seq):
+    """Elimina le righe del journal già comprese in uno snapshot completo caricato."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            conn.execute("DELETE FROM journal WHERE seq <= ?", (upto_seq,))
+    finally:
+        conn.close()
+
+
+def replay_journal(conn, rows):
+    """
+    Riapplica righe del journal (vedi read_journal) a un database ripristinato, con il journal
+    in pausa: inserimenti e modifiche come INSERT OR REPLACE sullo stesso rowid, eliminazioni per rowid.
+    """
+    conn.execute("UPDATE journal_control SET pausa = 1 WHERE id = 1")
+    for _, table, rowid, op, data, _ in rows:
+        if op == "D":
+            conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+            continue
+        values = {
+            col: bytes.fromhex(value["$hex"]) if isinstance(value, dict) else value
+            for col, value in json.loads(data).items()
+        }
+        columns = ", ".join(f'"{col}"' for col in values)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} (rowid, {columns}) VALUES (?, {', '.join('?' * len(values))})",
+            (rowid, *values.values()),
+        )
+    conn.execute("UPDATE journal_control SET pausa = 0 WHERE id = 1")
+
+
+# --- CACHE DI LETTURA CON VERSIONE DELLE TABELLE ---
+
+@st.cache_resource
+def _data_versions():
+    """
+    Registro condiviso da tutte le sessioni del processo con un contatore per tabella.
+    Ogni scrittura incrementa il contatore e invalida così solo le letture di quella tabella;
+    conta anche le scritture non ancora salvate dal backup (vedi backup automatico).
+    """
+    return {"lock": threading.Lock(), "versions": {}, "writes": 0, "saved_writes": 0,
+            "last_write": None, "first_unsaved": None}
+
+
+def get_data_version(table_name):
+    """Restituisce il token di versione corrente di una tabella."""
+    registry = _data_versions()
+    with registry["lock"]:
+        return registry["versions"].get(table_name, 0)
+
+
+def bump_data_version(*table_names):
+    """Segnala che le tabelle indicate sono state modificate (da chiamare dopo ogni commit)."""
+    _bump_versions(_data_versions(), *table_names)
+
+
+def _bump_versions(registry, *table_names):
+    """Come bump_data_version ma con il registro esplicito (per i thread in background)."""
+    with registry["lock"]:
+        for table_name in table_names:
+            registry["versions"][table_name] = registry["versions"].get(table_name, 0) + 1
+        now = time.monotonic()
+        registry["writes"] += 1
+        registry["last_write"] = now
+        if registry["first_unsaved"] is None:
+            registry["first_unsaved"] = now
+
 
 def load_data(table_name="manutenzioni"):
-    """Carica i dati da una tabella specifica in un DataFrame di pandas."""
-    conn = get_connection()
+    """Carica i dati da una tabella specifica in un DataFrame di pandas (con cache condivisa)."""
+    return _load_data_cached(table_name, get_data_version(table_name))
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_data_cached(table_name, data_version):
+    """Lettura effettiva dal DB: `data_version` fa parte della chiave di cache."""
+    conn = get_connection(readonly=True)
     try:
         if table_name == "manutenzioni":
-            df = pd.read_sql_query(f"SELECT * FROM {table_name} ORDER BY ID DESC", conn)
-            if not df.empty:
-                df['ultimo_intervento'] = pd.to_datetime(df['ultimo_intervento'], errors='coerce').dt.date
-                df['prossimo_intervento'] = pd.to_datetime(df['prossimo_intervento'], errors='coerce').dt.date
+            df = coerce_manutenzioni_dates(pd.read_sql_query(f"SELECT * FROM {table_name} ORDER BY ID DESC", conn))
         elif table_name == "comuni":
             df = pd.read_sql_query(f"SELECT * FROM {table_name} ORDER BY comune ASC", conn)
         elif table_name == "format":
@@ -595,8 +1785,354 @@ def load_data(table_name="manutenzioni"):
     finally:
         conn.close()
 
-import streamlit as st
-import pandas as pd
+
+def coerce_manutenzioni_dates(df):
+    """Converte le colonne data di 'manutenzioni' in oggetti date (come si aspetta l'editor)."""
+    if not df.empty:
+        df['ultimo_intervento'] = pd.to_datetime(df['ultimo_intervento'], errors='coerce').dt.date
+        df['prossimo_intervento'] = pd.to_datetime(df['prossimo_intervento'], errors='coerce').dt.date
+    return df
+
+
+# --- STATO DELLA MANUTENZIONE (CLASSIFICAZIONE VETTORIALE) ---
+
+# (stato, colore, icona) in ordine di codice: 0 = data mancante, poi per mesi dall'ultimo intervento
+MAINTENANCE_STATUSES = [
+    ("Sconosciuto", "gray", "question"),
+    ("Scaduto (>12 mesi)", "darkred", "exclamation-circle"),
+    ("Attenzione (8-12 mesi)", "orange", "exclamation-circle"),
+    ("In Scadenza (4-8 mesi)", "blue", "info-circle"),
+    ("OK (<4 mesi)", "green", "check-circle"),
+]
+
+
+def classify_maintenance_status(last_service_dates, today=None):
+    """
+    Classifica lo stato di manutenzione a partire dalle date di ultimo intervento, in
+    un'unica operazione sugli array: mesi trascorsi = differenza anno*12 + mese.
+    Ritorna un DataFrame (stesso indice) con le colonne categoriche status/color/icon.
+    """
+    dates = pd.to_datetime(pd.Series(last_service_dates), errors='coerce')
+    today = today or datetime.date.today()
+    months = (today.year - dates.dt.year) * 12 + (today.month - dates.dt.month)
+    codes = np.select(
+        [dates.isna().to_numpy(), (months > 12).to_numpy(), (months > 8).to_numpy(), (months > 4).to_numpy()],
+        [0, 1, 2, 3],
+        default=4,
+    )
+    statuses, colors, icons = (np.array(values, dtype=object) for values in zip(*MAINTENANCE_STATUSES))
+    return pd.DataFrame({
+        'status': pd.Categorical.from_codes(codes, categories=statuses),
+        'color': pd.Categorical.from_codes(codes, categories=colors),
+        'icon': pd.Categorical(icons[codes], categories=pd.unique(icons)),
+    }, index=dates.index)
+
+
+# --- INDICE DEI COMUNI (RICERCA E DISAMBIGUAZIONE) ---
+
+COMUNI_TRIGRAM_MIN_SCORE = 0.25
+COMUNI_OFFLINE_FUZZY_MIN_SCORE = 0.5   # più severo della ricerca: qui l'abbinamento è automatico
+
+
+def normalize_place_name(name):
+    """Nome di località confrontabile: senza accenti, minuscolo, punteggiatura ridotta a spazi."""
+    if name is None or (isinstance(name, float) and np.isnan(name)):
+        return ""
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def _comuni_index(data_version):
+    """
+    Indice in memoria dei comuni, costruito una volta per versione della tabella.
+    Una voce per (comune, provincia) con tutti i CAP; gli omonimi in province diverse
+    hanno etichetta "Nome (PR)".
+    """
+    df = load_data("comuni")
+    df = df[df['comune'].notna()]
+    grouped = df.groupby(['comune', 'provincia'], sort=False, dropna=False)
+    first = grouped.first()
+    # CAP importati da Excel: numeri, testo o intervalli ("20121-20162"), normalizzati come quelli dei PV
+    caps = grouped['cap'].agg(lambda values: list(dict.fromkeys(cap for cap in map(_normalize_cap, values) if cap)))
+
+    entries = []
+    for ((comune, provincia), row), entry_caps in zip(first.iterrows(), caps):
+        entries.append({
+            "comune": comune,
+            "provincia": provincia if pd.notna(provincia) else "",
+            "regione": row['regione'] if pd.notna(row['regione']) else "",
+            "codice": row['codice'],
+            "cap": entry_caps[0] if entry_caps else "",
+            "caps": entry_caps,
+            "lat": float(row['lat']) if pd.notna(row['lat']) else None,
+            "lon": float(row['lon']) if pd.notna(row['lon']) else None,
+            "key": normalize_place_name(comune),
+        })
+
+    by_name = {}
+    for entry in entries:
+        by_name.setdefault(entry["key"], []).append(entry)
+    for homonyms in by_name.values():
+        for entry in homonyms:
+            entry["label"] = f"{entry['comune']} ({entry['provincia']})" if len(homonyms) > 1 else entry["comune"]
+
+    names = sorted(by_name)
+    tokens = sorted((token, name_id) for name_id, name in enumerate(names) for token in set(name.split()))
+    trigrams = {}
+    for name_id, name in enumerate(names):
+        for gram in _trigrams(name):
+            trigrams.setdefault(gram, []).append(name_id)
+    return {
+        "labels": sorted((entry["label"] for entry in entries), key=normalize_place_name),
+        "by_label": {entry["label"]: entry for entry in entries},
+        "by_name": by_name,
+        "names": names,
+        "tokens": tokens,
+        "trigrams": trigrams,
+        "trigram_counts": [len(_trigrams(name)) for name in names],
+        "frame": pd.DataFrame(entries, columns=["comune", "provincia", "caps", "lat", "lon", "key"]),
+    }
+
+
+def get_comuni_index():
+    """Indice dei comuni per la versione corrente della tabella (vedi _comuni_index)."""
+    return _comuni_index(get_data_version("comuni"))
+
+
+def comune_options():
+    """Etichette dei comuni per le selectbox, ordinate e senza duplicati (un comune, più CAP)."""
+    return get_comuni_index()["labels"]
+
+
+def find_comuni(name, provincia=None):
+    """
+    Comuni che corrispondono a `name`: un'etichetta della lista oppure un nome qualsiasi,
+    senza distinguere accenti e maiuscole. Se è indicata la provincia, fra gli omonimi
+    restano quelli di quella provincia (se nessuno corrisponde li ritorna tutti).
+    """
+    index = get_comuni_index()
+    if name in index["by_label"]:
+        return [index["by_label"][name]]
+    matches = index["by_name"].get(normalize_place_name(name), [])
+    if provincia and len(matches) > 1:
+        same_province = [e for e in matches if normalize_place_name(e["provincia"]) == normalize_place_name(provincia)]
+        if same_province:
+            return same_province
+    return matches
+
+
+def lookup_comune(name, provincia=None):
+    """Il comune (dict dell'indice) identificato da name/provincia, oppure None se assente o ambiguo."""
+    matches = find_comuni(name, provincia)
+    return matches[0] if len(matches) == 1 else None
+
+
+def search_comuni(query, limit=20):
+    """
+    Etichette dei comuni per una ricerca libera, senza distinguere accenti e maiuscole:
+    prima i nomi che iniziano con il testo, poi quelli con una parola che inizia con il testo,
+    infine i più simili per trigrammi (tollera errori di battitura).
+    """
+    q = normalize_place_name(query)
+    if not q:
+        return []
+    index = get_comuni_index()
+    names, found = index["names"], []
+
+    def collect(name_id):
+        if name_id not in found:
+            found.append(name_id)
+        return len(found) >= limit
+
+    pos = bisect.bisect_left(names, q)
+    while pos < len(names) and names[pos].startswith(q):
+        if collect(pos):
+            break
+        pos += 1
+    tokens = index["tokens"]
+    pos = bisect.bisect_left(tokens, (q, -1))
+    while len(found) < limit and pos < len(tokens) and tokens[pos][0].startswith(q):
+        if collect(tokens[pos][1]):
+            break
+        pos += 1
+    if len(found) < limit:
+        for score, name_id in _similar_comuni_names(index, q):
+            if score < COMUNI_TRIGRAM_MIN_SCORE or collect(name_id):
+                break
+    return [entry["label"] for name_id in found for entry in index["by_name"][names[name_id]]][:limit]
+
+
+def _similar_comuni_names(index, key):
+    """(somiglianza di Jaccard sui trigrammi, id del nome) per i nomi normalizzati simili a key, dal più simile."""
+    query_grams = _trigrams(key)
+    shared = Counter(name_id for gram in query_grams for name_id in index["trigrams"].get(gram, ()))
+    return sorted(
+        ((count / (len(query_grams) + index["trigram_counts"][name_id] - count), name_id)
+         for name_id, count in shared.items()),
+        reverse=True,
+    )
+
+
+def check_comuni(citta, provincia):
+    """
+    Verifica coppie città/provincia (es. righe di un import) sull'indice dei comuni.
+    Ritorna un DataFrame con le sole coppie problematiche: citta, provincia, righe, esito
+    ("non trovato", "ambiguo", "provincia diversa").
+    """
+    pairs = pd.DataFrame({'citta': citta, 'provincia': provincia}).fillna("")
+    counts = pairs.value_counts(sort=False).rename('righe').reset_index()
+    outcomes = []
+    for city, prov in zip(counts['citta'], counts['provincia']):
+        matches = find_comuni(city, prov)
+        if not matches:
+            outcomes.append("non trovato")
+        elif len(matches) > 1:
+            outcomes.append("ambiguo")
+        elif prov and normalize_place_name(matches[0]["provincia"]) != normalize_place_name(prov):
+            outcomes.append("provincia diversa")
+        else:
+            outcomes.append(None)
+    counts['esito'] = outcomes
+    return counts[counts['esito'].notna()].reset_index(drop=True)
+
+
+def _normalize_cap(value):
+    if pd.isna(value) or str(value).strip() == "":
+        return ""
+    text = str(value).strip()
+    return text[:-2].zfill(5) if text.endswith(".0") else text.zfill(5)
+
+
+def _pick_comune_candidates(candidates):
+    """
+    Fra le coppie (PV, comune) candidate sceglie per ogni PV il comune con la stessa provincia,
+    altrimenti con lo stesso CAP; un PV con provincia indicata non viene abbinato a un comune
+    che non ha né la sua provincia né il suo CAP, e i PV che restano ambigui (omonimi) vengono scartati.
+    """
+    if candidates.empty:
+        return candidates
+    same_province = (candidates['prov_key'] != "") & (candidates['prov_key'] == candidates['provincia_comune'].map(normalize_place_name))
+    same_cap = pd.Series(
+        [bool(cap) and cap in caps for cap, caps in zip(candidates['cap'], candidates['caps'])],
+        index=candidates.index,
+    )
+    rank = same_province.astype(int) * 2 + same_cap.astype(int)
+    best = candidates[(rank == rank.groupby(candidates['ID']).transform('max')) & ((rank > 0) | (candidates['prov_key'] == ""))]
+    return best[~best['ID'].duplicated(keep=False)]
+
+
+def resolve_comuni_offline(df_rows):
+    """
+    Coordinate del centroide del comune per i PV di df_rows (colonne ID, citta, provincia, cap),
+    senza chiamate di rete, con join vettoriali sulla tabella dei comuni a tre livelli:
+    esatto (nome e provincia identici), normalizzato (senza accenti e maiuscole; omonimi
+    distinti da provincia o CAP) e approssimato (nome più simile per trigrammi, se netto).
+    Ritorna ID, lat, lon, comune, provincia, metodo per i soli PV risolti.
+    """
+    index = get_comuni_index()
+    comuni = index["frame"].dropna(subset=['lat', 'lon']).rename(columns={'provincia': 'provincia_comune'})
+    pv = pd.DataFrame({
+        'ID': pd.to_numeric(df_rows['ID']).astype(int).to_numpy(),
+        'citta': df_rows['citta'].fillna("").astype(str).str.strip().to_numpy(),
+        'provincia': df_rows['provincia'].fillna("").astype(str).str.strip().to_numpy(),
+        'cap': df_rows['cap'].map(_normalize_cap).to_numpy() if 'cap' in df_rows else "",
+    }).drop_duplicates('ID')
+    pv['key'] = pv['citta'].map(normalize_place_name)
+    pv['prov_key'] = pv['provincia'].map(normalize_place_name)
+    pv = pv[pv['key'] != ""]
+    columns = ['ID', 'lat', 'lon', 'comune', 'provincia_comune', 'metodo']
+
+    exact = pv.merge(comuni, left_on=['citta', 'provincia'], right_on=['comune', 'provincia_comune'])
+    exact = exact[~exact['ID'].duplicated(keep=False)].assign(metodo="esatto")
+    pending = pv[~pv['ID'].isin(exact['ID'])]
+
+    normalized = _pick_comune_candidates(pending.merge(comuni, on='key')).assign(metodo="normalizzato")
+    pending = pending[~pending['ID'].isin(normalized['ID'])]
+
+    # per ogni nome non riconosciuto il nome più simile, solo se supera la soglia e non è a pari merito
+    fuzzy_keys = {}
+    for key in pending['key'].unique():
+        scored = _similar_comuni_names(index, key)
+        if scored and scored[0][0] >= COMUNI_OFFLINE_FUZZY_MIN_SCORE and (len(scored) == 1 or scored[1][0] < scored[0][0]):
+            fuzzy_keys[key] = index["names"][scored[0][1]]
+    pending = pending.assign(key=pending['key'].map(fuzzy_keys)).dropna(subset=['key'])
+    fuzzy = _pick_comune_candidates(pending.merge(comuni, on='key')).assign(metodo="approssimato")
+
+    resolved = pd.concat([exact[columns], normalized[columns], fuzzy[columns]], ignore_index=True)
+    return resolved.rename(columns={'provincia_comune': 'provincia'})
+
+
+# --- FILTRI E PAGINAZIONE LATO DATABASE (TABELLA PV) ---
+
+PV_FILTER_COLUMNS = ["brand", "citta", "provincia", "regione"]
+PV_SEARCH_COLUMNS = ["punto_vendita", "indirizzo", "citta", "codice", "referente_pv", "telefono"]
+PV_PAGE_SIZES = [25, 50, 100, 250, 500]
+
+
+def build_manutenzioni_where(filters):
+    """
+    Costruisce clausola WHERE e parametri dai filtri della tabella PV:
+    uguaglianza su brand/citta/provincia/regione ("Tutti" = nessun filtro) e
+    ricerca libera (LIKE, case-insensitive) sulle colonne testuali principali.
+    """
+    clauses, params = [], []
+    for col in PV_FILTER_COLUMNS:
+        value = filters.get(col)
+        if value and value != "Tutti":
+            clauses.append(f"{col} = ?")
+            params.append(value)
+    search = (filters.get("search") or "").strip()
+    if search:
+        clauses.append("(" + " OR ".join(f"{col} LIKE ?" for col in PV_SEARCH_COLUMNS) + ")")
+        params.extend([f"%{search}%"] * len(PV_SEARCH_COLUMNS))
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    return where, params
+
+
+def load_manutenzioni_page(filters, page=1, page_size=50):
+    """
+    Restituisce (DataFrame della pagina, numero totale di righe filtrate).
+    Con page_size=None restituisce tutte le righe filtrate (es. per l'export).
+    """
+    filters_key = tuple(sorted((k, v) for k, v in filters.items() if v))
+    return _load_manutenzioni_page_cached(filters_key, page, page_size, get_data_version("manutenzioni"))
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _load_manutenzioni_page_cached(filters_key, page, page_size, data_version):
+    where, params = build_manutenzioni_where(dict(filters_key))
+    conn = get_connection(readonly=True)
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM manutenzioni {where}", params).fetchone()[0]
+        query = f"SELECT * FROM manutenzioni {where} ORDER BY ID DESC"
+        if page_size:
+            query += " LIMIT ? OFFSET ?"
+            params = params + [page_size, (max(page, 1) - 1) * page_size]
+        df = coerce_manutenzioni_dates(pd.read_sql_query(query, conn, params=params))
+        return df, total
+    finally:
+        conn.close()
+
+
+@st.cache_data(show_spinner=False)
+def load_manutenzioni_filter_options(data_version):
+    """Valori distinti di citta/provincia/regione per i filtri (chiave di cache: versione della tabella)."""
+    conn = get_connection(readonly=True)
+    try:
+        return {
+            col: [row[0] for row in conn.execute(
+                f"SELECT DISTINCT {col} FROM manutenzioni WHERE {col} IS NOT NULL AND {col} != '' ORDER BY {col}"
+            )]
+            for col in ("citta", "provincia", "regione")
+        }
+    finally:
+        conn.close()
 
 def show_pending_notice():
     """
@@ -604,7 +2140,7 @@ def show_pending_notice():
     Quando cliccato, porta automaticamente alla pagina '📋 Ordini Attivi'.
     """
     try:
-        conn = get_connection()
+        conn = get_connection(readonly=True)
         df_prog = pd.read_sql_query("SELECT COUNT(*) AS count FROM programmazione", conn)
         conn.close()
 
@@ -653,66 +2189,65 @@ def show_pending_notice():
         st.sidebar.error(f"Errore nel controllo ordini pendenti: {e}")
 
 
+def dataframe_to_sql_params(df, columns):
+    """Converte le colonne indicate in tuple di valori Python nativi (NaN/NaT -> None) per executemany."""
+    values = df[columns].astype(object)
+    values = values.where(df[columns].notna(), None)
+    return list(values.itertuples(index=False, name=None))
+
+
 def save_manutenzione(edited_df, original_df):
     """
     Confronta il DataFrame modificato con quello originale e aggiorna il database.
-    Usa iterrows() per maggiore robustezza e per evitare problemi di tipo.
+    Le differenze sono calcolate per colonna (confronto vettoriale con NaN == NaN) e
+    applicate con executemany in un'unica transazione: cancellazioni, inserimenti e
+    un UPDATE per ogni combinazione di colonne modificate.
     """
     conn = get_connection()
-    cursor = conn.cursor()
     
     try:
-        # --- 1. CANCELLAZIONE: Trova e rimuovi le righe eliminate dall'editor ---
-        deleted_ids = set(original_df['ID']) - set(edited_df['ID'])
-        for id_to_delete in deleted_ids:
-            cursor.execute("DELETE FROM manutenzioni WHERE ID = ?", (id_to_delete,))
-
-        # --- 2. INSERIMENTO: Trova e aggiungi le nuove righe ---
-        new_rows = edited_df[edited_df['ID'].isnull()]
-        if not new_rows.empty:
-            for index, row in new_rows.iterrows():
-                # Rimuove la colonna ID per l'inserimento
-                row_to_insert = row.drop('ID')
-                cursor.execute(f'''
+        with write_transaction(conn):
+            # --- 1. CANCELLAZIONE: Trova e rimuovi le righe eliminate dall'editor ---
+            deleted_ids = set(original_df['ID'].dropna().astype(int)) - set(edited_df['ID'].dropna().astype(int))
+            if deleted_ids:
+                conn.executemany("DELETE FROM manutenzioni WHERE ID = ?", [(i,) for i in sorted(deleted_ids)])
+
+            # --- 2. INSERIMENTO: Trova e aggiungi le nuove righe ---
+            new_rows = edited_df[edited_df['ID'].isnull()]
+            if not new_rows.empty:
+                conn.executemany(f'''
                     INSERT INTO manutenzioni ({", ".join(MANUTENZIONI_COLUMNS)})
                     VALUES ({", ".join(["?"]*len(MANUTENZIONI_COLUMNS))})
-                ''', tuple(row_to_insert))
-
-        # --- 3. AGGIORNAMENTO: Trova e aggiorna le righe modificate ---
-        # Confronta i DataFrame uniti per trovare le differenze
-        merged_df = pd.merge(edited_df, original_df, on='ID', suffixes=('_new', '_old'))
-        updated_rows = merged_df[merged_df['ID'].notnull()]
-        
-        if not updated_rows.empty:
-            # --- CORREZIONE CHIAVE: Usa un ciclo standard e più sicuro ---
-            for index, row in updated_rows.iterrows():
-                update_columns = []
-                update_values = []
-                
-                # Itera su tutte le colonne dati per trovare i cambiamenti
-                for col in MANUTENZIONI_COLUMNS:
-                    # Confronta il valore nuovo con quello vecchio, gestendo i NaN
-                    val_new = row[f'{col}_new']
-                    val_old = row[f'{col}_old']
-                    if pd.isna(val_new) and pd.isna(val_old):
-                        continue # Se entrambi sono NaN, non c'è cambiamento
-                    if val_new != val_old:
-                        update_columns.append(f"{col} = ?")
-                        update_values.append(val_new)
-                
-                # Se ci sono colonne da aggiornare, esegui la query
-                if update_columns:
-                    set_clause = ", ".join(update_columns)
-                    update_values.append(row['ID'])
-                    query = f"UPDATE manutenzioni SET {set_clause} WHERE ID = ?"
-                    cursor.execute(query, update_values)
+                ''', dataframe_to_sql_params(new_rows, MANUTENZIONI_COLUMNS))
+
+            # --- 3. AGGIORNAMENTO: maschera vettoriale delle celle cambiate ---
+            old = original_df.dropna(subset=['ID']).set_index('ID')[MANUTENZIONI_COLUMNS]
+            new = edited_df.dropna(subset=['ID']).set_index('ID')[MANUTENZIONI_COLUMNS]
+            old.index = old.index.astype(int)
+            new.index = new.index.astype(int)
+            common_ids = new.index.intersection(old.index)
+            old, new = old.loc[common_ids], new.loc[common_ids]
+
+            changed = new.ne(old) & ~(new.isna() & old.isna())
+            changed = changed[changed.any(axis=1)]
+
+            # Un executemany per ogni insieme di colonne modificate (di solito uno solo)
+            for pattern, ids in changed.groupby(MANUTENZIONI_COLUMNS).groups.items():
+                update_columns = [col for col, is_changed in zip(MANUTENZIONI_COLUMNS, pattern) if is_changed]
+                set_clause = ", ".join(f"{col} = ?" for col in update_columns)
+                if {'lat', 'lon'} & set(update_columns):
+                    set_clause += ", precisione_geo = NULL"  # coordinate inserite a mano
+                rows = new.loc[ids, update_columns].assign(ID=ids)
+                conn.executemany(
+                    f"UPDATE manutenzioni SET {set_clause} WHERE ID = ?",
+                    dataframe_to_sql_params(rows, update_columns + ['ID'])
+                )
 
-        conn.commit()
+        bump_data_version("manutenzioni")
         st.success("Modifiche salvate con successo!")
         return True
 
     except Exception as e:
-        conn.rollback()
         st.error(f"Errore durante il salvataggio: {e}")
         return False
     finally:
@@ -758,12 +2293,37 @@ def show_gestione_manutenzioni():
     tab1, tab2 = st.tabs(["📊 Tabella PV ", "➕ Aggiungi Punto Vendita "])
     
     with tab1:
-        selected_brand_filter = st.selectbox("Filtra per Brand/Formato: (es. CONDAD, CARREFOUR IPER; CARREFOUR MARKET)", options=["Tutti"] + brand_list)
-        
-        
-        df_manutenzioni = load_data("manutenzioni")
-        if selected_brand_filter != "Tutti":
-            df_manutenzioni = df_manutenzioni[df_manutenzioni['brand'] == selected_brand_filter]
+        filter_options = load_manutenzioni_filter_options(get_data_version("manutenzioni"))
+        col_brand, col_citta, col_prov, col_reg = st.columns(4)
+        selected_brand_filter = col_brand.selectbox("Filtra per Brand/Formato: (es. CONDAD, CARREFOUR IPER; CARREFOUR MARKET)", options=["Tutti"] + brand_list)
+        selected_citta_filter = col_citta.selectbox("Città", options=["Tutti"] + filter_options["citta"])
+        selected_prov_filter = col_prov.selectbox("Provincia", options=["Tutti"] + filter_options["provincia"])
+        selected_reg_filter = col_reg.selectbox("Regione", options=["Tutti"] + filter_options["regione"])
+        col_search, col_size = st.columns([3, 1])
+        search_text = col_search.text_input("🔍 Cerca (punto vendita, indirizzo, città, codice, referente, telefono)")
+        page_size = col_size.selectbox("Righe per pagina", PV_PAGE_SIZES, index=1)
+
+        pv_filters = {
+            "brand": selected_brand_filter,
+            "citta": selected_citta_filter,
+            "provincia": selected_prov_filter,
+            "regione": selected_reg_filter,
+            "search": search_text,
+        }
+        # Torna alla prima pagina quando cambiano i filtri o la dimensione pagina
+        filters_signature = (tuple(pv_filters.values()), page_size)
+        if st.session_state.get("pv_filters_signature") != filters_signature:
+            st.session_state["pv_filters_signature"] = filters_signature
+            st.session_state["pv_page"] = 1
+
+        _, total_rows = load_manutenzioni_page(pv_filters, 1, page_size)
+        total_pages = max(1, -(-total_rows // page_size))
+        if st.session_state.get("pv_page", 1) > total_pages:
+            st.session_state["pv_page"] = total_pages
+        current_page = st.number_input("Pagina", min_value=1, max_value=total_pages, step=1, key="pv_page")
+        st.caption(f"Pagina {current_page} di {total_pages} — {total_rows} punti vendita trovati")
+
+        df_manutenzioni, _ = load_manutenzioni_page(pv_filters, current_page, page_size)
         df_to_show = df_manutenzioni.copy()
         df_to_show.insert(0, "Seleziona", False)
          
@@ -781,6 +2341,7 @@ def show_gestione_manutenzioni():
                 "prossimo_intervento": st.column_config.DateColumn("Prossimo Intervento"),
                 "lat": st.column_config.NumberColumn("Latitudine", format="%.6f"),
                 "lon": st.column_config.NumberColumn("Longitudine", format="%.6f"),
+                "precisione_geo": st.column_config.TextColumn("Precisione coordinate", disabled=True),
                 "referente_pv": st.column_config.TextColumn("Referente PV"),
                 "telefono": st.column_config.TextColumn("Telefono"),
             },
@@ -801,6 +2362,7 @@ def show_gestione_manutenzioni():
                         query = f"DELETE FROM manutenzioni WHERE ID IN ({placeholders})"
                         cursor.execute(query, ids_to_delete)
                         conn.commit()
+                        bump_data_version("manutenzioni")
                         st.success(f"{len(ids_to_delete)} record cancellati con successo!")
                         st.rerun()
                     except Exception as e:
@@ -820,7 +2382,12 @@ def show_gestione_manutenzioni():
         # Pulsante per scaricare Excel
         if st.button("📥 Scarica Excel tabella PV"):
             output = io.BytesIO()
-            df_to_export = df_manutenzioni.copy()
+            # Esporta tutte le righe che rispettano i filtri, non solo la pagina corrente
+            df_to_export, _ = load_manutenzioni_page(pv_filters, page_size=None)
+            df_to_export.insert(
+                df_to_export.columns.get_loc('ultimo_intervento') + 1, 'stato_manutenzione',
+                classify_maintenance_status(df_to_export['ultimo_intervento'])['status'].astype(str),
+            )
             with pd.ExcelWriter(output, engine='openpyxl') as writer:
                 df_to_export.to_excel(writer, index=False, sheet_name='Manutenzioni')
             st.download_button(
@@ -832,9 +2399,12 @@ def show_gestione_manutenzioni():
     with tab2:
         st.subheader("Inserisci un nuovo punto vendita")
     
-        # --- Caricamento comuni ---
-        df_comuni = load_data("comuni")
-        comuni_list = df_comuni['comune'].tolist()
+        # --- Ricerca comuni (indice in memoria, senza accenti/maiuscole) ---
+        comune_query = st.text_input("🔎 Cerca comune", key="comune_search_form",
+                                     help="Filtra l'elenco anche ignorando accenti, maiuscole e piccoli errori di battitura.")
+        comuni_list = search_comuni(comune_query, limit=50) if comune_query else comune_options()
+        if st.session_state.get("citta_select_reactive") and st.session_state.citta_select_reactive not in comuni_list:
+            comuni_list = [st.session_state.citta_select_reactive] + comuni_list
     
         selected_comune = st.selectbox(
             "Seleziona Città *", 
@@ -856,17 +2426,16 @@ def show_gestione_manutenzioni():
                 st.session_state[f"{field}_form"] = default
     
         # --- Aggiorna dati auto se selezionato un comune ---
-        if selected_comune:
-            city_data = df_comuni[df_comuni['comune'] == selected_comune]
-            if not city_data.empty:
-                st.session_state.codice_form = city_data['codice'].iloc[0]
-                st.session_state.provincia_form = city_data['provincia'].iloc[0]
-                st.session_state.regione_form = city_data['regione'].iloc[0]
-                st.session_state.lat_form = float(city_data['lat'].iloc[0])
-                st.session_state.lon_form = float(city_data['lon'].iloc[0])
-                if not st.session_state.cap_form or st.session_state.cap_form == st.session_state.get("last_auto_cap", ""):
-                    st.session_state.cap_form = str(city_data['cap'].iloc[0])
-                    st.session_state.last_auto_cap = st.session_state.cap_form
+        selected_city_data = lookup_comune(selected_comune) if selected_comune else None
+        if selected_city_data:
+            st.session_state.codice_form = selected_city_data['codice']
+            st.session_state.provincia_form = selected_city_data['provincia']
+            st.session_state.regione_form = selected_city_data['regione']
+            st.session_state.lat_form = float(selected_city_data['lat'] or 0.0)
+            st.session_state.lon_form = float(selected_city_data['lon'] or 0.0)
+            if not st.session_state.cap_form or st.session_state.cap_form == st.session_state.get("last_auto_cap", ""):
+                st.session_state.cap_form = selected_city_data['cap']
+                st.session_state.last_auto_cap = st.session_state.cap_form
     
         # =======================================================
         # 📍 DATI AUTO-COMPILATI
@@ -958,7 +2527,8 @@ def show_gestione_manutenzioni():
                             VALUES ({", ".join(["?"]*len(MANUTENZIONI_COLUMNS))})
                         ''', (
                             punto_vendita, indirizzo, st.session_state.cap_form,
-                            selected_comune, st.session_state.provincia_form,
+                            selected_city_data['comune'] if selected_city_data else selected_comune,
+                            st.session_state.provincia_form,
                             st.session_state.regione_form, ultimo_intervento,
                             prossimo_intervento, attrezzature, note,
                             st.session_state.lat_form, st.session_state.lon_form,
@@ -966,6 +2536,7 @@ def show_gestione_manutenzioni():
                             referente_pv, telefono
                         ))
                         conn.commit()
+                        bump_data_version("manutenzioni")
                         st.success("✅ Nuova attività aggiunta con successo!")
                         st.toast("Attività inserita!", icon="✅")
                         st.session_state.reset_form_flag = True
@@ -999,56 +2570,62 @@ def reset_form_fields():
                         
 ## FUNZIONE PROGRAMMAZIONE PER PAGINA PROGRAMMAZIONE
 
+PROGRAMMAZIONE_INSERT_COLUMNS = [
+    "work_order_id", "work_order_number", "punto_vendita", "indirizzo", "cap", "citta", "provincia",
+    "tecnico_assegnato", "data_programmata", "distanza_totale", "referente_pv", "telefono",
+    "attrezzature", "note", "orario_previsto", "ordine_percorso"
+]
+
+
 def save_programmazione_to_db(df, total_distance):
-    """Salva un nuovo ordine di lavoro con tutti i campi, gestendo correttamente date e orari."""
+    """
+    Salva un nuovo ordine di lavoro con tutti i campi, gestendo correttamente date e orari.
+    Il numero d'ordine è allocato dalla tabella sequenze nella stessa transazione IMMEDIATE
+    dell'inserimento (niente numeri doppi con più pianificatori) e le righe sono inserite
+    con un solo executemany. L'ordine delle righe di `df` è salvato come ordine_percorso.
+    """
     try:
         work_order_id = str(uuid.uuid4())
-        conn = get_connection() 
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT MAX(work_order_number) FROM programmazione")
-        result = cursor.fetchone()
-        next_number = 1 if result[0] is None else result[0] + 1
-        
         df_to_save = df.copy()
+        empty = pd.Series(None, index=df_to_save.index, dtype=object)
+
+        # --- NORMALIZZAZIONE VETTORIALE DI DATE E ORARI ---
+        lines = pd.DataFrame({
+            "punto_vendita": df_to_save["punto_vendita"],
+            "indirizzo": df_to_save["indirizzo"],
+            "cap": df_to_save.get("cap", empty.fillna("")),
+            "citta": df_to_save["citta"],
+            "provincia": df_to_save.get("provincia", empty.fillna("")),
+            "tecnico_assegnato": df_to_save["tecnico_assegnato"],
+            "data_programmata": normalize_date_series(df_to_save["data_programmata"]),
+            "referente_pv": df_to_save.get("referente_pv", empty),
+            "telefono": df_to_save.get("telefono", empty),
+            "attrezzature": df_to_save.get("attrezzature", empty),
+            "note": df_to_save.get("note", empty),
+            "orario_previsto": normalize_time_series(df_to_save.get("orario_previsto", empty)),
+            # le righe arrivano già nella sequenza di visita
+            "ordine_percorso": np.arange(1, len(df_to_save) + 1),
+        })
 
-        for index, row in df_to_save.iterrows():
-            # --- GESTIONE DELLA DATA ---
-            date_value = row['data_programmata']
-            date_to_save = date_value.date() if pd.notna(date_value) and isinstance(date_value, pd.Timestamp) else None
-            
-            # --- GESTIONE DELL'ORARIO (LA CORREZIONE FINALE) ---
-            # 1. Normalizza il valore (restituisce un oggetto datetime.time)
-            time_obj = normalize_time(row.get('orario_previsto'))
-            # 2. Converti l'oggetto datetime.time in una stringa formattata per il DB
-            time_to_save = time_obj.strftime('%H:%M:%S') if time_obj is not None else None
-
-            cursor.execute("""
-                INSERT INTO programmazione (work_order_id, work_order_number, punto_vendita, indirizzo, cap, citta, provincia, tecnico_assegnato, data_programmata, distanza_totale, referente_pv, telefono, attrezzature, note, orario_previsto)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                work_order_id,
-                next_number,
-                row['punto_vendita'],
-                row['indirizzo'],
-                row.get('cap', ''),
-                row['citta'],
-                row.get('provincia', ''),
-                row['tecnico_assegnato'],
-                date_to_save,
-                total_distance,
-                row.get('referente_pv'),
-                row.get('telefono'),
-                row.get('attrezzature'),
-                row.get('note'),
-                time_to_save
-                
-            ))
-        conn.commit()
-        conn.close()
+        conn = get_connection()
+        try:
+            with write_transaction(conn):
+                next_number = next_sequence_value(conn, "work_order_number")
+                lines = lines.assign(
+                    work_order_id=work_order_id,
+                    work_order_number=next_number,
+                    distanza_totale=total_distance,
+                )
+                conn.executemany(f"""
+                    INSERT INTO programmazione ({", ".join(PROGRAMMAZIONE_INSERT_COLUMNS)})
+                    VALUES ({", ".join(["?"] * len(PROGRAMMAZIONE_INSERT_COLUMNS))})
+                """, dataframe_to_sql_params(lines, PROGRAMMAZIONE_INSERT_COLUMNS))
+        finally:
+            conn.close()
+        bump_data_version("programmazione")
          # --- GESTIONE DEL MESSAGIO DI SUCCESSO PERSISTENTE ---
         st.session_state['last_save_success'] = {
-            'message': f"Ordine '{df_to_save.iloc[0]['punto_vendita']}' salvato con successo!",
+            'message': f"Ordine {next_number} '{df_to_save.iloc[0]['punto_vendita']}' salvato con successo!",
             'timestamp': datetime.datetime.now()
         }
         st.success("Ordine di lavoro creato con successo!")
@@ -1058,17 +2635,620 @@ def save_programmazione_to_db(df, total_distance):
         st.error(f"Errore durante il salvataggio nel database: {e}")
         return False
     
+# --- MOTORE DISTANZE VETTORIALE (HAVERSINE) ---
+
+EARTH_RADIUS_KM = 6371.0088
+# Scarto massimo tra haversine (sfera) e geodetica WGS84: circa 0,5%
+HAVERSINE_MAX_REL_ERROR = 0.006
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Distanza haversine in km tra coppie di punti; accetta scalari o array NumPy (con broadcast)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distances_from_point(center, lats, lons, radius_km=None):
+    """
+    Distanze in km da `center` (lat, lon) a tutti i punti, calcolate su array.
+    Se è indicato radius_km, solo i punti a cavallo del bordo del raggio (dove l'errore
+    di haversine potrebbe cambiare l'esito del filtro) vengono ricalcolati con geodesic.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    distances = haversine_km(center[0], center[1], lats, lons)
+    if radius_km is not None and distances.size:
+        near_border = np.abs(distances - radius_km) <= radius_km * HAVERSINE_MAX_REL_ERROR
+        for i in np.flatnonzero(near_border):
+            distances[i] = geodesic(center, (lats[i], lons[i])).km
+    return distances
+
+
+def route_leg_distances_km(lats, lons):
+    """Distanze in km delle tratte tra punti consecutivi di un percorso."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    return haversine_km(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+
 def calculate_total_route_distance(df):
     """Calcola la distanza totale del percorso sommando le distanze tra punti consecutivi."""
     if len(df) < 2:
         return 0.0
-    total_distance = 0.0
     # Assumiamo che l'ordine nel DataFrame sia l'ordine del percorso
-    for i in range(len(df) - 1):
-        point1 = (df.iloc[i]['lat'], df.iloc[i]['lon'])
-        point2 = (df.iloc[i+1]['lat'], df.iloc[i+1]['lon'])
-        total_distance += geodesic(point1, point2).km
-    return total_distance
+    return float(route_leg_distances_km(df['lat'].to_numpy(), df['lon'].to_numpy()).sum())
+
+
+# --- INDICE SPAZIALE (SQLite R*Tree) ---
+
+# tabella -> (tabella R*Tree, colonna chiave = rowid della tabella)
+SPATIAL_INDEXES = {
+    "manutenzioni": ("manutenzioni_rtree", "ID"),
+    "comuni": ("comuni_rtree", "rowid"),
+}
+# Raggio oltre il quale la ricerca dei più vicini rinuncia al prefiltro (copre tutta l'Italia)
+SPATIAL_MAX_SEARCH_KM = 1500
+
+
+def install_spatial_index(conn, table):
+    """
+    Crea (o ricrea) l'R*Tree di `table` con i trigger che lo tengono allineato a
+    INSERT/UPDATE di lat, lon/DELETE, e lo ripopola dai dati attuali.
+    Va richiamata anche dopo aver ricreato la tabella (es. import comuni con 'replace').
+    Se SQLite non ha il modulo rtree non fa nulla: le query usano il fallback su lat/lon.
+    """
+    rtree, key = SPATIAL_INDEXES[table]
+    try:
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError:
+        return False
+    new_row = f"""
+        INSERT OR REPLACE INTO {rtree} (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT NEW.{key}, NEW.lat, NEW.lat, NEW.lon, NEW.lon
+        WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+    """
+    conn.execute(f"DROP TRIGGER IF EXISTS trg_{rtree}_insert")
+    conn.execute(f"DROP TRIGGER IF EXISTS trg_{rtree}_update")
+    conn.execute(f"DROP TRIGGER IF EXISTS trg_{rtree}_delete")
+    conn.execute(f"CREATE TRIGGER trg_{rtree}_insert AFTER INSERT ON {table} BEGIN {new_row} END")
+    conn.execute(f"""
+        CREATE TRIGGER trg_{rtree}_update AFTER UPDATE OF lat, lon ON {table} BEGIN
+            DELETE FROM {rtree} WHERE id = OLD.{key};
+            {new_row}
+        END
+    """)
+    conn.execute(f"CREATE TRIGGER trg_{rtree}_delete AFTER DELETE ON {table} BEGIN DELETE FROM {rtree} WHERE id = OLD.{key}; END")
+    conn.execute(f"DELETE FROM {rtree}")
+    conn.execute(f"""
+        INSERT INTO {rtree} (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT {key}, lat, lat, lon, lon FROM {table} WHERE lat IS NOT NULL AND lon IS NOT NULL
+    """)
+    return True
+
+
+def install_distance_cache(conn, clear=False):
+    """
+    Crea la tabella distanze (una riga per coppia di PV, con pv_id_a < pv_id_b) e i trigger
+    che scartano le coppie di un PV quando ne cambiano lat/lon o viene eliminato: valgono per
+    ogni percorso di scrittura (modifica tabella, geocodifica, import Excel).
+    Con clear=True svuota la cache (es. dopo una ricostruzione che rinumera gli ID).
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS distanze (
+            pv_id_a INTEGER NOT NULL,
+            pv_id_b INTEGER NOT NULL,
+            km REAL NOT NULL,
+            minuti REAL,
+            PRIMARY KEY (pv_id_a, pv_id_b),
+            CHECK (pv_id_a < pv_id_b)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_distanze_pv_b ON distanze (pv_id_b)")
+    forget_pv = "DELETE FROM distanze WHERE pv_id_a = OLD.ID OR pv_id_b = OLD.ID;"
+    conn.execute("DROP TRIGGER IF EXISTS trg_distanze_update")
+    conn.execute("DROP TRIGGER IF EXISTS trg_distanze_delete")
+    conn.execute(f"""
+        CREATE TRIGGER trg_distanze_update AFTER UPDATE OF lat, lon ON manutenzioni
+        WHEN OLD.lat IS NOT NEW.lat OR OLD.lon IS NOT NEW.lon
+        BEGIN {forget_pv} END
+    """)
+    conn.execute(f"CREATE TRIGGER trg_distanze_delete AFTER DELETE ON manutenzioni BEGIN {forget_pv} END")
+    if clear:
+        conn.execute("DELETE FROM distanze")
+
+
+def pv_distance_matrix_km(pv_ids, lats, lons):
+    """
+    Matrice NxN delle distanze (km) tra i PV indicati. Le coppie già note sono lette dalla
+    tabella distanze; quelle mancanti sono calcolate con haversine e salvate per le volte
+    successive. La scrittura è un di più: se il database è occupato non attende il lock
+    (busy_timeout 0) e i valori sono solo restituiti, con l'errore nel log.
+    """
+    ids = np.asarray(pv_ids, dtype=np.int64)
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    n = len(ids)
+    dist = np.full((n, n), np.nan)
+    np.fill_diagonal(dist, 0.0)
+    if n < 2:
+        return dist
+
+    position = {int(pv_id): i for i, pv_id in enumerate(ids)}
+    placeholders = ",".join("?" * n)
+    conn = get_connection(readonly=True)
+    try:
+        cached = conn.execute(
+            f"SELECT pv_id_a, pv_id_b, km FROM distanze "
+            f"WHERE pv_id_a IN ({placeholders}) AND pv_id_b IN ({placeholders})",
+            ids.tolist() * 2,
+        ).fetchall()
+    finally:
+        conn.close()
+    if cached:
+        ia = np.array([position[a] for a, _, _ in cached])
+        ib = np.array([position[b] for _, b, _ in cached])
+        km = np.array([k for _, _, k in cached], dtype=float)
+        dist[ia, ib] = km
+        dist[ib, ia] = km
+
+    iu, ju = np.triu_indices(n, k=1)
+    missing = np.isnan(dist[iu, ju])
+    if missing.any():
+        mi, mj = iu[missing], ju[missing]
+        km = haversine_km(lats[mi], lons[mi], lats[mj], lons[mj])
+        dist[mi, mj] = km
+        dist[mj, mi] = km
+        pairs = zip(np.minimum(ids[mi], ids[mj]).tolist(), np.maximum(ids[mi], ids[mj]).tolist(), km.tolist())
+        conn = get_connection()
+        try:
+            conn.execute("PRAGMA busy_timeout = 0")
+            with write_transaction(conn):
+                conn.executemany("INSERT OR IGNORE INTO distanze (pv_id_a, pv_id_b, km) VALUES (?, ?, ?)", pairs)
+        except sqlite3.Error as e:
+            logger.info("Cache distanze non aggiornata (%d coppie): %s", int(missing.sum()), e)
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {SQLITE_PRAGMAS['busy_timeout']}")
+            conn.close()
+    return dist
+
+
+def bbox_around(lat, lon, radius_km):
+    """Riquadro (min_lat, max_lat, min_lon, max_lon) che contiene il cerchio di raggio radius_km."""
+    # margine per la differenza sfera/ellissoide
+    dlat = np.degrees(radius_km * (1 + HAVERSINE_MAX_REL_ERROR) / EARTH_RADIUS_KM)
+    dlon = dlat / max(np.cos(np.radians(lat)), 0.01)
+    return (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+
+
+def ids_in_bbox(table, bbox):
+    """
+    Chiavi (ID per manutenzioni, rowid per comuni) dei record con coordinate nel riquadro.
+    Usa l'R*Tree se presente, altrimenti un filtro BETWEEN sulla tabella.
+    """
+    rtree, key = SPATIAL_INDEXES[table]
+    min_lat, max_lat, min_lon, max_lon = (float(v) for v in bbox)
+    conn = get_connection(readonly=True)
+    try:
+        has_rtree = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (rtree,)
+        ).fetchone() is not None
+        if has_rtree:
+            query = f"SELECT id FROM {rtree} WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?"
+        else:
+            query = f"SELECT {key} FROM {table} WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?"
+        params = (min_lat, max_lat, min_lon, max_lon)
+        return np.array([row[0] for row in conn.execute(query, params)], dtype=np.int64)
+    finally:
+        conn.close()
+
+
+def filter_within_radius(df_points, center, radius_km, table="manutenzioni", id_col="ID"):
+    """Punti di df_points entro radius_km da center, con colonna 'distance': prefiltro R*Tree + haversine."""
+    candidates = df_points[df_points[id_col].isin(ids_in_bbox(table, bbox_around(center[0], center[1], radius_km)))].copy()
+    candidates['distance'] = distances_from_point(center, candidates['lat'], candidates['lon'], radius_km=radius_km)
+    return candidates[candidates['distance'] <= radius_km]
+
+
+def filter_nearest(df_points, center, n_count, table="manutenzioni", id_col="ID"):
+    """
+    Gli n_count punti di df_points più vicini a center, con colonna 'distance'.
+    Il riquadro di ricerca raddoppia finché contiene n_count punti entro il suo raggio.
+    """
+    radius_km = 10.0
+    while radius_km < SPATIAL_MAX_SEARCH_KM:
+        candidates = filter_within_radius(df_points, center, radius_km, table, id_col)
+        if len(candidates) >= n_count:
+            return candidates.nsmallest(n_count, 'distance')
+        radius_km *= 2
+    candidates = df_points.copy()
+    candidates['distance'] = distances_from_point(center, candidates['lat'], candidates['lon'])
+    return candidates.nsmallest(n_count, 'distance')
+
+
+def comuni_near(lat, lon, max_km=30):
+    """Comuni con centroide entro max_km da (lat, lon), ordinati per distanza (colonna 'distance')."""
+    ids = ids_in_bbox("comuni", bbox_around(lat, lon, max_km))
+    conn = get_connection(readonly=True)
+    try:
+        placeholders = ",".join("?" * len(ids))
+        df = pd.read_sql_query(
+            f"SELECT * FROM comuni WHERE rowid IN ({placeholders})", conn, params=[int(i) for i in ids]
+        )
+    finally:
+        conn.close()
+    df['distance'] = distances_from_point((lat, lon), df['lat'], df['lon'])
+    return df[df['distance'] <= max_km].sort_values('distance')
+
+
+def nearest_comune(lat, lon, max_km=30):
+    """Comune (dict) con centroide più vicino a (lat, lon) entro max_km, oppure None."""
+    near = comuni_near(lat, lon, max_km)
+    return None if near.empty else near.iloc[0].to_dict()
+
+
+# --- OTTIMIZZAZIONE PERCORSO (NEAREST NEIGHBOUR + 2-OPT + OR-OPT) ---
+
+ROUTE_MAX_IMPROVEMENT_ROUNDS = 50
+
+
+def distance_matrix_km(lats, lons):
+    """Matrice NxN delle distanze haversine (km) tra tutti i punti."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    return haversine_km(lats[:, None], lons[:, None], lats[None, :], lons[None, :])
+
+
+def path_length_km(order, dist):
+    """Lunghezza del percorso aperto che visita i nodi nell'ordine dato."""
+    order = np.asarray(order)
+    return float(dist[order[:-1], order[1:]].sum()) if len(order) > 1 else 0.0
+
+
+def _nearest_neighbour_order(dist, start):
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        candidates = np.where(visited, np.inf, dist[order[-1]])
+        nxt = int(np.argmin(candidates))
+        order.append(nxt)
+        visited[nxt] = True
+    return np.array(order)
+
+
+def _two_opt(order, dist, fixed_start):
+    """
+    Migliora il percorso aperto invertendo tratti order[i..j] finché c'è guadagno.
+    Per ogni i tutti i j sono valutati in un'unica operazione su array.
+    """
+    order = order.copy()
+    n = len(order)
+    improved = False
+    for i in range(1 if fixed_start else 0, n - 1):
+        js = np.arange(i + 1, n)
+        has_next = js < n - 1
+        after_j = order[np.minimum(js + 1, n - 1)]
+        old = np.where(has_next, dist[order[js], after_j], 0.0)
+        new = np.where(has_next, dist[order[i], after_j], 0.0)
+        if i > 0:
+            old = old + dist[order[i - 1], order[i]]
+            new = new + dist[order[i - 1], order[js]]
+        k = int(np.argmin(new - old))
+        if new[k] - old[k] < -1e-9:
+            j = js[k]
+            order[i:j + 1] = order[i:j + 1][::-1]
+            improved = True
+    return order, improved
+
+
+def _or_opt(order, dist, fixed_start):
+    """Sposta segmenti di 1-3 tappe (anche invertiti) nella posizione in cui costano meno."""
+    order = order.copy()
+    n = len(order)
+    improved = False
+    for seg_len in (1, 2, 3):
+        i = 1 if fixed_start else 0
+        # il segmento deve lasciare almeno una tappa in cui essere reinserito
+        while i + seg_len < n:
+            seg = order[i:i + seg_len]
+            rest = np.concatenate([order[:i], order[i + seg_len:]])
+            m = len(rest)
+            prev_node = order[i - 1] if i > 0 else None
+            next_node = order[i + seg_len] if i + seg_len < n else None
+            removal_gain = 0.0
+            if prev_node is not None:
+                removal_gain += dist[prev_node, seg[0]]
+            if next_node is not None:
+                removal_gain += dist[seg[-1], next_node]
+            if prev_node is not None and next_node is not None:
+                removal_gain -= dist[prev_node, next_node]
+
+            # costo di inserimento tra rest[p-1] e rest[p], p = 0..m
+            positions = np.arange(1 if fixed_start else 0, m + 1)
+            left = rest[np.maximum(positions - 1, 0)]
+            right = rest[np.minimum(positions, m - 1)]
+            has_left = positions > 0
+            has_right = positions < m
+            bridge = np.where(has_left & has_right, dist[left, right], 0.0)
+            best = None
+            for oriented in (seg, seg[::-1]):
+                cost = (np.where(has_left, dist[left, oriented[0]], 0.0)
+                        + np.where(has_right, dist[oriented[-1], right], 0.0) - bridge)
+                k = int(np.argmin(cost))
+                if best is None or cost[k] < best[0]:
+                    best = (cost[k], positions[k], oriented)
+            if best[0] < removal_gain - 1e-9:
+                p, oriented = best[1], best[2]
+                order = np.concatenate([rest[:p], oriented, rest[p:]])
+                improved = True
+            else:
+                i += 1
+    return order, improved
+
+
+def optimize_route_order(dist, fixed_start=False):
+    """
+    Ordine di visita (indici) che riduce la lunghezza del percorso aperto sulla matrice `dist`:
+    seme nearest-neighbour (da ogni partenza se la prima tappa è libera) migliorato con
+    2-opt e Or-opt. Con fixed_start=True il nodo 0 (es. deposito) resta il primo.
+    """
+    n = len(dist)
+    if n < 3:
+        return np.arange(n)
+    starts = [0] if fixed_start else range(n)
+    order = min((_nearest_neighbour_order(dist, s) for s in starts), key=lambda o: path_length_km(o, dist))
+    for _ in range(ROUTE_MAX_IMPROVEMENT_ROUNDS):
+        order, improved_2opt = _two_opt(order, dist, fixed_start)
+        order, improved_oropt = _or_opt(order, dist, fixed_start)
+        if not (improved_2opt or improved_oropt):
+            break
+    return order
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _optimized_order_cached(dist, fixed_start):
+    return optimize_route_order(dist, fixed_start=fixed_start).tolist()
+
+
+def plan_route(df_stops, depot=None, optimize=True):
+    """
+    Pianifica la sequenza di visita dei PV selezionati (eventualmente partendo da un deposito).
+    Ritorna (df_stops riordinato, km nell'ordine originale, km nell'ordine pianificato);
+    i km includono la tratta dal deposito, se indicato.
+    Le distanze tra PV vengono dalla cache persistente (tabella distanze).
+    """
+    lats = df_stops['lat'].to_numpy(dtype=float)
+    lons = df_stops['lon'].to_numpy(dtype=float)
+    if 'ID' in df_stops.columns and df_stops['ID'].notna().all():
+        dist = pv_distance_matrix_km(df_stops['ID'], lats, lons)
+    else:
+        dist = distance_matrix_km(lats, lons)
+    if depot is not None:
+        from_depot = haversine_km(float(depot[0]), float(depot[1]), lats, lons)
+        dist = np.block([[np.zeros((1, 1)), from_depot[None, :]], [from_depot[:, None], dist]])
+
+    naive_order = np.arange(len(dist))
+    order = np.array(_optimized_order_cached(dist, depot is not None)) if optimize else naive_order
+    naive_km, route_km = path_length_km(naive_order, dist), path_length_km(order, dist)
+    if depot is not None:
+        order = order[1:] - 1
+    return df_stops.iloc[order], naive_km, route_km
+
+
+# --- RENDERING DEI MARKER SULLA MAPPA ---
+
+# oltre questa soglia i marker dei PV vengono raggruppati (clustering lato browser)
+MAP_CLUSTER_THRESHOLD = 300
+MAP_PIN_COLORS = {"darkred": "#8B0000", "orange": "#FF8C00", "blue": "#0066CC", "green": "#008000", "gray": "#808080", "black": "#333333"}
+MAP_POPUP_COLUMNS = ['punto_vendita', 'brand', 'indirizzo', 'citta', 'provincia', 'ultimo_intervento', 'status', 'referente_pv', 'telefono', 'note']
+
+# stile dei pin definito una volta nella pagina: ogni marker porta solo le classi CSS
+MAP_PIN_CSS = "<style>" + """
+.pv-pin { width: 36px; height: 36px; border-radius: 50% 50% 50% 0; transform: rotate(-45deg); display: flex; align-items: center; justify-content: center; border: 2px solid white; box-shadow: 0 2px 5px rgba(0,0,0,0.3); }
+.pv-pin i { color: white; transform: rotate(45deg); font-size: 18px; }
+""" + "".join(f".pv-pin-{name} {{ background-color: {hex_color}; }}\n" for name, hex_color in MAP_PIN_COLORS.items()) + "</style>"
+
+# callback dei PV: riga = [lat, lon, colore, icona, testo distanza, *MAP_POPUP_COLUMNS];
+# il popup viene costruito (con escape dei testi) solo quando l'utente lo apre
+MAP_PV_CALLBACK = """
+function (row) {
+    var esc = function (v) {
+        return String(v === null || v === undefined ? '' : v).replace(/[&<>"']/g, function (c) {
+            return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+        });
+    };
+    var icon = L.divIcon({
+        className: '',
+        html: '<div class="pv-pin pv-pin-' + row[2] + '"><i class="fa fa-' + row[3] + '"></i></div>',
+        iconSize: [36, 36], iconAnchor: [18, 36], popupAnchor: [0, -36]
+    });
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindTooltip(esc(row[5]));
+    marker.bindPopup(function () {
+        return (row[4] ? '<b>🚗 ' + esc(row[4]) + '</b><br>' : '')
+            + '<b>' + esc(row[5]) + '</b><br>Brand: ' + esc(row[6])
+            + '<br>Indirizzo: ' + esc(row[7]) + ', ' + esc(row[8]) + ' (' + esc(row[9]) + ')'
+            + '<br>Ultimo Intervento: ' + esc(row[10]) + '<br>Stato: ' + esc(row[11])
+            + '<br>👤 Referente: ' + esc(row[12]) + '<br>📞 Telefono: ' + esc(row[13])
+            + '<br>📝 Note: ' + esc(row[14]);
+    }, {maxWidth: 300});
+    return marker;
+}
+"""
+
+# callback delle aree aggregate: riga = [lat, lon, raggio, area, totale PV, scaduti]
+MAP_AREA_CALLBACK = """
+function (row) {
+    var area = String(row[3]).replace(/[&<>"']/g, function (c) {
+        return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+    });
+    return L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: row[2], color: '#0066CC', weight: 2, fill: true, fillColor: '#0066CC', fillOpacity: 0.35
+    }).bindTooltip(area + ': ' + row[4] + ' PV (' + row[5] + ' scaduti) - zooma per il dettaglio');
+}
+"""
+
+
+class ClientMarkerLayer(folium.MacroElement):
+    """
+    Punti disegnati dal browser: per ogni riga di `data` il `callback` JavaScript ritorna un
+    layer Leaflet che viene aggiunto al genitore. Lato Python si serializzano solo i dati,
+    non un oggetto folium (con il suo template) per ogni marker.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function () {
+                var callback = {{ this.callback }};
+                var data = {{ this.data|tojson }};
+                for (var i = 0; i < data.length; i++) {
+                    callback(data[i]).addTo({{ this._parent.get_name() }});
+                }
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, data, callback):
+        super().__init__()
+        self._name = "ClientMarkerLayer"
+        self.data = data
+        self.callback = callback
+
+
+def pv_marker_rows(df_points, distance_label=None):
+    """Righe compatte per MAP_PV_CALLBACK da df_points (con colonne color/icon/status)."""
+    if 'distance' in df_points.columns:
+        prefix = f"Distanza da {distance_label or 'centro mappa'}: "
+        distance = df_points['distance'].map(lambda d: "" if pd.isna(d) else f"{prefix}{d:.2f} Km")
+    else:
+        distance = pd.Series("", index=df_points.index)
+    popup = df_points[MAP_POPUP_COLUMNS].astype(object)
+    rows = pd.concat([
+        df_points[['lat', 'lon']].astype(float),
+        df_points['color'].fillna("gray"),
+        df_points['icon'].fillna("question"),
+        distance.rename('distance'),
+        popup.where(popup.notna(), "").astype(str),
+    ], axis=1)
+    return rows.values.tolist()
+
+
+# --- CARICAMENTO PER AREA VISIBILE (VIEWPORT) ---
+
+MAP_WIDTH_PX, MAP_HEIGHT_PX = 900, 600
+MAP_DEFAULT_ZOOM = 10
+MAP_VIEWPORT_MARGIN = 0.5          # margine caricato attorno alla vista, in frazioni della sua ampiezza
+MAP_VIEWPORT_ZOOM_STEP = 2         # variazione di zoom che forza il ricaricamento
+MAP_VIEWPORT_MAX_POINTS = 2000     # oltre, vista aggregata per provincia/regione
+MAP_AGGREGATE_REGION_ZOOM = 7      # sotto questo zoom si aggrega per regione
+
+
+def viewport_bbox_from_view(lat, lon, zoom, width_px=MAP_WIDTH_PX, height_px=MAP_HEIGHT_PX):
+    """Riquadro (min_lat, max_lat, min_lon, max_lon) visibile stimato da centro e zoom (Web Mercator)."""
+    lon_span = width_px * 360.0 / (256 * 2 ** zoom)
+    lat_span = lon_span * height_px / width_px * max(np.cos(np.radians(lat)), 0.01)
+    return (lat - lat_span / 2, lat + lat_span / 2, lon - lon_span / 2, lon + lon_span / 2)
+
+
+def bbox_from_folium_bounds(bounds):
+    """Converte i bounds restituiti da st_folium nel formato (min_lat, max_lat, min_lon, max_lon)."""
+    try:
+        sw, ne = bounds["_southWest"], bounds["_northEast"]
+        bbox = (float(sw["lat"]), float(ne["lat"]), float(sw["lng"]), float(ne["lng"]))
+    except (TypeError, KeyError, ValueError):
+        return None
+    return bbox if all(np.isfinite(bbox)) and bbox[0] < bbox[1] and bbox[2] < bbox[3] else None
+
+
+def resolve_map_viewport(map_state, previous, center, zoom_start=MAP_DEFAULT_ZOOM):
+    """
+    Riquadro di PV da caricare sulla mappa, come dict {"bbox", "zoom"}.
+    map_state è il valore dell'ultima interazione con st_folium (None al primo disegno),
+    previous il riquadro caricato in precedenza. Se la vista è ancora dentro il riquadro
+    precedente e lo zoom è cambiato di poco, ritorna previous (nessun ricalcolo); altrimenti
+    allarga la vista del margine e la allinea alla griglia delle tile dello zoom corrente,
+    così piccoli spostamenti producono lo stesso riquadro.
+    """
+    visible = bbox_from_folium_bounds(map_state.get("bounds")) if map_state else None
+    zoom = map_state.get("zoom") if map_state else None
+    if visible is None or not isinstance(zoom, (int, float)):
+        zoom = zoom_start
+        visible = viewport_bbox_from_view(center[0], center[1], zoom)
+
+    if previous and abs(zoom - previous["zoom"]) < MAP_VIEWPORT_ZOOM_STEP:
+        p_min_lat, p_max_lat, p_min_lon, p_max_lon = previous["bbox"]
+        if p_min_lat <= visible[0] and visible[1] <= p_max_lat and p_min_lon <= visible[2] and visible[3] <= p_max_lon:
+            return previous
+
+    min_lat, max_lat, min_lon, max_lon = visible
+    d_lat = (max_lat - min_lat) * MAP_VIEWPORT_MARGIN
+    d_lon = (max_lon - min_lon) * MAP_VIEWPORT_MARGIN
+    step = 360.0 / 2 ** int(zoom)
+    snap_down = lambda v: float(np.floor(v / step) * step)
+    snap_up = lambda v: float(np.ceil(v / step) * step)
+    bbox = (
+        max(snap_down(min_lat - d_lat), -90.0), min(snap_up(max_lat + d_lat), 90.0),
+        max(snap_down(min_lon - d_lon), -180.0), min(snap_up(max_lon + d_lon), 180.0),
+    )
+    return {"bbox": bbox, "zoom": int(zoom)}
+
+
+def points_in_bbox(df_points, bbox):
+    """Maschera booleana dei punti di df_points (colonne lat/lon) dentro il riquadro."""
+    min_lat, max_lat, min_lon, max_lon = bbox
+    return df_points['lat'].between(min_lat, max_lat) & df_points['lon'].between(min_lon, max_lon)
+
+
+def aggregate_marker_rows(df_points, level):
+    """Righe per MAP_AREA_CALLBACK: un cerchio per provincia/regione (`level`) con PV e scaduti."""
+    grouped = (
+        df_points.assign(
+            area=df_points[level].fillna("N/D").replace("", "N/D"),
+            scaduto=df_points['color'].eq("darkred"),
+        )
+        .groupby('area')
+        .agg(lat=('lat', 'mean'), lon=('lon', 'mean'), totale=('lat', 'size'), scaduti=('scaduto', 'sum'))
+    )
+    radius = np.minimum(40, 6 + 3 * np.sqrt(grouped['totale']))
+    return [
+        [float(row.lat), float(row.lon), float(r), str(area), int(row.totale), int(row.scaduti)]
+        for (area, row), r in zip(grouped.iterrows(), radius)
+    ]
+
+
+# --- CACHE DEL LAYER DELLA MAPPA ---
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_map_layer_payload(layer_key, _df_view, distance_label=None, aggregate_level=None):
+    """
+    Dati del layer dei PV, memorizzati per `layer_key` (stato dei filtri, riquadro caricato,
+    versione dei dati di manutenzioni e data odierna): le interazioni che non cambiano la
+    chiave, come le spunte in selection_editor o le modifiche in work_order_editor, riusano
+    il layer già pronto. _df_view è escluso dall'hash: layer_key deve bastare a identificarlo.
+    Ritorna (modalità, righe) con modalità "aree", "marker" o "cluster".
+    """
+    if aggregate_level:
+        return "aree", aggregate_marker_rows(_df_view, aggregate_level)
+    mode = "cluster" if len(_df_view) > MAP_CLUSTER_THRESHOLD else "marker"
+    return mode, pv_marker_rows(_df_view, distance_label)
+
+
+def map_layer_from_payload(mode, rows):
+    """
+    FeatureGroup dei PV costruito dai dati compatti: marker singoli fino a
+    MAP_CLUSTER_THRESHOLD, cluster lato browser oltre, oppure cerchi delle aree aggregate.
+    Lo stile dei pin (MAP_PIN_CSS) va aggiunto una volta all'header della mappa.
+    """
+    layer = folium.FeatureGroup(name="Punti vendita")
+    if mode == "cluster":
+        FastMarkerCluster(
+            rows, callback=MAP_PV_CALLBACK,
+            options={"chunkedLoading": True, "showCoverageOnHover": False, "disableClusteringAtZoom": 15},
+        ).add_to(layer)
+    else:
+        ClientMarkerLayer(rows, MAP_AREA_CALLBACK if mode == "aree" else MAP_PV_CALLBACK).add_to(layer)
+    return layer
 
 # GENERAZIONE PDF PROGRAMMAZIONE  funzione globale 
 
@@ -1177,151 +3357,86 @@ def create_pdf(dataframe):
  ## FUNZIONE DI COMPLETAMENTO DEL WORK ORDER CONFERMA ATTIVITA MANUTENZIONE SVOLTE
    
 
-import datetime
-import pandas as pd
-import streamlit as st
-from dateutil.relativedelta import relativedelta
+def _sql_add_months(iso_date, months):
+    """Funzione SQL add_months(data, mesi) con la stessa semantica di relativedelta."""
+    if not iso_date:
+        return None
+    try:
+        start_date = datetime.date.fromisoformat(str(iso_date)[:10])
+    except ValueError:
+        return None
+    return (start_date + relativedelta(months=int(months))).isoformat()
+
 
 def complete_work_order(work_order_id):
     """
     Sposta tutti i record di un work_order da 'programmazione' -> 'storico_prog',
     e per ogni punto vendita aggiorna i campi in 'manutenzioni' (ultimo_intervento,
     prossimo_intervento = ultimo + 10 mesi, attrezzature, referente_pv, telefono, note).
-    Evita duplicati nello storico controllando work_order_id + punto_vendita.
+    Tutto avviene con istruzioni set-based in un'unica transazione; i duplicati nello
+    storico sono esclusi dal vincolo UNIQUE (work_order_id, punto_vendita).
     """
-    try:
-        st.info("⏳ Inizio completamento dell'ordine...")
-
-        conn = get_connection()
-        cursor = conn.cursor()
-
-        # --- PRELEVA TUTTE LE RIGHE DEL WORK_ORDER ---
-        cursor.execute("SELECT * FROM programmazione WHERE work_order_id = ?", (work_order_id,))
-        rows = cursor.fetchall()
-
-        if not rows:
-            st.warning(f"Nessun ordine trovato per ID {work_order_id}.")
-            conn.close()
-            return
-
-        # Recupera i nomi delle colonne della tabella programmazione (per inserimento in storico)
-        pragma = cursor.execute("PRAGMA table_info(programmazione)").fetchall()
-        prog_cols = [c[1] for c in pragma]  # lista di nomi colonne
-
-        # Indici utili (se non esistono verrà sollevato KeyError, che catturiamo)
-        try:
-            idx_pv = prog_cols.index("punto_vendita")
-            idx_data = prog_cols.index("data_programmata")
-            # campi opzionali
-            idx_ref = prog_cols.index("referente_pv") if "referente_pv" in prog_cols else None
-            idx_tel = prog_cols.index("telefono") if "telefono" in prog_cols else None
-            idx_note = prog_cols.index("note") if "note" in prog_cols else None
-            idx_att = prog_cols.index("attrezzature") if "attrezzature" in prog_cols else None
-        except ValueError as ve:
-            st.error(f"Struttura tabella 'programmazione' inattesa: {ve}")
-            conn.close()
-            return
-
-        updated_count = 0
-        inserted_in_storico = 0
-
-        # --- PER OGNI RIGA: aggiorna manutenzioni ---
-        for row in rows:
-            pv = row[idx_pv]
-            data_prog = row[idx_data]
-            ref_pv = row[idx_ref] if idx_ref is not None else None
-            tel = row[idx_tel] if idx_tel is not None else None
-            note = row[idx_note] if idx_note is not None else None
-            attrezzature = row[idx_att] if idx_att is not None else None
-
-            # Conversione sicura data_programmata -> date
-            data_ultimo_intervento = None
-            if data_prog:
-                try:
-                    if isinstance(data_prog, str):
-                        # try isoformat first, fallback: pandas
-                        try:
-                            data_ultimo_intervento = datetime.datetime.fromisoformat(data_prog).date()
-                        except Exception:
-                            data_ultimo_intervento = pd.to_datetime(data_prog, errors="coerce").date()
-                    elif isinstance(data_prog, datetime.datetime):
-                        data_ultimo_intervento = data_prog.date()
-                    elif isinstance(data_prog, datetime.date):
-                        data_ultimo_intervento = data_prog
-                except Exception:
-                    st.warning(f"⚠️ Data non valida per PV '{pv}': {data_prog}")
-
-            # Calcola prossimo intervento (+10 mesi)
-            data_prossimo_intervento = None
-            if data_ultimo_intervento:
-                data_prossimo_intervento = data_ultimo_intervento + relativedelta(months=+10)
-
-            # Prepara update dinamico per manutenzioni
-            updates = []
-            params = []
-
-            if data_ultimo_intervento:
-                updates.append("ultimo_intervento = ?")
-                params.append(data_ultimo_intervento)
-            if data_prossimo_intervento:
-                updates.append("prossimo_intervento = ?")
-                params.append(data_prossimo_intervento)
-            if ref_pv:
-                updates.append("referente_pv = ?")
-                params.append(ref_pv)
-            if tel:
-                updates.append("telefono = ?")
-                params.append(tel)
-            if note:
-                updates.append("note = ?")
-                params.append(note)
-            if attrezzature:
-                updates.append("attrezzature = ?")
-                params.append(attrezzature)
-
-            if updates:
-                params.append(pv)
-                query = f"UPDATE manutenzioni SET {', '.join(updates)} WHERE punto_vendita = ?"
-                cursor.execute(query, tuple(params))
-                updated_count += 1
-
-        # --- INSERIMENTO nello storico: riga-per-riga controllando duplicati ---
-        # Costruisco query di insert dinamica usando i nomi colonne presi da programmazione
-        placeholders = ", ".join(["?"] * len(prog_cols))
-        cols_sql = ", ".join(prog_cols)
-        insert_sql = f"INSERT INTO storico_prog ({cols_sql}) VALUES ({placeholders})"
-
-        for row in rows:
-            pv = row[idx_pv]
-            # controllo duplicato sul binomio work_order_id + punto_vendita
-            cursor.execute("SELECT COUNT(*) FROM storico_prog WHERE work_order_id = ? AND punto_vendita = ?", (work_order_id, pv))
-            if cursor.fetchone()[0] == 0:
-                cursor.execute(insert_sql, tuple(row))
-                inserted_in_storico += 1
-            else:
-                st.write(f"DEBUG: record work_order_id={work_order_id} punto_vendita='{pv}' già presente nello storico; salto insert.")
-
-        # --- ELIMINA tutte le righe in programmazione per quel work_order_id ---
-        cursor.execute("DELETE FROM programmazione WHERE work_order_id = ?", (work_order_id,))
-        deleted = cursor.rowcount
-
-        conn.commit()
-        conn.close()
-
-        st.success(f"✅ Aggiornati {updated_count} record in 'manutenzioni'.")
-        st.success(f"✅ Inseriti {inserted_in_storico} record in 'storico_prog' e cancellati {deleted} da 'programmazione'.")
-        st.balloons()
-        st.rerun()
+    st.info("⏳ Inizio completamento dell'ordine...")
 
+    conn = get_connection()
+    conn.create_function("add_months", 2, _sql_add_months, deterministic=True)
+    try:
+        with write_transaction(conn):
+            order_rows = conn.execute(
+                "SELECT COUNT(*) FROM programmazione WHERE work_order_id = ?", (work_order_id,)
+            ).fetchone()[0]
+            if order_rows == 0:
+                st.warning(f"Nessun ordine trovato per ID {work_order_id}.")
+                return False
+
+            # --- AGGIORNA manutenzioni: una sola UPDATE ... FROM (ultima riga dell'ordine per PV) ---
+            # I campi vuoti dell'ordine non sovrascrivono i valori esistenti
+            updated_count = conn.execute("""
+                UPDATE manutenzioni
+                SET ultimo_intervento = COALESCE(p.data_ultimo, manutenzioni.ultimo_intervento),
+                    prossimo_intervento = COALESCE(add_months(p.data_ultimo, 10), manutenzioni.prossimo_intervento),
+                    referente_pv = COALESCE(NULLIF(p.referente_pv, ''), manutenzioni.referente_pv),
+                    telefono = COALESCE(NULLIF(p.telefono, ''), manutenzioni.telefono),
+                    note = COALESCE(NULLIF(p.note, ''), manutenzioni.note),
+                    attrezzature = COALESCE(NULLIF(p.attrezzature, ''), manutenzioni.attrezzature)
+                FROM (
+                    SELECT punto_vendita, date(data_programmata) AS data_ultimo,
+                           referente_pv, telefono, note, attrezzature
+                    FROM programmazione
+                    WHERE id IN (
+                        SELECT MAX(id) FROM programmazione WHERE work_order_id = ? GROUP BY punto_vendita
+                    )
+                ) AS p
+                WHERE manutenzioni.punto_vendita = p.punto_vendita
+            """, (work_order_id,)).rowcount
+
+            # --- INSERIMENTO nello storico delle colonne comuni alle due tabelle ---
+            storico_cols = {c[1] for c in conn.execute("PRAGMA table_info(storico_prog)")}
+            cols_sql = ", ".join(
+                c[1] for c in conn.execute("PRAGMA table_info(programmazione)") if c[1] in storico_cols
+            )
+            inserted_in_storico = conn.execute(f"""
+                INSERT OR IGNORE INTO storico_prog ({cols_sql})
+                SELECT {cols_sql} FROM programmazione WHERE work_order_id = ? ORDER BY id
+            """, (work_order_id,)).rowcount
+
+            # --- ELIMINA tutte le righe in programmazione per quel work_order_id ---
+            deleted = conn.execute(
+                "DELETE FROM programmazione WHERE work_order_id = ?", (work_order_id,)
+            ).rowcount
     except Exception as e:
         st.error(f"❌ Errore durante il completamento dell'ordine: {e}")
-        try:
-            conn.rollback()
-        except:
-            pass
-        finally:
-            if 'conn' in locals() and conn:
-                conn.close()
+        return False
+    finally:
+        conn.close()
+
+    bump_data_version("manutenzioni", "programmazione", "storico_prog")
+    st.success(f"✅ Aggiornati {updated_count} record in 'manutenzioni'.")
+    st.success(f"✅ Inseriti {inserted_in_storico} record in 'storico_prog' e cancellati {deleted} da 'programmazione'.")
+    if inserted_in_storico < order_rows:
+        st.info(f"ℹ️ {order_rows - inserted_in_storico} record erano già presenti nello storico e non sono stati duplicati.")
+    st.balloons()
+    st.rerun()
 
 
                 
@@ -1351,67 +3466,75 @@ def show_mappa():
            st.stop()
         df_map = df_manutenzioni.dropna(subset=['lat', 'lon']).copy()
         if df_map.empty: st.warning("Nessun punto vendita con coordinate disponibili..."); return
-        df_map['ultimo_intervento_dt'] = pd.to_datetime(df_map['ultimo_intervento'], errors='coerce')
-        def get_status(last_service_date_dt):
-            if pd.isna(last_service_date_dt): return "Sconosciuto", "gray", "question"
-            try:
-                today = datetime.date.today()
-                months_diff = (today.year - last_service_date_dt.year) * 12 + (today.month - last_service_date_dt.month)
-                if months_diff > 12: return "Scaduto (>12 mesi)", "darkred", "exclamation-circle"
-                elif 8 < months_diff <= 12: return "Attenzione (8-12 mesi)", "orange", "exclamation-circle"
-                elif 4 < months_diff <= 8: return "In Scadenza (4-8 mesi)", "blue", "info-circle"
-                else: return "OK (<4 mesi)", "green", "check-circle"
-            except Exception: return "Errore Data", "black", "times-circle"
-        df_map[['status', 'color', 'icon']] = df_map['ultimo_intervento_dt'].apply(lambda x: pd.Series(get_status(x)))
+        df_map[['status', 'color', 'icon']] = classify_maintenance_status(df_map['ultimo_intervento'])
         st.sidebar.subheader("Filtri Mappa")
         filter_type = st.sidebar.radio("Tipo di Filtro", ["Nessuno", "Raggio (Km)", "N più Vicini"])
+        selected_brand_map, filter_value = "Tutti", None
         if filter_type != "Nessuno":
             df_brands = load_data("format")
             brand_list = ["Tutti"] + df_brands['brand'].tolist()
             selected_brand_map = st.sidebar.selectbox("Filtra per Brand", brand_list)
             if selected_brand_map != "Tutti": df_map = df_map[df_map['brand'] == selected_brand_map]
-        unique_cities = df_comuni['comune'].dropna().unique()
-        city_list = [""] + sorted(unique_cities.tolist())
+        city_list = [""] + comune_options()
         selected_city = st.sidebar.selectbox("Centra Mappa su / Filtra per Città", city_list)
         center_lat, center_lon = 45.4367, 9.2072
-        if selected_city:
-            city_data = df_comuni[df_comuni['comune'] == selected_city]
-            if not city_data.empty:
-                center_lat = city_data['lat'].iloc[0]
-                center_lon = city_data['lon'].iloc[0]
+        city_data = lookup_comune(selected_city) if selected_city else None
+        if city_data and city_data['lat'] is not None:
+            center_lat, center_lon = city_data['lat'], city_data['lon']
         if filter_type == "Raggio (Km)":
-            radius_km = st.sidebar.number_input("Raggio in Km", min_value=1, value=10)
+            radius_km = filter_value = st.sidebar.number_input("Raggio in Km", min_value=1, value=10)
             if selected_city:
                 center_point = (center_lat, center_lon)
-                distances = [geodesic(center_point, (lat, lon)).km for lat, lon in zip(df_map['lat'], df_map['lon'])]
-                df_map['distance'] = distances
-                df_map = df_map[df_map['distance'] <= radius_km]
+                df_map = filter_within_radius(df_map, center_point, radius_km)
             else: st.sidebar.warning("Seleziona una città per usare il filtro per raggio.")
         elif filter_type == "N più Vicini":
-            n_count = st.sidebar.number_input("Numero di punti più vicini", min_value=1, value=5)
+            n_count = filter_value = st.sidebar.number_input("Numero di punti più vicini", min_value=1, value=5)
             if selected_city:
                 center_point = (center_lat, center_lon)
-                distances = [geodesic(center_point, (lat, lon)).km for lat, lon in zip(df_map['lat'], df_map['lon'])]
-                df_map['distance'] = distances
-                df_map = df_map.sort_values(by='distance').head(n_count)
+                df_map = filter_nearest(df_map, center_point, n_count)
             else: st.sidebar.warning("Seleziona una città per usare il filtro per prossimità.")
         elif filter_type == "Nessuno":
-            if selected_city: df_map = df_map[df_map['citta'] == selected_city]
+            if selected_city:
+                city_name = city_data['comune'] if city_data else selected_city
+                same_city = df_map['citta'].map(normalize_place_name) == normalize_place_name(city_name)
+                if city_data and city_data['label'] != city_data['comune']:
+                    # omonimo: si distingue per provincia
+                    same_city &= df_map['provincia'].map(normalize_place_name) == normalize_place_name(city_data['provincia'])
+                df_map = df_map[same_city]
         
         df_map = df_map.copy()
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=10)
-        pin_colors_hex = {"darkred": "#8B0000 ", "orange": "#FF8C00", "blue": "#0066CC", "green": "#008000", "gray": "#808080", "black": "#333333"}
-        for _, row in df_map.iterrows():
-            # ... (logica di creazione del marker rimane identica) ...
-            distance_text = ""
-            if 'distance' in df_map.columns and not pd.isna(row.get('distance')):
-                distance_text = f"<br><b>🚗 Distanza da {selected_city or 'centro mappa'}:</b> {row['distance']:.2f} Km"
-            popup_text = f"</b>{distance_text}<br>{row['punto_vendita']}<br>Brand: {row['brand']}<br>Indirizzo: {row['indirizzo']}, {row['citta']} ({row['provincia']})<br>Ultimo Intervento: {row['ultimo_intervento']}</b><br>Stato: {row['status']}<br>👤 Referente: {row['referente_pv']}<br>📞 Telefono: {row['telefono']}<br>📝 Note: {row['note']}"
-            pin_color_hex = pin_colors_hex.get(row['color'], "#808080")
-            icon_html = f"""<div style="background-color: {pin_color_hex}; width: 36px; height: 36px; border-radius: 50% 50% 50% 0; transform: rotate(-45deg); display: flex; align-items: center; justify-content: center; border: 2px solid white; box-shadow: 0 2px 5px rgba(0,0,0,0.3);"><i class="fa fa-{row['icon']}" style="color: white; transform: rotate(45deg); font-size: 18px;"></i></div>"""
-            custom_icon = folium.DivIcon(html=icon_html, icon_size=(36, 36), icon_anchor=(18, 36), popup_anchor=(0, -36))
-            folium.Marker(location=[row['lat'], row['lon']], popup=folium.Popup(popup_text, max_width=300), tooltip=row['punto_vendita'], icon=custom_icon).add_to(m)
-        st_data = st_folium(m, width=900, height=600, key="main_interactive_map")
+        m = folium.Map(location=[center_lat, center_lon], zoom_start=MAP_DEFAULT_ZOOM)
+        m.get_root().header.add_child(folium.Element(MAP_PIN_CSS))
+
+        # --- SOLO I PV DELL'AREA VISIBILE (più margine) VANNO AL BROWSER ---
+        # una chiave per centro: cambiando città la mappa riparte senza i bounds della vista precedente
+        map_key = f"main_interactive_map_{center_lat:.4f}_{center_lon:.4f}"
+        viewport = resolve_map_viewport(
+            st.session_state.get(map_key), st.session_state.get("map_viewport"), (center_lat, center_lon)
+        )
+        st.session_state.map_viewport = viewport
+        df_view = df_map[points_in_bbox(df_map, viewport["bbox"])]
+        level = None
+        if len(df_view) > MAP_VIEWPORT_MAX_POINTS:
+            level = "regione" if viewport["zoom"] < MAP_AGGREGATE_REGION_ZOOM else "provincia"
+        layer_key = (
+            filter_type, selected_brand_map, selected_city, filter_value,
+            viewport["bbox"], viewport["zoom"],
+            get_data_version("manutenzioni"), datetime.date.today().isoformat(),
+        )
+        render_mode, layer_rows = build_map_layer_payload(layer_key, df_view, selected_city, level)
+        markers_layer = map_layer_from_payload(render_mode, layer_rows)
+        if render_mode == "aree":
+            st.caption(f"🗺️ {len(df_view)} PV nell'area: vista aggregata per {level} ({len(layer_rows)} aree), zooma per vedere i singoli punti.")
+        elif render_mode == "cluster":
+            st.caption(f"📍 {len(df_view)} punti vendita nell'area: marker raggruppati sulla mappa, zooma per vedere i singoli PV.")
+        if len(df_view) < len(df_map):
+            st.caption(f"Sulla mappa {len(df_view)} di {len(df_map)} PV filtrati (area visibile); la tabella sotto li elenca tutti.")
+        # i marker viaggiano come feature group: spostare la vista non ricrea la mappa
+        st_folium(
+            m, width=MAP_WIDTH_PX, height=MAP_HEIGHT_PX, key=map_key,
+            feature_group_to_add=markers_layer, returned_objects=["bounds", "zoom"],
+        )
 
         # --- SEZIONE 2: TABELLA PER LA SELEZIONE ---
         st.subheader("1. Seleziona i Punti Vendita e Aggiungi Dettagli")
@@ -1439,7 +3562,19 @@ def show_mappa():
         selected_rows_full = df_map.loc[selected_indices]
         
         if not selected_rows_full.empty:
-            st.session_state.selected_for_work_order = selected_rows_full
+            # --- OTTIMIZZAZIONE DEL PERCORSO (sequenza di visita salvata con l'ordine) ---
+            col_opt, col_depot = st.columns([1, 2])
+            with col_opt:
+                optimize_route = st.checkbox("🧭 Ottimizza ordine di visita", value=True, key="optimize_route")
+            with col_depot:
+                depot_city = st.selectbox("Partenza da (opzionale)", city_list, key="route_depot_city")
+            depot = None
+            depot_data = lookup_comune(depot_city) if depot_city else None
+            if depot_data and depot_data['lat'] is not None:
+                depot = (depot_data['lat'], depot_data['lon'])
+            route_df, naive_km, route_km = plan_route(selected_rows_full, depot=depot, optimize=optimize_route)
+
+            st.session_state.selected_for_work_order = route_df
             work_order_df = st.session_state.selected_for_work_order[[
                 'punto_vendita', 'indirizzo', 'citta', 'cap', 'provincia', 
                 'referente_pv', 'telefono', 'attrezzature', 'note'
@@ -1477,8 +3612,16 @@ def show_mappa():
                         # --- SEZIONE 3: CALCOLO DISTANZA E SALVATAGGIO ---
             st.subheader("2. Salva la Programmazione")
             
-            total_distance = calculate_total_route_distance(st.session_state.selected_for_work_order)
-            st.info(f"🚗 Distanza totale stimata del percorso: **{total_distance:.2f} Km**")
+            total_distance = route_km
+            if optimize_route and naive_km > 0:
+                saving = (naive_km - route_km) / naive_km * 100
+                st.info(f"🚗 Distanza totale stimata del percorso ottimizzato: **{route_km:.2f} Km** "
+                        f"(ordine di selezione: {naive_km:.2f} Km, risparmio {saving:.1f}%)")
+            else:
+                st.info(f"🚗 Distanza totale stimata del percorso: **{total_distance:.2f} Km**")
+            st.caption("Sequenza di visita: " + " → ".join(
+                f"{i}. {pv}" for i, pv in enumerate(route_df['punto_vendita'], start=1)
+            ))
 
             if st.button("🔒 Conferma e Salva Programmazione", type="primary"):
                 if not st.session_state.work_order_data.empty:
@@ -1533,8 +3676,8 @@ def show_programmazione():
     def show_tab_attivi():
         st.subheader("📋 Gestione Ordini di Lavoro Attivi")
         
-        conn = get_connection()
-        df_prog = pd.read_sql_query("SELECT * FROM programmazione ORDER BY work_order_number DESC", conn)
+        conn = get_connection(readonly=True)
+        df_prog = pd.read_sql_query("SELECT * FROM programmazione ORDER BY work_order_number DESC, ordine_percorso, id", conn)
         conn.close()
         df_prog['created_at'] = pd.to_datetime(df_prog['created_at'])
 
@@ -1636,8 +3779,8 @@ def show_programmazione():
     def show_tab_storico():
         st.subheader("📜 Storico attività manutenzione")
     
-        conn = get_connection()
-        df_storico = pd.read_sql_query("SELECT * FROM storico_prog ORDER BY work_order_number DESC", conn)
+        conn = get_connection(readonly=True)
+        df_storico = pd.read_sql_query("SELECT * FROM storico_prog ORDER BY work_order_number DESC, ordine_percorso, id", conn)
         conn.close()
     
         df_storico['created_at'] = pd.to_datetime(df_storico['created_at'])
@@ -1658,6 +3801,7 @@ def show_programmazione():
                             cursor.execute("DELETE FROM storico_prog")
                             conn.commit()
                             conn.close()
+                            bump_data_version("storico_prog")
                             st.success("✅ Tutto lo storico è stato eliminato!")
                             st.rerun()
                         except Exception as e:
@@ -1699,6 +3843,7 @@ def show_programmazione():
                             placeholders = ','.join(['?'] * len(ids_to_delete))
                             cursor.execute(f"DELETE FROM storico_prog WHERE id IN ({placeholders})", ids_to_delete)
                             conn.commit()
+                            bump_data_version("storico_prog")
                             st.success(f"{len(ids_to_delete)} record eliminati con successo!")
                             st.rerun()
                         except Exception as e:
@@ -1769,7 +3914,7 @@ def show_programmazione():
 
         # --- Report analitico manutenzioni ---
         st.subheader("#📈 Report analitico manutenzioni")
-        conn = get_connection()
+        conn = get_connection(readonly=True)
         filtered = pd.DataFrame()
 
         try:
@@ -1814,14 +3959,19 @@ def show_programmazione():
     def show_tab_stato():
         st.subheader("🔧 Stato Attuale Manutenzioni")
         
-        conn = get_connection()
+        conn = get_connection(readonly=True)
         df_manutenzioni = pd.read_sql_query("SELECT * FROM manutenzioni ORDER BY punto_vendita", conn)
         conn.close()
         
         if df_manutenzioni.empty:
             st.info("Nessun dato di manutenzione disponibile.")
         else:
-            df_manutenzioni['ultimo_intervento'] = pd.to_datetime(df_manutenzioni['ultimo_intervento'])
+            df_manutenzioni['ultimo_intervento'] = pd.to_datetime(df_manutenzioni['ultimo_intervento'], errors='coerce')
+            stato = classify_maintenance_status(df_manutenzioni['ultimo_intervento'])['status']
+            df_manutenzioni.insert(1, 'stato_manutenzione', stato)
+            conteggi = stato.value_counts(sort=False)
+            for col, (nome, totale) in zip(st.columns(len(conteggi)), conteggi.items()):
+                col.metric(nome, int(totale))
             st.dataframe(df_manutenzioni, use_container_width=True)
 
     # --- Creazione delle tab ---
@@ -1875,6 +4025,7 @@ def save_changes(edited_df):
             ))
         conn.commit()
         conn.close()
+        bump_data_version("programmazione")
         st.success("Modifiche salvate con successo!")
         st.rerun()
     except Exception as e:
@@ -1891,6 +4042,7 @@ def delete_selected_rows(edited_df):
                 cursor.execute("DELETE FROM programmazione WHERE id = ?", (record_id,))
             conn.commit()
             conn.close()
+            bump_data_version("programmazione")
             st.success(f"{len(rows_to_delete)} righe eliminate con successo!")
             st.rerun()
         except Exception as e:
@@ -1906,12 +4058,42 @@ def delete_entire_work_order(work_order_id):
         cursor.execute("DELETE FROM programmazione WHERE work_order_id = ?", (work_order_id,))
         conn.commit()
         conn.close()
+        bump_data_version("programmazione")
         st.success("Intero ordine di lavoro eliminato!")
         st.rerun()
     except Exception as e:
         st.error(f"Errore durante l'eliminazione dell'ordine di lavoro: {e}")
 
 
+def normalize_date_series(values):
+    """Converte una colonna di date (date, Timestamp, stringhe) in stringhe 'YYYY-MM-DD' o None."""
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), errors='coerce')
+    return parsed.dt.strftime('%Y-%m-%d').astype(object).where(parsed.notna(), None)
+
+
+def normalize_time_series(values):
+    """
+    Versione vettoriale di normalize_time() per un'intera colonna: restituisce stringhe
+    'HH:MM:SS' (o None) da oggetti time/datetime, stringhe con o senza millisecondi e
+    frazioni di giorno (formato orario di Excel).
+    """
+    values = pd.Series(values, dtype=object)
+    text = values.where(values.notna()).astype(str)
+
+    parsed = pd.to_datetime(text, format='%H:%M:%S.%f', errors='coerce')
+    for fmt in ('%H:%M:%S', '%H:%M', 'ISO8601'):
+        parsed = parsed.fillna(pd.to_datetime(text, format=fmt, errors='coerce'))
+    result = parsed.dt.strftime('%H:%M:%S').astype(object)
+
+    numeric = pd.to_numeric(values, errors='coerce')
+    fractions = numeric[(numeric >= 0) & (numeric < 1) & parsed.isna()]
+    if not fractions.empty:
+        as_time = pd.Timestamp(0) + pd.to_timedelta(fractions * 86400, unit='s').dt.floor('s')
+        result[fractions.index] = as_time.dt.strftime('%H:%M:%S')
+
+    return result.where(result.notna(), None)
+
+
 def normalize_time(value):
     """
     Converte qualsiasi tipo di dato relativo all'orario in un oggetto datetime.time standard.
@@ -1949,12 +4131,448 @@ def normalize_time(value):
     return None
 
 
+# --- GEOCODIFICA CON CACHE PERSISTENTE ---
+
+GEOCODE_PROVIDER = "nominatim"
+GEOCODE_USER_AGENT = "my_manutenzioni_app"
+GEOCODE_NEGATIVE_TTL = datetime.timedelta(days=30)   # dopo, un indirizzo non trovato viene ricercato di nuovo
+
+
+def geocoding_queries(row):
+    """
+    Ricerche da tentare online per un PV, dalla più precisa alla più generica, come (livello, testo):
+    indirizzo completo, indirizzo + città. Le parti mancanti vengono saltate (e con esse le ricerche
+    che diventerebbero duplicate); senza indirizzo non c'è nulla da chiedere al servizio, perché la
+    posizione del comune arriva offline da resolve_comuni_offline.
+    """
+    if not has_street_address(row):
+        return []
+    def join(*parts):
+        return ", ".join(str(p).strip() for p in parts if pd.notna(p) and str(p).strip())
+    queries = [
+        ("completo", join(row.get('indirizzo'), row.get('cap'), row.get('citta'), row.get('provincia'), "Italia")),
+        ("semplice", join(row.get('indirizzo'), row.get('citta'), "Italia")),
+    ]
+    # a parità di testo vale il livello più generico (es. senza CAP e provincia resta solo "semplice")
+    unique = {}
+    for level, query in reversed(queries):
+        if query != "Italia":
+            unique.setdefault(query, level)
+    return [(level, query) for query, level in reversed(list(unique.items()))]
+
+
+def has_street_address(row):
+    """True se il PV ha un indirizzo stradale (non vuoto e non un semplice 'snc')."""
+    address = normalize_place_name(row.get('indirizzo'))
+    return address not in ("", "snc")
+
+
+def geocode_cache_get(conn, query, provider=GEOCODE_PROVIDER):
+    """
+    Esito in cache per `query`: dict con lat/lon (None se l'indirizzo non era stato trovato),
+    oppure None se non c'è o se è un esito negativo più vecchio di GEOCODE_NEGATIVE_TTL.
+    """
+    row = conn.execute(
+        "SELECT lat, lon, livello, aggiornato_il FROM geocode_cache WHERE chiave = ? AND provider = ?",
+        (normalize_place_name(query), provider),
+    ).fetchone()
+    if row is None:
+        return None
+    lat, lon, level, updated_at = row
+    if lat is None and datetime.datetime.fromisoformat(updated_at) < datetime.datetime.now() - GEOCODE_NEGATIVE_TTL:
+        return None
+    return {"lat": lat, "lon": lon, "livello": level}
+
+
+def geocode_cache_put(conn, query, level, coords, provider=GEOCODE_PROVIDER):
+    """Memorizza l'esito di una ricerca (coords = (lat, lon) oppure None se non trovato)."""
+    lat, lon = coords if coords else (None, None)
+    conn.execute("""
+        INSERT OR REPLACE INTO geocode_cache (chiave, query, lat, lon, livello, provider, aggiornato_il)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (normalize_place_name(query), query, lat, lon, level, provider,
+          datetime.datetime.now().isoformat(timespec="seconds")))
+
+
+def geocode_with_cache(conn, geolocator, queries, before_request=None, provider=GEOCODE_PROVIDER):
+    """
+    Risolve la prima delle `queries` (livello, testo) che dà un risultato, consultando prima
+    geocode_cache e chiamando il servizio solo per i testi non in cache; ogni esito, anche
+    negativo, viene salvato subito in una breve transazione (nessun lock tenuto durante le
+    chiamate di rete), quindi `conn` non deve avere transazioni aperte.
+    Gli errori di rete non vengono memorizzati. `before_request` è chiamata prima di ogni
+    richiesta al servizio (limite di frequenza).
+    Ritorna dict con lat, lon, livello, query (None se nessuna ricerca riesce) e richieste
+    (numero di chiamate al servizio), errore (ultimo errore di rete o None).
+    """
+    result = {"lat": None, "lon": None, "livello": None, "query": None, "richieste": 0, "errore": None}
+    for level, query in queries:
+        cached = geocode_cache_get(conn, query, provider)
+        if cached is None:
+            if before_request:
+                before_request()
+            result["richieste"] += 1
+            try:
+                location = geolocator.geocode(query, timeout=10)
+            except GeopyError as e:
+                result["errore"] = str(e)
+                continue
+            coords = (location.latitude, location.longitude) if location else None
+            with write_transaction(conn):
+                geocode_cache_put(conn, query, level, coords, provider)
+            cached = {"lat": coords[0], "lon": coords[1], "livello": level} if coords else None
+        if cached and cached["lat"] is not None:
+            result.update(lat=cached["lat"], lon=cached["lon"], livello=level, query=query)
+            return result
+    return result
+
+
+# --- CODA DI GEOCODIFICA IN BACKGROUND ---
+
+GEOCODE_RATE_PER_SECOND = 1.0      # policy Nominatim: al massimo una richiesta al secondo
+GEOCODE_BURST = 1
+GEOCODE_POLL_SECONDS = 2
+GEOCODE_ACTIVE_STATES = ("in_coda", "in_corso")
+GEOCODE_ITEM_COLUMNS = ["indirizzo", "cap", "citta", "provincia"]
+# precisione_geo dei PV posizionati sul centroide del comune (da raffinare con la geocodifica online)
+GEO_PRECISION_CENTROID = {"esatto": "comune", "normalizzato": "comune", "approssimato": "comune_approssimato"}
+
+
+class TokenBucket:
+    """Limitatore a gettoni: in media `rate` richieste al secondo, con raffiche fino a `capacity`."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Attende finché è disponibile un gettone e lo consuma."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_geocoder():
+    """Geocoder usato dal worker (sostituibile, es. con un geocoder locale nei test)."""
+    return Nominatim(user_agent=GEOCODE_USER_AGENT)
+
+
+@st.cache_resource
+def _geocoding_worker_state():
+    """Stato del worker di geocodifica, unico per processo."""
+    return {
+        "lock": threading.Lock(),
+        "thread": None,
+        "bucket": TokenBucket(GEOCODE_RATE_PER_SECOND, GEOCODE_BURST),
+    }
+
+
+def ensure_geocoding_worker(geocoder_factory=None):
+    """
+    Avvia il thread di geocodifica se non è attivo. Il thread riceve i registri dei pool e delle
+    versioni (non usa le cache di Streamlit) e termina da solo quando non restano job da fare.
+    """
+    state = _geocoding_worker_state()
+    with state["lock"]:
+        if state["thread"] is None or not state["thread"].is_alive():
+            state["thread"] = threading.Thread(
+                target=_geocoding_worker_loop,
+                args=(state, _connection_pools(), _data_versions(), (geocoder_factory or make_geocoder)()),
+                name="geocoding-worker", daemon=True,
+            )
+            state["thread"].start()
+    return state
+
+
+def _next_geocoding_job(conn):
+    row = conn.execute(
+        "SELECT id FROM geocode_jobs WHERE stato IN ('in_coda', 'in_corso') ORDER BY id LIMIT 1"
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _geocoding_worker_loop(state, pools, versions, geocoder):
+    conn = _connection_from(pools, DB_FILE, readonly=False)
+    try:
+        while True:
+            job_id = _next_geocoding_job(conn)
+            if job_id is None:
+                # uscita sotto lock: un job accodato nel frattempo trova il thread già chiuso e ne avvia uno nuovo
+                with state["lock"]:
+                    if _next_geocoding_job(conn) is None:
+                        state["thread"] = None
+                        return
+                continue
+            _run_geocoding_job(conn, job_id, state["bucket"], versions, geocoder)
+    finally:
+        conn.close()
+
+
+def _run_geocoding_job(conn, job_id, bucket, versions, geocoder):
+    """Elabora gli elementi in coda di un job, uno alla volta con commit per elemento."""
+    now = lambda: datetime.datetime.now().isoformat(timespec="seconds")
+    with write_transaction(conn):
+        conn.execute(
+            "UPDATE geocode_jobs SET stato = 'in_corso', aggiornato_il = ? WHERE id = ? AND stato = 'in_coda'",
+            (now(), job_id),
+        )
+    while True:
+        job_state, item = conn.execute("""
+            SELECT j.stato, i.pv_id FROM geocode_jobs j
+            LEFT JOIN geocode_job_items i ON i.job_id = j.id AND i.stato = 'in_coda'
+            WHERE j.id = ? ORDER BY i.pv_id LIMIT 1
+        """, (job_id,)).fetchone()
+        if job_state != "in_corso":
+            return  # annullato: gli elementi restano in coda per una ripresa
+        if item is None:
+            with write_transaction(conn):
+                conn.execute(
+                    "UPDATE geocode_jobs SET stato = 'completato', aggiornato_il = ? WHERE id = ? AND stato = 'in_corso'",
+                    (now(), job_id),
+                )
+            return
+
+        fields = conn.execute(
+            f"SELECT {', '.join(GEOCODE_ITEM_COLUMNS)} FROM geocode_job_items WHERE job_id = ? AND pv_id = ?",
+            (job_id, item),
+        ).fetchone()
+        try:
+            result = geocode_with_cache(
+                conn, geocoder, geocoding_queries(dict(zip(GEOCODE_ITEM_COLUMNS, fields))),
+                before_request=bucket.acquire,
+            )
+        except Exception as e:
+            result = {"lat": None, "livello": None, "query": None, "errore": str(e)}
+        found = result["lat"] is not None
+        with write_transaction(conn):
+            if found:
+                conn.execute(
+                    "UPDATE manutenzioni SET lat = ?, lon = ?, precisione_geo = ? WHERE ID = ?",
+                    (result["lat"], result["lon"], result["livello"], item),
+                )
+            conn.execute("""
+                UPDATE geocode_job_items SET stato = ?, livello = ?, query = ?, errore = ?, aggiornato_il = ?
+                WHERE job_id = ? AND pv_id = ?
+            """, ("ok" if found else "fallito", result["livello"], result["query"],
+                  None if found else result["errore"], now(), job_id, item))
+            conn.execute("UPDATE geocode_jobs SET aggiornato_il = ? WHERE id = ?", (now(), job_id))
+        if found:
+            _bump_versions(versions, "manutenzioni")
+
+
+def centroid_precision_sql(alias=""):
+    """Condizione SQL sui PV (con alias di tabella opzionale): coordinate assenti o solo al centroide del comune."""
+    p = f"{alias}." if alias else ""
+    levels = ", ".join(f"'{level}'" for level in sorted(set(GEO_PRECISION_CENTROID.values())))
+    return f"({p}lat IS NULL OR {p}lon IS NULL OR {p}precisione_geo IN ({levels}))"
+
+
+def assign_comune_centroids(df_rows):
+    """
+    Risoluzione offline: assegna in blocco il centroide del comune (resolve_comuni_offline) ai PV
+    di df_rows senza coordinate o già al centroide, senza toccare quelli geocodificati online o
+    posizionati a mano. Ritorna i PV risolti (ID, comune, provincia, metodo, ...).
+    """
+    resolved = resolve_comuni_offline(df_rows)
+    if resolved.empty:
+        return resolved
+    resolved['precisione_geo'] = resolved['metodo'].map(GEO_PRECISION_CENTROID)
+    conn = get_connection()
+    try:
+        with write_transaction(conn):
+            conn.executemany(
+                f"UPDATE manutenzioni SET lat = ?, lon = ?, precisione_geo = ? WHERE ID = ? AND {centroid_precision_sql()}",
+                dataframe_to_sql_params(resolved, ['lat', 'lon', 'precisione_geo', 'ID']),
+            )
+    finally:
+        conn.close()
+    bump_data_version("manutenzioni")
+    return resolved
+
+
+def geocode_in_tiers(df_rows, created_by=None):
+    """
+    Geocodifica a livelli: prima il centroide del comune per tutti, subito e offline, poi un job
+    in background solo per i PV con indirizzo stradale. Ritorna (PV risolti offline, id del job o None).
+    """
+    resolved = assign_comune_centroids(df_rows)
+    street_rows = df_rows[df_rows.apply(has_street_address, axis=1)] if not df_rows.empty else df_rows
+    job_id = enqueue_geocoding_job(street_rows, created_by) if not street_rows.empty else None
+    return resolved, job_id
+
+
+def enqueue_geocoding_job(df_rows, created_by=None):
+    """
+    Accoda un job con un elemento per PV di df_rows (colonne ID, indirizzo, cap, citta, provincia),
+    fotografando l'indirizzo al momento della richiesta, e avvia il worker. Ritorna l'id del job.
+    """
+    items = df_rows.drop_duplicates('ID').copy()
+    items['ID'] = items['ID'].astype(int)
+    items['cap'] = items['cap'].map(lambda v: None if pd.isna(v) else str(v))
+    conn = get_connection()
+    try:
+        with write_transaction(conn):
+            job_id = conn.execute(
+                "INSERT INTO geocode_jobs (stato, totale, creato_da, creato_il) VALUES ('in_coda', ?, ?, ?)",
+                (len(items), created_by, datetime.datetime.now().isoformat(timespec="seconds")),
+            ).lastrowid
+            conn.executemany(
+                f"INSERT INTO geocode_job_items (job_id, pv_id, {', '.join(GEOCODE_ITEM_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, *params) for params in dataframe_to_sql_params(items, ['ID'] + GEOCODE_ITEM_COLUMNS)],
+            )
+    finally:
+        conn.close()
+    ensure_geocoding_worker()
+    return job_id
+
+
+def set_geocoding_job_state(job_id, new_state, from_states):
+    """Cambia lo stato di un job (annulla/riprendi) solo se è in uno degli stati `from_states`."""
+    conn = get_connection()
+    try:
+        with write_transaction(conn):
+            placeholders = ",".join("?" * len(from_states))
+            changed = conn.execute(
+                f"UPDATE geocode_jobs SET stato = ?, aggiornato_il = ? WHERE id = ? AND stato IN ({placeholders})",
+                (new_state, datetime.datetime.now().isoformat(timespec="seconds"), job_id, *from_states),
+            ).rowcount
+    finally:
+        conn.close()
+    if changed and new_state == "in_coda":
+        ensure_geocoding_worker()
+    return bool(changed)
+
+
+def geocoding_job_progress(job_id=None):
+    """Stato e conteggi per esito di un job (l'ultimo se job_id è None), oppure None se non ce ne sono."""
+    conn = get_connection(readonly=True)
+    try:
+        query = "SELECT id, stato, totale, creato_da, creato_il, aggiornato_il FROM geocode_jobs"
+        job = conn.execute(query + (" WHERE id = ?" if job_id else " ORDER BY id DESC LIMIT 1"),
+                           (job_id,) if job_id else ()).fetchone()
+        if job is None:
+            return None
+        counts = dict(conn.execute(
+            "SELECT stato, COUNT(*) FROM geocode_job_items WHERE job_id = ? GROUP BY stato", (job[0],)
+        ).fetchall())
+    finally:
+        conn.close()
+    progress = dict(zip(["id", "stato", "totale", "creato_da", "creato_il", "aggiornato_il"], job))
+    progress.update(ok=counts.get("ok", 0), fallito=counts.get("fallito", 0), in_coda=counts.get("in_coda", 0))
+    return progress
+
+
+def load_failed_geocoding_items(job_id):
+    """Elementi falliti di un job, con il nome del PV, pronti per la correzione e un nuovo tentativo."""
+    conn = get_connection(readonly=True)
+    try:
+        return pd.read_sql_query(f"""
+            SELECT i.pv_id AS ID, m.punto_vendita, {', '.join('i.' + c for c in GEOCODE_ITEM_COLUMNS)}, i.errore
+            FROM geocode_job_items i LEFT JOIN manutenzioni m ON m.ID = i.pv_id
+            WHERE i.job_id = ? AND i.stato = 'fallito' AND {centroid_precision_sql("m")}
+            ORDER BY m.punto_vendita
+        """, conn, params=(job_id,))
+    finally:
+        conn.close()
+
+
+@st.cache_data
+def geocoding_job_plausibility(job_id, data_version, max_km=30):
+    """
+    Controllo di plausibilità con l'indice spaziale dei comuni sui PV geocodificati da un job:
+    avvisi per le coordinate a più di max_km dalla città dichiarata.
+    """
+    conn = get_connection(readonly=True)
+    try:
+        found = pd.read_sql_query("""
+            SELECT m.punto_vendita, m.citta, m.lat, m.lon FROM geocode_job_items i
+            JOIN manutenzioni m ON m.ID = i.pv_id
+            WHERE i.job_id = ? AND i.stato = 'ok' AND m.lat IS NOT NULL AND m.lon IS NOT NULL
+        """, conn, params=(job_id,))
+    finally:
+        conn.close()
+    warnings = []
+    for row in found.itertuples(index=False):
+        near = comuni_near(row.lat, row.lon, max_km=max_km)
+        if normalize_place_name(row.citta) not in near['comune'].map(normalize_place_name).tolist():
+            found_near = near['comune'].iloc[0] if not near.empty else "nessun comune noto"
+            warnings.append(f"⚠️ Verifica '{row.punto_vendita}': le coordinate sono a più di {max_km} km da {row.citta} (vicino a {found_near}).")
+    return warnings
+
+
+@st.cache_resource
+def resume_geocoding_jobs():
+    """All'avvio del processo riprende i job rimasti in coda o interrotti (una volta per processo)."""
+    conn = get_connection(readonly=True)
+    try:
+        pending = _next_geocoding_job(conn) is not None
+    finally:
+        conn.close()
+    if pending:
+        ensure_geocoding_worker()
+    return pending
+
+
+def _show_geocoding_job_status(job_id, was_active):
+    progress = geocoding_job_progress(job_id)
+    done = progress["ok"] + progress["fallito"]
+    st.progress(done / progress["totale"] if progress["totale"] else 1.0)
+    labels = {"in_coda": "in attesa", "in_corso": "in corso", "annullato": "annullato", "completato": "completato"}
+    st.caption(
+        f"Job #{progress['id']} ({labels.get(progress['stato'], progress['stato'])}, avviato da "
+        f"{progress['creato_da'] or 'n/d'} il {progress['creato_il']}): {done}/{progress['totale']} elaborati, "
+        f"{progress['ok']} trovati, {progress['fallito']} non trovati."
+    )
+    col_cancel, col_resume = st.columns(2)
+    if progress["stato"] in GEOCODE_ACTIVE_STATES:
+        if col_cancel.button("⏹️ Annulla geocodifica", key=f"cancel_geocode_{job_id}"):
+            set_geocoding_job_state(job_id, "annullato", GEOCODE_ACTIVE_STATES)
+            st.rerun()
+    elif progress["stato"] == "annullato" and progress["in_coda"]:
+        if col_resume.button("▶️ Riprendi geocodifica", key=f"resume_geocode_{job_id}"):
+            set_geocoding_job_state(job_id, "in_coda", ("annullato",))
+            st.rerun()
+    if was_active and progress["stato"] not in GEOCODE_ACTIVE_STATES:
+        # job appena terminato: aggiorna tutta la pagina (elenco dei record senza coordinate)
+        st.rerun(scope="app")
+
+
+def show_geocoding_progress():
+    """Riquadro con l'avanzamento dell'ultimo job; si aggiorna da solo finché il job è attivo."""
+    progress = geocoding_job_progress()
+    if progress is None:
+        return None
+    active = progress["stato"] in GEOCODE_ACTIVE_STATES
+    if active:
+        ensure_geocoding_worker()
+    st.fragment(_show_geocoding_job_status, run_every=GEOCODE_POLL_SECONDS if active else None)(progress["id"], active)
+    return progress
+
+
 def show_geocodifica():
     st.header("🌍 Geocodifica Indirizzi Mancanti")
-    st.warning("Questa funzione trova le coordinate (latitudine, longitudine) per i record che non le hanno. Utilizza un servizio gratuito (Nominatim/OpenStreetMap) con un limite di richieste. Sii paziente.")
+    st.warning("Questa funzione trova le coordinate (latitudine, longitudine) per i record che non le hanno. Il centroide del comune viene assegnato subito dall'elenco comuni; gli indirizzi stradali usano un servizio gratuito (Nominatim/OpenStreetMap) con un limite di richieste. Sii paziente.")
     
+    progress = show_geocoding_progress()
+    job_active = progress is not None and progress["stato"] in GEOCODE_ACTIVE_STATES
+    if progress is not None and not job_active:
+        for warning in geocoding_job_plausibility(progress["id"], get_data_version("manutenzioni")):
+            st.warning(warning)
+
     df_manutenzioni = load_data("manutenzioni")
-    df_to_geocode = df_manutenzioni[df_manutenzioni['lat'].isna() | df_manutenzioni['lon'].isna()].copy()
+    missing = df_manutenzioni['lat'].isna() | df_manutenzioni['lon'].isna()
+    at_centroid = df_manutenzioni['precisione_geo'].isin(list(GEO_PRECISION_CENTROID.values()))
+    df_to_geocode = df_manutenzioni[missing | at_centroid].copy()
     
     if df_to_geocode.empty:
         st.success("Tutti i record hanno già le coordinate!")
@@ -1963,7 +4581,16 @@ def show_geocodifica():
             del st.session_state.geocode_editor_df
         return
 
-    st.write(f"Trovati {len(df_to_geocode)} record senza coordinate. Seleziona quelli da geocodificare.")
+    if missing.any():
+        st.info(f"{int(missing.sum())} record non hanno coordinate: la posizione del comune si può assegnare subito, senza servizio online.")
+        if st.button("📍 Assegna il centroide del comune (offline)", key="offline_geocode"):
+            resolved = assign_comune_centroids(df_manutenzioni[missing])
+            st.toast(f"Centroide del comune assegnato a {len(resolved)} record su {int(missing.sum())}.", icon="📍")
+            if 'geocode_editor_df' in st.session_state:
+                del st.session_state.geocode_editor_df
+            st.rerun()
+
+    st.write(f"Trovati {int(missing.sum())} record senza coordinate e {int((at_centroid & ~missing).sum())} posizionati solo sul comune. Seleziona quelli da geocodificare.")
     
     # --- NUOVA LOGICA: USA SESSION STATE COME FONTE DI VERITÀ ---
     
@@ -1996,144 +4623,47 @@ def show_geocodifica():
     
     # 5. La logica di geocodifica ora usa il DataFrame dalla session_state
     selected_rows = st.session_state.geocode_editor_df[st.session_state.geocode_editor_df['Seleziona'] == True]
-        
-    if not selected_rows.empty and st.button("Avvia Geocodifica per i Selezionati", type="primary"):
-        geolocator = Nominatim(user_agent="my_manutenzioni_app")
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        successful_updates = 0
-        failed_updates = 0
-        failed_records = []
-        
-        total_updates = len(selected_rows)
-        current_progress = 0
-        
-        for index, row in selected_rows.iterrows():
-            status_text.text(f"Geocodifica in corso per: {row['punto_vendita']}...")
-            
-            full_address = f"{row['indirizzo']}, {row['cap']}, {row['citta']}, {row['provincia']}, Italia"
-            simple_address = f"{row['indirizzo']}, {row['citta']}, Italia"
-            city_only_address = f"{row['citta']}, Italia"
-            
-            location = None
-            address_used = "Nessuno"
-
-            location = geolocator.geocode(full_address, timeout=10)
-            if location:
-                address_used = full_address
-
-            if not location:
-                st.warning(f"Indirizzo completo non trovato. Provo con '{simple_address}'...")
-                location = geolocator.geocode(simple_address, timeout=10)
-                if location:
-                    address_used = simple_address
-
-            if not location:
-                st.warning(f"Indirizzo semplice non trovato. Provo solo con la città '{city_only_address}'...")
-                location = geolocator.geocode(city_only_address, timeout=10)
-                if location:
-                    address_used = city_only_address
-            
-            if location:
-                cursor.execute(
-                    "UPDATE manutenzioni SET lat = ?, lon = ? WHERE ID = ?",
-                    (location.latitude, location.longitude, row['ID'])
-                )
-                successful_updates += 1
-                st.info(f"✅ Coordinate trovate per '{row['punto_vendita']}' usando: {address_used}")
-            else:
-                st.error(f"❌ Impossibile trovare le coordinate per '{row['punto_vendita']}'.")
-                failed_updates += 1
-                failed_records.append(row.to_dict())
-            
-            current_progress += 1
-            progress_bar.progress(current_progress / total_updates)
-            time.sleep(1)
-        
-        conn.commit()
-        conn.close()
-        
-        status_text.text("Geocodifica completata!")
-        st.success(f"Processo terminato. Aggiornati {successful_updates} record. Falliti {failed_updates} record.")
-        
-        if failed_records:
-            st.session_state.failed_geocoding_df = pd.DataFrame(failed_records)
-            st.error("Ci sono stati record falliti. Puoi modificarli e riprovare nella sezione sottostante.")
-        else:
-            if 'failed_geocoding_df' in st.session_state:
-                del st.session_state.failed_geocoding_df
 
+    if not selected_rows.empty and st.button("Avvia Geocodifica per i Selezionati", type="primary", disabled=job_active):
+        resolved, job_id = geocode_in_tiers(selected_rows, created_by=st.session_state.get("username"))
+        st.toast(f"Centroide del comune assegnato offline a {len(resolved)} record.", icon="📍")
+        if job_id is not None:
+            st.toast(f"Geocodifica degli indirizzi accodata (job #{job_id}): prosegue in background anche cambiando pagina.", icon="🌍")
         # Pulisci lo stato per forzare una reinizializzazione al prossimo caricamento
         if 'geocode_editor_df' in st.session_state:
             del st.session_state.geocode_editor_df
-        
-        if successful_updates > 0:
-            st.rerun()
+        st.rerun()
 
-            # --- SECONDA PARTE: MODIFICA E RIPROVA (CORRETTA) ---
-    if 'failed_geocoding_df' in st.session_state and not st.session_state.failed_geocoding_df.empty:
+    # --- SECONDA PARTE: MODIFICA E RIPROVA (elementi falliti dell'ultimo job) ---
+    if progress is None or job_active:
+        return
+    failed_df = load_failed_geocoding_items(progress["id"])
+    if not failed_df.empty:
         st.markdown("---")
         st.subheader("🔧 Modifica e Riprova Geocodifica")
-        st.info("I record qui sotto non sono stati geocodificati. Puoi modificare l'indirizzo e poi riprovare per tutti i record falliti.")
-        
+        st.info("Per i record qui sotto l'indirizzo non è stato trovato (al più hanno la posizione del comune). Puoi modificare l'indirizzo e poi riprovare per tutti i record falliti.")
+
         failed_edited_df = st.data_editor(
-            st.session_state.failed_geocoding_df, 
-            use_container_width=True, 
+            failed_df,
+            use_container_width=True,
             hide_index=True,
-            column_config={"ID": st.column_config.NumberColumn("ID", disabled=True, width="small")},
-            num_rows="dynamic"
+            column_config={
+                "ID": st.column_config.NumberColumn("ID", disabled=True, width="small"),
+                "punto_vendita": st.column_config.TextColumn("punto_vendita", disabled=True),
+                "errore": st.column_config.TextColumn("errore", disabled=True),
+            },
+            key=f"geocode_retry_editor_{progress['id']}",
         )
 
         if st.button("Riprova Geocodifica per i Record Falliti", type="secondary"):
-            
-            # Controllo di sicurezza per assicurarsi che sia un DataFrame
-            if not isinstance(failed_edited_df, pd.DataFrame):
-                st.error("Errore interno: i dati da riprovare non sono in un formato valido. Ricarica la pagina e riprova.")
-                return
-
-            if not failed_edited_df.empty:
-                geolocator = Nominatim(user_agent="my_manutenzioni_app")
-                retry_progress = st.progress(0)
-                retry_status = st.empty()
-                
-                conn = get_connection()
-                cursor = conn.cursor()
-                
-                retry_successful = 0
-                retry_failed = 0
-                
-                # --- CORREZIONE CHIAVE: Usa un ciclo standard e più sicuro ---
-                for index, row in failed_edited_df.iterrows():
-                    retry_status.text(f"Riprovo per: {row['punto_vendita']}...")
-                    
-                    full_address = f"{row['indirizzo']}, {row['cap']}, {row['citta']}, {row['provincia']}, Italia"
-                    location = geolocator.geocode(full_address, timeout=10)
-                    
-                    if location:
-                        cursor.execute("UPDATE manutenzioni SET lat = ?, lon = ? WHERE ID = ?", (location.latitude, location.longitude, row['ID']))
-                        retry_successful += 1
-                        st.info(f"✅ Riuscito! Coordinate trovate per '{row['punto_vendita']}'.")
-                        # Rimuovi il record dalla lista dei falliti in session_state
-                        st.session_state.failed_geocoding_df = st.session_state.failed_geocoding_df[st.session_state.failed_geocoding_df['ID'] != row['ID']]
-                    else:
-                        retry_failed += 1
-                        st.error(f"❌ Ancora fallito per '{row['punto_vendita']}'.")
-                    
-                    retry_progress.progress((index + 1) / len(failed_edited_df))
-                    time.sleep(1)
-
-                conn.commit()
-                conn.close()
-                
-                retry_status.text("Retry completato!")
-                st.success(f"Retry terminato. Riusciti: {retry_successful}, Falliti: {retry_failed}.")
-                st.rerun()
+            # la riprova usa l'indirizzo modificato: se invariato l'esito arriva dalla cache
+            resolved, job_id = geocode_in_tiers(failed_edited_df, created_by=st.session_state.get("username"))
+            if job_id is not None:
+                st.toast(f"Riprova accodata (job #{job_id}).", icon="🔁")
             else:
-                st.info("Nessun record fallito da riprovare.")
+                st.toast(f"Nessun indirizzo stradale da cercare; centroide del comune assegnato a {len(resolved)} record.", icon="📍")
+            st.rerun()
+
 
 def show_import_export_dati():
     st.header("📤 Import / Export Dati")
@@ -2171,11 +4701,18 @@ def show_import_export_dati():
                             new_data[col] = pd.to_datetime(new_data[col], errors='coerce').dt.date
                     new_data = new_data.where(pd.notnull(new_data), None)
 
+                    # Verifica città/provincia sull'elenco dei comuni (non bloccante)
+                    comuni_issues = check_comuni(new_data['citta'], new_data['provincia'])
+                    if not comuni_issues.empty:
+                        st.warning(f"⚠️ {int(comuni_issues['righe'].sum())} righe hanno città/provincia non riconosciute o ambigue nell'elenco comuni.")
+                        st.dataframe(comuni_issues, hide_index=True)
+
                     # Bottone di conferma per l'importazione
                     if st.button("Conferma e Aggiungi alla Tabella", type="primary"):
                         conn = get_connection()
                         try:
                             new_data.to_sql('manutenzioni', conn, if_exists='append', index=False)
+                            bump_data_version("manutenzioni")
                             st.success(f"✅ Importazione completata! {len(new_data)} righe sono state aggiunte al database.")
                             st.toast("Dati manutenzioni importati!", icon="📥")
                             st.rerun()
@@ -2196,7 +4733,7 @@ def show_import_export_dati():
         st.warning("Questa è un'operazione da eseguire una sola volta. Se eseguita di nuovo, sovrascriverà tutti i dati esistenti nella tabella 'comuni'.")
         st.write(f"Il file Excel deve avere esattamente queste colonne: {', '.join(COMUNI_COLUMNS)}")
         
-        conn = get_connection()
+        conn = get_connection(readonly=True)
         count = pd.read_sql_query("SELECT COUNT(*) as count FROM comuni", conn)['count'].iloc[0]
         conn.close()
         if count > 0:
@@ -2214,7 +4751,13 @@ def show_import_export_dati():
                     if st.button("Conferma e Importa Comuni", type="primary"):
                         conn = get_connection()
                         try:
-                            new_comuni.to_sql('comuni', conn, if_exists='replace', index=False)
+                            # import massivo fuori dal journal (il prossimo backup sarà completo);
+                            # 'replace' ricrea la tabella: ricostruisce R*Tree e trigger
+                            with journal_paused(conn):
+                                new_comuni.to_sql('comuni', conn, if_exists='replace', index=False)
+                                install_spatial_index(conn, "comuni")
+                            conn.commit()
+                            bump_data_version("comuni")
                             st.success(f"✅ Importazione completata! La tabella 'comuni' è stata popolata con {len(new_comuni)} comuni.")
                             st.toast("Dati comuni importati!", icon="🗂️")
                             st.rerun()
@@ -2255,6 +4798,7 @@ def show_impostazioni():
             try:
                 cursor.execute("INSERT INTO format (brand) VALUES (?)", (new_brand.strip(),))
                 conn.commit()
+                bump_data_version("format")
                 st.success(f"Brand '{new_brand.strip()}' aggiunto con successo!")
                 st.rerun()
             except sqlite3.IntegrityError:
@@ -2273,6 +4817,30 @@ def show_impostazioni():
         st.info("Nessun brand aggiunto. Usare il form sopra per aggiungerne.")
 
     st.markdown("---")
+    st.subheader("🗂️ Indici del Database")
+    missing_indexes = find_missing_indexes()
+    if not missing_indexes:
+        st.success(f"✅ Tutti gli indici gestiti ({len(MANAGED_INDEXES)}) sono presenti.")
+    else:
+        st.warning(f"⚠️ Mancano {len(missing_indexes)} indici: le ricerche su queste colonne eseguono una scansione completa.")
+        st.dataframe(
+            pd.DataFrame(missing_indexes, columns=["database", "indice", "tabella", "colonne", "univoco"]),
+            use_container_width=True, hide_index=True
+        )
+        if st.button("Crea indici mancanti", type="primary"):
+            try:
+                for db_file in sorted({entry[0] for entry in missing_indexes}):
+                    conn = get_connection(db_file)
+                    try:
+                        create_managed_indexes(conn, db_file)
+                        conn.commit()
+                    finally:
+                        conn.close()
+                st.success("✅ Indici creati con successo!")
+                st.rerun()
+            except Exception as e:
+                st.error(f"Errore durante la creazione degli indici: {e}")
+
     st.markdown("---")
     
     # --- NUOVA SEZIONE PER LA MIGRAZIONE ---
@@ -2289,37 +4857,48 @@ def show_impostazioni():
         cursor = conn.cursor()
         try:
             st.info("Avvio migrazione...")
-            # 1. Rinomina la tabella esistente
-            cursor.execute("ALTER TABLE manutenzioni RENAME TO manutenzioni_old")
+            # La ricostruzione rinumera gli ID: fuori dal journal, il prossimo backup sarà completo
+            with journal_paused(conn):
+                # 1. Rinomina la tabella esistente
+                cursor.execute("ALTER TABLE manutenzioni RENAME TO manutenzioni_old")
             
-            # 2. Crea la nuova tabella con la struttura corretta
-            cursor.execute('''
-                CREATE TABLE manutenzioni (
-                    ID INTEGER PRIMARY KEY AUTOINCREMENT,
-                    punto_vendita TEXT NOT NULL,
-                    indirizzo TEXT NOT NULL,
-                    cap TEXT,
-                    citta TEXT NOT NULL,
-                    provincia TEXT,
-                    regione TEXT,
-                    ultimo_intervento DATE,
-                    prossimo_intervento DATE,
-                    attrezzature TEXT,
-                    note TEXT,
-                    lat REAL,
-                    lon REAL,
-                    codice TEXT,
-                    brand TEXT
-                )
-            ''')
+                # 2. Crea la nuova tabella con la struttura corretta
+                cursor.execute('''
+                    CREATE TABLE manutenzioni (
+                        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+                        punto_vendita TEXT NOT NULL,
+                        indirizzo TEXT NOT NULL,
+                        cap TEXT,
+                        citta TEXT NOT NULL,
+                        provincia TEXT,
+                        regione TEXT,
+                        ultimo_intervento DATE,
+                        prossimo_intervento DATE,
+                        attrezzature TEXT,
+                        note TEXT,
+                        lat REAL,
+                        lon REAL,
+                        codice TEXT,
+                        brand TEXT,
+                        referente_pv TEXT,
+                        telefono TEXT,
+                        precisione_geo TEXT
+                    )
+                ''')
             
-            # 3. Copia i dati dalla vecchia tabella alla nuova
-            cursor.execute("INSERT INTO manutenzioni (punto_vendita, indirizzo, cap, citta, provincia, regione, ultimo_intervento, prossimo_intervento, attrezzature, note, lat, lon, codice, brand) SELECT punto_vendita, indirizzo, cap, citta, provincia, regione, ultimo_intervento, prossimo_intervento, attrezzature, note, lat, lon, codice, brand FROM manutenzioni_old")
+                # 3. Copia i dati dalla vecchia tabella alla nuova
+                cursor.execute("INSERT INTO manutenzioni (punto_vendita, indirizzo, cap, citta, provincia, regione, ultimo_intervento, prossimo_intervento, attrezzature, note, lat, lon, codice, brand, referente_pv, telefono, precisione_geo) SELECT punto_vendita, indirizzo, cap, citta, provincia, regione, ultimo_intervento, prossimo_intervento, attrezzature, note, lat, lon, codice, brand, referente_pv, telefono, precisione_geo FROM manutenzioni_old")
             
-            # 4. Elimina la vecchia tabella
-            cursor.execute("DROP TABLE manutenzioni_old")
+                # 4. Elimina la vecchia tabella
+                cursor.execute("DROP TABLE manutenzioni_old")
+
+                # 5. Ricrea indici, indice spaziale e trigger della cache distanze persi con la vecchia tabella
+                create_managed_indexes(conn, DB_FILE)
+                install_spatial_index(conn, "manutenzioni")
+                install_distance_cache(conn, clear=True)
             
             conn.commit()
+            bump_data_version("manutenzioni")
             st.success("✅ Migrazione completata con successo! La tabella 'manutenzioni' ora ha il contatore ID corretto.")
             st.balloons()
             st.rerun()
@@ -2366,6 +4945,7 @@ def show_impostazioni():
                     seq_row = cursor.fetchone()
                     report_lines.append(f"- Riga in 'sqlite_sequence' dopo la cancellazione: {seq_row}")
                     conn.commit()
+                    bump_data_version("manutenzioni")
                     st.session_state.diagnostic_report = "\n".join(report_lines)
                     st.success("✅ Comandi di reset eseguiti. Controlla il report diagnostico qui sopra.")
                     st.balloons()
@@ -2390,16 +4970,21 @@ def main():
         st.session_state["role"] = None
         st.session_state["login_start_time"] = None
 
-    # 🔹 ASSICURATI CHE I DATABASE SIANO INIZIALIZZATI (se i file esistono)
-    if os.path.exists("manutenzioni.db"):
-        init_db()
-    if os.path.exists("login_log.db"):
-        init_login_log()
-
     # --- GESTIONE RIPRISTINO DB ---
     if "restore_report" not in st.session_state:
         st.session_state["restore_report"] = restore_from_github_simple()
     report = st.session_state["restore_report"]
+
+    # 🔹 SCHEMA DEI DATABASE: migrazioni applicate una sola volta per processo (dopo il ripristino)
+    try:
+        ensure_database_schema()
+    except Exception as e:
+        st.error(f"❌ Errore durante l'aggiornamento dello schema del database: {e}")
+        st.stop()
+    # job di geocodifica interrotti da un riavvio: ripresi in background una volta per processo
+    resume_geocoding_jobs()
+    # backup automatico su GitHub delle modifiche (thread unico per processo)
+    ensure_backup_scheduler()
     if report["errors"]:
         for error in report["errors"]: st.error(error)
     if report["warnings"]:
@@ -2455,7 +5040,7 @@ def main():
         if os.path.exists(LOGO_PATH):
             st.image(LOGO_PATH, width=180)
         try:
-            conn = get_connection()
+            conn = get_connection(readonly=True)
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM programmazione")
             pending_count = cursor.fetchone()[0]
@@ -2530,7 +5115,7 @@ def main():
     else:
         st.sidebar.caption("🕒 Nessun backup registrato.")
 
-    st.sidebar.caption("Backup automatico e ripristino da GitHub")
+    show_backup_status()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,390 @@
+import base64
+import os
+import json
+import sqlite3
+import threading
+
+import pytest
+
+import gestione_manutenzioni as gm
+
+
+SETTINGS = {"token": "t", "repo": "o/r", "branch": "main", "api_url": "https://api.test"}
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None, content=b""):
+        self.status_code = status_code
+        self._payload = payload
+        self.content = content
+        self.text = json.dumps(payload)
+
+    def json(self):
+        return self._payload
+
+
+class FakeGitHub:
+    """
+    Git Data API in memoria; `before_patch`, se impostata, viene eseguita una volta prima del
+    primo PATCH; le chiamate (metodo, percorso) in `fail` rispondono 500.
+    """
+
+    def __init__(self):
+        self.blobs, self.trees, self.commits = {}, {"t0": {}}, {"c0": {"tree": "t0", "parents": []}}
+        self.head = "c0"
+        self.before_patch = None
+        self.calls = []
+        self.fail = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def files(self, commit=None):
+        return self.trees[self.commits[commit or self.head]["tree"]]
+
+    def put(self, files):
+        """Commit diretto sul branch (un'altra istanza che fa il suo backup)."""
+        tree = dict(self.files())
+        for path, content in files.items():
+            sha = gm.git_blob_sha(content)
+            self.blobs[sha] = content
+            tree[path] = sha
+        tree_sha = f"t{len(self.trees)}"
+        self.trees[tree_sha] = tree
+        commit = f"c{len(self.commits)}"
+        self.commits[commit] = {"tree": tree_sha, "parents": [self.head]}
+        self.head = commit
+
+    def request(self, method, url, timeout=None, json=None, params=None):
+        path = url.split("/repos/o/r/", 1)[1]
+        self.calls.append((method, path))
+        if (method, path) in self.fail:
+            return FakeResponse(500, {"message": "errore simulato"})
+        if method == "GET" and path.startswith("git/ref/heads/"):
+            return FakeResponse(200, {"object": {"sha": self.head}})
+        if method == "GET" and path.startswith("git/commits/"):
+            return FakeResponse(200, {"tree": {"sha": self.commits[path.rsplit("/", 1)[1]]["tree"]}})
+        if method == "GET" and path.startswith("git/trees/"):
+            tree = self.trees[path.rsplit("/", 1)[1]]
+            return FakeResponse(200, {"tree": [{"path": p, "type": "blob", "sha": s} for p, s in tree.items()]})
+        if method == "POST" and path == "git/blobs":
+            content = base64.b64decode(json["content"])
+            sha = gm.git_blob_sha(content)
+            self.blobs[sha] = content
+            return FakeResponse(201, {"sha": sha})
+        if method == "POST" and path == "git/trees":
+            tree = dict(self.trees[json["base_tree"]])
+            tree.update({e["path"]: e["sha"] for e in json["tree"]})
+            tree_sha = f"t{len(self.trees)}"
+            self.trees[tree_sha] = {p: s for p, s in tree.items() if s is not None}
+            return FakeResponse(201, {"sha": tree_sha})
+        if method == "POST" and path == "git/commits":
+            commit = f"c{len(self.commits)}"
+            self.commits[commit] = {"tree": json["tree"], "parents": json["parents"]}
+            return FakeResponse(201, {"sha": commit})
+        if method == "PATCH" and path.startswith("git/refs/heads/"):
+            if self.before_patch:
+                hook, self.before_patch = self.before_patch, None
+                hook()
+            if self.commits[json["sha"]]["parents"] != [self.head]:
+                return FakeResponse(422, {"message": "Update is not a fast forward"})
+            self.head = json["sha"]
+            return FakeResponse(200, {"object": {"sha": self.head}})
+        return FakeResponse(400, {"message": f"{method} {path}"})
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        path = url.split("/contents/", 1)[1]
+        files = self.files(params["ref"] if params["ref"] != "main" else None)
+        if path not in files:
+            return FakeResponse(404)
+        return FakeResponse(200, content=self.blobs[files[path]])
+
+
+@pytest.fixture
+def github(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fake = FakeGitHub()
+    monkeypatch.setattr(gm, "github_session", lambda settings: fake)
+    return fake
+
+
+def make_database(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE manutenzioni (ID INTEGER PRIMARY KEY, note TEXT)")
+    with conn:
+        gm.install_change_journal(conn)
+        conn.executemany("INSERT INTO manutenzioni (note) VALUES (?)", [(f"pv {i}",) for i in range(50)])
+    return conn
+
+
+def rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT rowid, * FROM manutenzioni ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+
+
+def make_login_database(path):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE login_log (id INTEGER PRIMARY KEY, username TEXT)")
+        conn.execute("INSERT INTO login_log (username) VALUES ('admin')")
+    conn.close()
+
+
+def test_all_databases_land_in_one_commit(github):
+    make_database(gm.DB_FILE).close()
+    make_login_database(gm.LOGIN_DB_FILE)
+    reports = gm.backup_databases(SETTINGS)
+    assert [report["esito"] for report in reports] == ["caricato", "caricato"]
+    assert [call for call in github.calls if call[0] in ("POST", "PATCH") and call[1] != "git/blobs"] == [
+        ("POST", "git/trees"), ("POST", "git/commits"), ("PATCH", "git/refs/heads/main"),
+    ]
+    assert github.commits[github.head]["parents"] == ["c0"]
+    for db_file in gm.BACKUP_DB_FILES:
+        assert gm.backup_paths(db_file)[0] in github.files()
+
+
+@pytest.mark.parametrize("failing", ["git/blobs", "git/trees", "git/commits"])
+def test_failed_upload_leaves_branch_unchanged(github, failing):
+    make_database(gm.DB_FILE).close()
+    make_login_database(gm.LOGIN_DB_FILE)
+    github.fail.add(("POST", failing))
+    reports = gm.backup_databases(SETTINGS)
+    assert [report["esito"] for report in reports] == ["errore", "errore"]
+    assert github.head == "c0" and github.files() == {}
+    assert gm.load_backup_state() == {}
+
+    github.fail.clear()
+    assert [report["esito"] for report in gm.backup_databases(SETTINGS)] == ["caricato", "caricato"]
+
+
+def test_unchanged_database_is_not_uploaded(github):
+    conn = make_database("manutenzioni.db")
+    gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+
+    github.calls.clear()
+    [report] = gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+    assert (report["esito"], report["tipo"]) == ("invariato", "incrementale")
+    assert github.calls == []
+    # senza journal attivo il confronto è sull'hash dello snapshot completo
+    with conn:
+        conn.execute("UPDATE journal_control SET pausa = 1 WHERE id = 1")
+    gm.backup_databases(SETTINGS, ["manutenzioni.db"], full=True)
+    github.calls.clear()
+    [report] = gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+    assert (report["esito"], report["tipo"]) == ("invariato", "completo")
+    assert github.calls == []
+    conn.close()
+
+
+def test_snapshot_has_only_committed_data(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn = make_database("manutenzioni.db")
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.execute("UPDATE manutenzioni SET note = 'nel wal' WHERE ID = 1")
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("UPDATE manutenzioni SET note = 'non confermato' WHERE ID = 2")
+
+    with gm.database_snapshot("manutenzioni.db") as path:
+        snapshot = sqlite3.connect(path)
+        assert snapshot.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        notes = dict(snapshot.execute("SELECT ID, note FROM manutenzioni WHERE ID IN (1, 2)"))
+        snapshot.close()
+    assert notes == {1: "nel wal", 2: "pv 1"}
+    assert not os.path.exists(path)
+    conn.rollback()
+    conn.close()
+
+
+def test_incremental_backup_falls_back_to_full_when_branch_moves(github, tmp_path, monkeypatch):
+    conn = make_database("manutenzioni.db")
+    [report] = gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+    assert (report["esito"], report["tipo"]) == ("caricato", "completo")
+
+    with conn:
+        conn.execute("UPDATE manutenzioni SET note = 'modificato' WHERE ID = 3")
+    manifest_path = gm.backup_paths("manutenzioni.db")[0]
+    # un'altra istanza riscrive il manifest tra la lettura della testa e lo spostamento del ref
+    github.before_patch = lambda: github.put({manifest_path: b'{"altro": true}'})
+    [report] = gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+    assert (report["esito"], report["tipo"], report["righe"]) == ("caricato", "completo", 0)
+    conn.close()
+
+    manifest = json.loads(github.blobs[github.files()[manifest_path]])
+    assert manifest["journal"] == []
+
+    live = rows("manutenzioni.db")
+    (tmp_path / "ripristino").mkdir()
+    monkeypatch.chdir(tmp_path / "ripristino")
+    result = gm.restore_database("manutenzioni.db", SETTINGS, github, {})
+    assert result["esito"] == "ripristinato"
+    assert rows("manutenzioni.db") == live
+
+
+def test_restore_with_journal_drops_stale_distances(github, tmp_path, monkeypatch):
+    conn = sqlite3.connect("manutenzioni.db")
+    conn.execute("CREATE TABLE manutenzioni (ID INTEGER PRIMARY KEY, note TEXT, lat REAL, lon REAL)")
+    with conn:
+        gm.install_change_journal(conn)
+        gm.install_spatial_index(conn, "manutenzioni")
+        gm.install_distance_cache(conn)
+        conn.executemany("INSERT INTO manutenzioni (note, lat, lon) VALUES (?, ?, ?)",
+                         [("pv 1", 45.0, 9.0), ("pv 2", 45.5, 9.5)])
+        conn.execute("INSERT INTO distanze (pv_id_a, pv_id_b, km) VALUES (1, 2, 123.0)")
+    gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+
+    with conn:
+        conn.execute("UPDATE manutenzioni SET lat = 41.9, lon = 12.5 WHERE ID = 1")
+    [report] = gm.backup_databases(SETTINGS, ["manutenzioni.db"])
+    assert (report["esito"], report["tipo"]) == ("caricato", "incrementale")
+    assert conn.execute("SELECT COUNT(*) FROM distanze").fetchone()[0] == 0
+    conn.close()
+
+    (tmp_path / "ripristino").mkdir()
+    monkeypatch.chdir(tmp_path / "ripristino")
+    gm.restore_database("manutenzioni.db", SETTINGS, github, {})
+    restored = sqlite3.connect("manutenzioni.db")
+    try:
+        assert restored.execute("SELECT COUNT(*) FROM distanze").fetchone()[0] == 0
+        rtree = gm.SPATIAL_INDEXES["manutenzioni"][0]
+        assert restored.execute(f"SELECT min_lat, min_lon FROM {rtree} WHERE id = 1").fetchone() == pytest.approx((41.9, 12.5), abs=1e-4)
+    finally:
+        restored.close()
+
+
+def test_journal_stays_paused_and_capped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    conn = make_database("manutenzioni.db")
+    assert conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0] == 50
+
+    with conn:
+        conn.execute("UPDATE journal_control SET pausa = 1 WHERE id = 1")
+        with gm.journal_paused(conn):
+            conn.execute("DELETE FROM manutenzioni WHERE ID = 1")
+        conn.execute("UPDATE manutenzioni SET note = 'x' WHERE ID = 2")
+    assert conn.execute("SELECT pausa FROM journal_control").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0] == 50
+
+    assert gm.journal_position("manutenzioni.db") is None
+    with conn:
+        conn.execute("UPDATE journal_control SET pausa = 0 WHERE id = 1")
+    requested = gm.journal_position("manutenzioni.db")[1]
+    with conn:
+        assert not gm.cap_journal(conn, max_rows=50)
+        assert gm.cap_journal(conn, max_rows=10)
+    assert gm.journal_position("manutenzioni.db") == (0, requested + 1)
+    conn.close()
+
+
+def make_registry():
+    return {"lock": threading.Lock(), "versions": {}, "writes": 0, "saved_writes": 0,
+            "last_write": None, "first_unsaved": None}
+
+
+def write_at(registry, now, monkeypatch):
+    monkeypatch.setattr(gm.time, "monotonic", lambda: now)
+    gm._bump_versions(registry, "login_log")
+
+
+def test_backup_due_after_quiet_period_or_max_delay(monkeypatch):
+    settings = {"quiet_seconds": 60, "max_delay_seconds": 600}
+    registry = make_registry()
+    assert not gm.backup_due(registry, settings, 0)
+
+    write_at(registry, 1000, monkeypatch)
+    assert not gm.backup_due(registry, settings, 1059)
+    assert gm.backup_due(registry, settings, 1060)
+
+    # scritture continue: il periodo di quiete non scade mai, il ritardo massimo sì
+    for now in range(1030, 1600, 30):
+        write_at(registry, now, monkeypatch)
+        assert not gm.backup_due(registry, settings, now)
+    assert gm.backup_due(registry, settings, 1600)
+
+
+def test_run_backup_marks_writes_saved(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    registry, scheduler = make_registry(), {"run_lock": threading.Lock(), "status": {}}
+    write_at(registry, 100, monkeypatch)
+    write_at(registry, 110, monkeypatch)
+
+    def backup(settings):
+        # una scrittura durante il caricamento resta da salvare
+        gm._bump_versions(registry, "manutenzioni")
+        return [{"esito": "caricato", "bytes_inviati": 42, "messaggio": ""}]
+
+    monkeypatch.setattr(gm, "backup_databases", backup)
+    assert gm.run_backup(scheduler, registry, {}, "automatico")
+    assert (registry["writes"], registry["saved_writes"]) == (3, 2)
+    assert registry["first_unsaved"] is not None
+    assert scheduler["status"]["bytes_inviati"] == 42
+    assert (tmp_path / gm.BACKUP_TIMESTAMP_FILE).exists()
+
+    monkeypatch.setattr(gm, "backup_databases", lambda settings: [{"esito": "caricato", "bytes_inviati": 0, "messaggio": ""}])
+    gm.run_backup(scheduler, registry, {}, "automatico")
+    assert registry["saved_writes"] == 3 and registry["first_unsaved"] is None
+
+    with scheduler["run_lock"]:
+        assert gm.run_backup(scheduler, registry, {}, "manuale") is None
+
+
+def test_run_backup_failure_keeps_writes_pending(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    registry, scheduler = make_registry(), {"run_lock": threading.Lock(), "status": {}}
+    write_at(registry, 100, monkeypatch)
+    monkeypatch.setattr(gm, "backup_databases", lambda settings: [{"esito": "errore", "bytes_inviati": 0, "messaggio": "502"}])
+    gm.run_backup(scheduler, registry, {}, "automatico")
+    assert registry["saved_writes"] == 0
+    assert scheduler["status"]["errore"] == "502"
+    assert scheduler["status"]["riprova_dopo"] == 100 + gm.BACKUP_AUTO_RETRY_SECONDS
+    assert not (tmp_path / gm.BACKUP_TIMESTAMP_FILE).exists()
+    assert not (tmp_path / gm.DB_FILE).exists()
+
+
+@pytest.fixture
+def paged_database(github, monkeypatch):
+    """Database di circa 30 pagine da 4 KiB, un blocco per pagina, journal in pausa (backup completi)."""
+    monkeypatch.setattr(gm, "BACKUP_CHUNK_SIZE", 4096)
+    conn = make_database(gm.DB_FILE)
+    with conn:
+        conn.executemany("INSERT INTO manutenzioni (note) VALUES (?)", [("x" * 200,) for _ in range(500)])
+        conn.execute("UPDATE journal_control SET pausa = 1 WHERE id = 1")
+    [report] = gm.backup_databases(SETTINGS, [gm.DB_FILE])
+    assert report["blocchi_caricati"] == report["blocchi"] > 20
+    yield conn
+    conn.close()
+
+
+def test_only_changed_chunks_are_uploaded(github, paged_database):
+    with paged_database as conn:
+        conn.execute("UPDATE manutenzioni SET note = 'y' || substr(note, 2) WHERE ID = 300")
+    github.calls.clear()
+    [report] = gm.backup_databases(SETTINGS, [gm.DB_FILE])
+    assert (report["esito"], report["tipo"], report["blocchi_caricati"]) == ("caricato", "completo", 1)
+    # il blocco nuovo e il manifest
+    assert github.calls.count(("POST", "git/blobs")) == 2
+
+
+@pytest.mark.parametrize("damage", ["corrotto", "mancante"])
+def test_restore_rejects_damaged_chunk(github, paged_database, tmp_path, monkeypatch, damage):
+    files = github.files()
+    chunk_path = sorted(path for path in files if "/chunks/" in path)[3]
+    if damage == "corrotto":
+        github.put({chunk_path: gm.gzip.compress(b"\0" * 4096)})
+    else:
+        tree = {path: sha for path, sha in files.items() if path != chunk_path}
+        github.trees["t_danneggiato"] = tree
+        github.commits["c_danneggiato"] = {"tree": "t_danneggiato", "parents": [github.head]}
+        github.head = "c_danneggiato"
+
+    (tmp_path / "ripristino").mkdir()
+    monkeypatch.chdir(tmp_path / "ripristino")
+    with pytest.raises(ValueError, match=damage):
+        gm.restore_database(gm.DB_FILE, SETTINGS, github, {})
+    assert os.listdir(".") == []
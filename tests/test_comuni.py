@@ -0,0 +1,19 @@
+import pandas as pd
+
+import gestione_manutenzioni as gm
+
+
+def test_comuni_index_accepts_any_cap_format(monkeypatch):
+    comuni = pd.DataFrame({
+        "comune": ["Milano", "Milano", "Bergamo", "Aosta", "Roma"],
+        "provincia": ["MI", "MI", "BG", "AO", "RM"],
+        "regione": ["Lombardia", "Lombardia", "Lombardia", "Valle d'Aosta", "Lazio"],
+        "codice": ["F205", "F205", "A794", "A326", "H501"],
+        "cap": ["20121-20162", 20121.0, "24121", 11100, None],
+        "lat": [45.46, 45.46, 45.69, 45.73, 41.89],
+        "lon": [9.19, 9.19, 9.67, 7.32, 12.48],
+    })
+    monkeypatch.setattr(gm, "load_data", lambda table: comuni)
+    index = gm._comuni_index("test-cap")
+    caps = {label: entry["caps"] for label, entry in index["by_label"].items()}
+    assert caps == {"Milano": ["20121-20162", "20121"], "Bergamo": ["24121"], "Aosta": ["11100"], "Roma": []}
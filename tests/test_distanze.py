@@ -0,0 +1,65 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import gestione_manutenzioni as gm
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pools = {"lock": threading.Lock(), "pools": {}}
+    monkeypatch.setattr(gm, "_connection_pools", lambda: pools)
+    conn = gm.get_connection()
+    gm.apply_migrations(conn, gm.MIGRATIONS)
+    with gm.write_transaction(conn):
+        conn.executemany("INSERT INTO manutenzioni (ID, punto_vendita, indirizzo, citta, lat, lon) VALUES (?, ?, 'Via Roma 1', 'Milano', ?, ?)",
+                         [(1, "PV 1", 45.46, 9.19), (2, "PV 2", 45.07, 7.69), (3, "PV 3", 41.90, 12.50)])
+    conn.close()
+    yield
+    for pool in pools["pools"].values():
+        pool.close_all()
+
+
+def cached_pairs():
+    conn = sqlite3.connect(gm.DB_FILE)
+    try:
+        return conn.execute("SELECT pv_id_a, pv_id_b FROM distanze ORDER BY 1, 2").fetchall()
+    finally:
+        conn.close()
+
+
+def test_moving_a_pv_invalidates_its_distances(db):
+    gm.pv_distance_matrix_km([1, 2, 3], [45.46, 45.07, 41.90], [9.19, 7.69, 12.50])
+    assert cached_pairs() == [(1, 2), (1, 3), (2, 3)]
+
+    conn = gm.get_connection()
+    with gm.write_transaction(conn):
+        conn.execute("UPDATE manutenzioni SET note = 'solo note' WHERE ID = 3")
+    assert cached_pairs() == [(1, 2), (1, 3), (2, 3)]
+    with gm.write_transaction(conn):
+        conn.execute("UPDATE manutenzioni SET lat = 40.85, lon = 14.27 WHERE ID = 1")
+    conn.close()
+    assert cached_pairs() == [(2, 3)]
+
+    dist = gm.pv_distance_matrix_km([1, 2, 3], [40.85, 45.07, 41.90], [14.27, 7.69, 12.50])
+    assert dist[0, 1] == pytest.approx(gm.haversine_km(40.85, 14.27, 45.07, 7.69))
+    assert cached_pairs() == [(1, 2), (1, 3), (2, 3)]
+
+
+def test_busy_database_skips_the_cache_write(db):
+    writer = sqlite3.connect(gm.DB_FILE)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        started = time.monotonic()
+        dist = gm.pv_distance_matrix_km([1, 2], [45.46, 45.07], [9.19, 7.69])
+        assert time.monotonic() - started < 1
+    finally:
+        writer.rollback()
+        writer.close()
+    assert dist[0, 1] == pytest.approx(gm.haversine_km(45.46, 9.19, 45.07, 7.69))
+    assert np.allclose(dist, dist.T)
+    assert cached_pairs() == []
@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import gestione_manutenzioni as gm
+
+
+class FakeLocation:
+    def __init__(self, latitude, longitude):
+        self.latitude, self.longitude = latitude, longitude
+
+
+class FakeGeocoder:
+    """Geocoder locale: trova ogni indirizzo tranne quelli in `missing`; `on_call` viene chiamata prima di rispondere."""
+
+    def __init__(self, missing=(), on_call=None):
+        self.queries, self.missing, self.on_call = [], set(missing), on_call
+
+    def geocode(self, query, timeout=None):
+        self.queries.append(query)
+        if self.on_call:
+            self.on_call(len(self.queries))
+        if any(text in query for text in self.missing):
+            return None
+        return FakeLocation(45.0 + len(self.queries) / 100, 9.0)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pools = {"lock": threading.Lock(), "pools": {}}
+    conn = gm._connection_from(pools, gm.DB_FILE, readonly=False)
+    gm.apply_migrations(conn, gm.MIGRATIONS)
+    conn.close()
+    yield pools
+    for pool in pools["pools"].values():
+        pool.close_all()
+
+
+def add_job(stato="in_coda", done=0, total=3):
+    """Job con `total` PV in via Roma 1..N, di cui i primi `done` già elaborati."""
+    conn = sqlite3.connect(gm.DB_FILE)
+    with conn:
+        job_id = conn.execute(
+            "INSERT INTO geocode_jobs (stato, totale, creato_il) VALUES (?, ?, '2026-01-01T00:00:00')", (stato, total)
+        ).lastrowid
+        for pv in range(1, total + 1):
+            conn.execute("INSERT INTO manutenzioni (ID, punto_vendita, indirizzo, citta) VALUES (?, ?, ?, 'Milano')",
+                         (pv, f"PV {pv}", f"Via Roma {pv}"))
+            conn.execute(
+                "INSERT INTO geocode_job_items (job_id, pv_id, indirizzo, citta, stato) VALUES (?, ?, ?, 'Milano', ?)",
+                (job_id, pv, f"Via Roma {pv}", "ok" if pv <= done else "in_coda"),
+            )
+    conn.close()
+    return job_id
+
+
+def item_states(job_id):
+    conn = sqlite3.connect(gm.DB_FILE)
+    try:
+        return dict(conn.execute("SELECT pv_id, stato FROM geocode_job_items WHERE job_id = ?", (job_id,)).fetchall())
+    finally:
+        conn.close()
+
+
+def run_worker(pools, geocoder):
+    state = {"lock": threading.Lock(), "thread": object(), "bucket": gm.TokenBucket(1000, 10)}
+    versions = {"lock": threading.Lock(), "versions": {}, "writes": 0, "saved_writes": 0,
+                "last_write": None, "first_unsaved": None}
+    gm._geocoding_worker_loop(state, pools, versions, geocoder)
+    return state, versions
+
+
+def test_token_bucket_spaces_requests():
+    bucket = gm.TokenBucket(rate=20, capacity=1)
+    times = []
+    for _ in range(5):
+        bucket.acquire()
+        times.append(time.monotonic())
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 0.04
+    assert times[-1] - times[0] >= 0.19
+
+
+def test_items_are_committed_one_at_a_time(db):
+    job_id = add_job()
+    seen = []
+    # ogni richiesta vede già salvati gli elementi precedenti (su un'altra connessione)
+    geocoder = FakeGeocoder(missing={"Via Roma 2"}, on_call=lambda n: seen.append(item_states(job_id)))
+    state, versions = run_worker(db, geocoder)
+
+    assert [sum(s != "in_coda" for s in states.values()) for states in seen] == [0, 1, 2]
+    assert item_states(job_id) == {1: "ok", 2: "fallito", 3: "ok"}
+    conn = sqlite3.connect(gm.DB_FILE)
+    assert conn.execute("SELECT stato FROM geocode_jobs WHERE id = ?", (job_id,)).fetchone()[0] == "completato"
+    assert conn.execute("SELECT COUNT(*) FROM manutenzioni WHERE lat IS NOT NULL").fetchone()[0] == 2
+    conn.close()
+    assert state["thread"] is None
+    assert versions["versions"]["manutenzioni"] == 2
+
+
+def test_interrupted_job_resumes_from_queued_items(db):
+    job_id = add_job(stato="in_corso", done=1)
+    geocoder = FakeGeocoder()
+    run_worker(db, geocoder)
+    assert not any("Via Roma 1," in query for query in geocoder.queries)
+    assert item_states(job_id) == {1: "ok", 2: "ok", 3: "ok"}
+
+
+def test_cancelled_job_stops(db):
+    job_id = add_job()
+
+    def cancel(n):
+        if n == 1:
+            conn = sqlite3.connect(gm.DB_FILE)
+            with conn:
+                conn.execute("UPDATE geocode_jobs SET stato = 'annullato' WHERE id = ?", (job_id,))
+            conn.close()
+
+    geocoder = FakeGeocoder(on_call=cancel)
+    run_worker(db, geocoder)
+    states = item_states(job_id)
+    assert states[1] == "ok" and states[2] == states[3] == "in_coda"
+    assert all("Via Roma 1," in query for query in geocoder.queries)
+
+
+def test_ensure_geocoding_worker_uses_the_factory(db, monkeypatch):
+    job_id = add_job()
+    monkeypatch.setattr(gm, "_connection_pools", lambda: db)
+    state = gm._geocoding_worker_state()
+    monkeypatch.setitem(state, "bucket", gm.TokenBucket(1000, 10))
+    geocoder = FakeGeocoder()
+    thread = gm.ensure_geocoding_worker(geocoder_factory=lambda: geocoder)["thread"]
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert item_states(job_id) == {1: "ok", 2: "ok", 3: "ok"}
@@ -0,0 +1,23 @@
+import numpy as np
+
+import gestione_manutenzioni as gm
+
+
+def test_optimize_route_order_with_three_stops():
+    points = np.array([[0.0, 0.0], [10.0, 0.0], [5.0, 0.0]])
+    dist = np.abs(points[:, None, 0] - points[None, :, 0])
+    order = gm.optimize_route_order(dist)
+    assert sorted(order.tolist()) == [0, 1, 2]
+    assert gm.path_length_km(order, dist) == 10.0
+
+
+def test_or_opt_keeps_every_stop():
+    rng = np.random.default_rng(0)
+    for n in range(2, 8):
+        points = rng.random((n, 2))
+        dist = np.linalg.norm(points[:, None] - points[None, :], axis=-1)
+        for fixed_start in (False, True):
+            order, _ = gm._or_opt(np.arange(n), dist, fixed_start)
+            assert sorted(order.tolist()) == list(range(n))
+            if fixed_start:
+                assert order[0] == 0